@@ -42,19 +42,34 @@ from app.core.utils import (
     extend_context,
     initialize_rag,
     save_documents,
+    job_progress_events,
     construct_collection_name,
     create_collection,
 )
-from app.settings import BASE_DIR, url_user_not_required
+from app.settings import BASE_DIR, settings, url_user_not_required, logging
+from app.core.jobs import IngestionJob
 from app.core.document_validator import path_is_valid
 from app.core.response_parser import add_links
+from contextlib import asynccontextmanager
 from typing import Optional
 import os
 
 # TODO: implement a better TextHandler
 # TODO: optionally implement DocHandler
 
-api = FastAPI()
+# components of rag are created lazily, so the construction does not wait for models
+rag = initialize_rag()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.warm_up_on_start:
+        rag.start_warm_up()  # in background, cheap routes are served while models are loading
+    yield
+    rag.shutdown()
+
+
+api = FastAPI(lifespan=lifespan)
 
 api.mount(
     "/chats_storage",
@@ -69,7 +84,6 @@ api.mount(
 templates = Jinja2Templates(
     directory=os.path.join(BASE_DIR, "app", "frontend", "templates")
 )
-rag = initialize_rag()
 
 # NOTE: carefully read documentation to require_user
 # <--------------------------------- Middleware --------------------------------->
@@ -126,6 +140,45 @@ async def health_check():
     return {"status": "ok"}
 
 
+"""
+Reports readiness of every heavy component (models, db connection), 503 until all of them are loaded
+"""
+
+
+@api.get("/ready")
+async def readiness_check():
+    return JSONResponse(
+        {"ready": rag.is_ready(), "components": rag.readiness()},
+        status_code=200 if rag.is_ready() else 503,
+    )
+
+
+"""
+Starts loading of all components in background, progress is reported by /ready
+"""
+
+
+@api.post("/warm_up")
+async def warm_up():
+    started = rag.start_warm_up()
+    return JSONResponse({"started": started, "components": rag.readiness()}, status_code=202)
+
+
+"""
+Latency and cache hit rate of reranking and embedding
+"""
+
+
+@api.get("/metrics")
+def show_metrics():
+    metrics = {}
+    if rag.components["reranking"].status == "ready":
+        metrics["reranking"] = rag.reranking.metrics.as_dict()
+    if rag.components["embedder"].status == "ready" and rag.embedder.cache is not None:
+        metrics["embedding_cache"] = rag.embedder.cache.stats()
+    return JSONResponse(metrics)
+
+
 @api.get("/")
 def root(request: Request):
     current_template = "pages/main.html"
@@ -134,6 +187,24 @@ def root(request: Request):
     )
 
 
+"""
+The question may be about the files attached to the same message, so the answer waits until they are
+indexed (without blocking the event loop). Files of other jobs are indexed in background as before
+"""
+
+
+async def answer_after_indexing(job: IngestionJob | None, collection_name: str, user_prompt: str):
+    if job is not None:
+        await job.wait()
+        if job.error is not None:
+            logging.error("Files of the message were not indexed: %s", job.error)
+
+    async for chunk in rag.generate_response_stream(
+        collection_name=collection_name, user_prompt=user_prompt, stream=True
+    ):
+        yield chunk
+
+
 @api.post("/message_with_docs")
 async def send_message(
         request: Request,
@@ -149,7 +220,8 @@ async def send_message(
 
         register_message(content=prompt, sender="user", chat_id=int(chat_id))
 
-        await save_documents(
+        # documents are indexed in background, the job id is sent in headers right away
+        job = await save_documents(
             collection_name, files=files, RAG=rag, user=user, chat_id=chat_id
         )
 
@@ -159,12 +231,13 @@ async def send_message(
         #         yield chunk.json()
 
         return StreamingResponse(
-            rag.generate_response_stream(
-                collection_name=collection_name, user_prompt=prompt, stream=True
-            ),
+            answer_after_indexing(job, collection_name=collection_name, user_prompt=prompt),
             status,
+            headers={"X-Ingestion-Job-Id": job.id} if job is not None else None,
             media_type="text/event-stream",
         )
+    except HTTPException:
+        raise
     except Exception as e:
         status = 500
         print(e)
@@ -180,6 +253,38 @@ async def replace_message(request: Request):
     return JSONResponse({"updated_message": updated_message})
 
 
+@api.get("/jobs/id={job_id}")
+def show_job(job_id: str, user: User = Depends(get_current_user)):
+    job = rag.jobs.get(job_id)
+    if job is None or job.owner_id != user.id:
+        raise HTTPException(404, "Job not found")
+
+    return JSONResponse(job.get_progress())
+
+
+@api.get("/jobs/id={job_id}/progress")
+def stream_job_progress(job_id: str, user: User = Depends(get_current_user)):
+    job = rag.jobs.get(job_id)
+    if job is None or job.owner_id != user.id:
+        raise HTTPException(404, "Job not found")
+
+    return StreamingResponse(job_progress_events(job), media_type="text/event-stream")
+
+
+"""
+Serves a file of the upload store to logged-in users (pdf viewer loads files from here). Names of stored
+files are sha256 of their content, the cached chunks next to them are never served
+"""
+
+
+@api.get("/documents/{name}")
+def show_stored_file(name: str):
+    path = rag.store.file_path(name)
+    if path is None:
+        raise HTTPException(404, "Document not found")
+    return FileResponse(path)
+
+
 @api.get("/viewer")
 def show_document(
         request: Request,
@@ -0,0 +1,79 @@
+"""
+Measures chunking time of DocumentProcessor.split_document on synthetic text documents of growing size.
+Compares the line lookup through the offsets index with the previous scan from the top of the text.
+
+Run from base dir ---> python -m app.benchmarks.chunking
+"""
+
+from langchain_core.documents import Document
+from app.core.processor import DocumentProcessor
+import random
+import time
+
+
+def scan_start_end_lines(splitted_text: list[str], start_char: int, end_char: int) -> tuple[int, int]:
+    start, end, char_ct = 0, 0, 0
+
+    for i, line in enumerate(splitted_text):
+        if char_ct <= start_char <= char_ct + len(line) + 1:
+            start = i + 1
+        if char_ct <= end_char <= char_ct + len(line) + 1:
+            end = i + 1
+            break
+        char_ct += len(line) + 1
+
+    return start, end
+
+
+def generate_text(size: int, seed: int = 5) -> str:
+    rnd = random.Random(seed)  # nosec B311 - generated benchmark data, not security
+    words = ["retrieval", "augmented", "generation", "QDRANT", "chunk", "line", "citation", "a", "of"]
+    lines = []
+    total = 0
+
+    while total < size:
+        line = " ".join(rnd.choice(words) for _ in range(rnd.randint(0, 20)))
+        lines.append(line)
+        total += len(line) + 1
+
+    return "\n".join(lines)
+
+
+def measure(processor: DocumentProcessor, document: Document, use_index: bool) -> tuple[float, list[tuple[int, int]]]:
+    text = processor.text_splitter.split_documents([document])
+    lines = document.page_content.split("\n")
+
+    start = time.perf_counter()
+    line_index = processor.build_line_index(lines)
+    result = []
+    for chunk in text:
+        start_char = chunk.metadata.get("start_index", 0)
+        end_char = start_char + len(chunk.page_content)
+        if use_index:
+            result.append(processor.get_start_end_lines(lines, start_char, end_char, line_index=line_index))
+        else:
+            result.append(scan_start_end_lines(lines, start_char, end_char))
+
+    return time.perf_counter() - start, result
+
+
+def main():
+    processor = DocumentProcessor(embedder=None)
+    print(f"{'size, chars':>12} {'chunks':>8} {'scan, s':>10} {'index, s':>10} {'full split, s':>14}")
+
+    for size in (250_000, 500_000, 1_000_000, 2_000_000, 4_000_000):
+        document = Document(page_content=generate_text(size), metadata={"source": "benchmark.txt"})
+
+        scan_time, scan_result = measure(processor, document, use_index=False)
+        index_time, index_result = measure(processor, document, use_index=True)
+        assert scan_result == index_result, "Line lookup results differ"  # nosec B101 - benchmark self-check
+
+        start = time.perf_counter()
+        chunks = processor.split_document(document)
+        split_time = time.perf_counter() - start
+
+        print(f"{size:>12} {len(chunks):>8} {scan_time:>10.3f} {index_time:>10.3f} {split_time:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
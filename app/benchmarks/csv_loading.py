@@ -0,0 +1,65 @@
+"""
+Compares packing csv rows into chunks (iter_csv_chunks) with CSVLoader, which makes a Document of
+every row that is then splitted separately. Reports rows per minute and peak python memory.
+
+Run from base dir ---> python -m app.benchmarks.csv_loading
+"""
+
+from langchain_community.document_loaders import CSVLoader
+from app.core.loaders import iter_csv_chunks
+from app.core.processor import DocumentProcessor
+from app.settings import settings
+import tempfile
+import tracemalloc
+import random
+import time
+import os
+
+
+def generate_csv(path: str, rows: int, seed: int = 5) -> None:
+    rnd = random.Random(seed)  # nosec B311 - generated benchmark data, not security
+    with open(path, "w", newline="") as f:
+        f.write("id,name,city,score,comment\n")
+        for i in range(rows):
+            f.write(f'{i},name{i},city{rnd.randint(0, 99)},{rnd.random():.4f},"comment, number {i}"\n')
+
+
+def measure(load) -> tuple[float, float, int]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    chunks = load()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return elapsed, peak, chunks
+
+
+def main():
+    processor = DocumentProcessor(embedder=None)
+    chunk_size = settings.text_splitter.chunk_size
+
+    def packed(path: str) -> int:
+        return sum(len(batch) for batch in iter_csv_chunks(path, chunk_size))
+
+    def per_row(path: str) -> int:
+        return sum(len(processor.split_document(document)) for document in CSVLoader(file_path=path).load())
+
+    print(f"{'rows':>9} {'packed, s':>10} {'rows/min':>12} {'MB':>7} {'chunks':>8} "
+          f"{'per row, s':>11} {'rows/min':>12} {'MB':>7} {'chunks':>8}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in (10_000, 100_000, 1_000_000):
+            path = os.path.join(directory, f"benchmark_{rows}.csv")
+            generate_csv(path, rows)
+
+            packed_time, packed_memory, packed_chunks = measure(lambda: packed(path))
+            line = f"{rows:>9} {packed_time:>10.3f} {rows / packed_time * 60:>12.0f} {packed_memory:>7.1f} {packed_chunks:>8}"
+
+            if rows <= 100_000:  # the per row path takes too long on larger files
+                row_time, row_memory, row_chunks = measure(lambda: per_row(path))
+                line += f" {row_time:>11.3f} {rows / row_time * 60:>12.0f} {row_memory:>7.1f} {row_chunks:>8}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Measures near-duplicate filtering of VectorDatabase.store_vectors on random vectors with planted duplicates.
+Compares one query per vector (accept_vector) with batched filtering (which also upserts accepted points),
+checking the collection with one batched query and with the in-process near-duplicate index.
+Uses qdrant server from settings, falls back to the local (in-memory) mode, where there are no round-trips
+to save and the difference is smaller.
+
+Run from base dir ---> python -m app.benchmarks.dedupe
+"""
+
+from qdrant_client import QdrantClient
+from qdrant_client.models import VectorParams, Distance, PointStruct
+from app.core.database import VectorDatabase
+from app.core.chunks import Chunk
+from app.settings import settings
+from collections import OrderedDict
+from threading import Lock
+from types import SimpleNamespace
+from uuid import uuid4
+import numpy as np
+import time
+
+DIMENSIONALITY = 384
+
+
+def make_db() -> VectorDatabase:
+    db = VectorDatabase.__new__(VectorDatabase)  # no model is needed
+    db.embedder = SimpleNamespace(get_vector_dimensionality=lambda: DIMENSIONALITY)
+    db.dedupe_indexes, db._dedupe_lock = OrderedDict(), Lock()
+    db._dedupe_locks, db._dedupe_checked = {}, {}
+    db.sparse_collections = {}
+    try:
+        db.client = QdrantClient(**settings.qdrant.model_dump())
+        db.client.get_collections()
+    except Exception:
+        db.client = QdrantClient(":memory:")
+    return db
+
+
+def make_vectors(count: int, seed: int = 5) -> np.ndarray:
+    rnd = np.random.default_rng(seed)
+    vectors = rnd.normal(size=(count, DIMENSIONALITY)).astype(np.float32)
+    duplicates = rnd.choice(count, size=count // 10, replace=False)
+    vectors[duplicates] = vectors[(duplicates + 1) % count] + rnd.normal(scale=0.01, size=(len(duplicates), DIMENSIONALITY))
+    return vectors
+
+
+def make_collection(db: VectorDatabase, name: str, existing: np.ndarray) -> None:
+    if db.client.collection_exists(name):
+        db.client.delete_collection(name)
+    db.client.create_collection(name, VectorParams(size=DIMENSIONALITY, distance=Distance.COSINE))
+    db.client.upsert(name, [PointStruct(id=str(uuid4()), vector=vector.tolist()) for vector in existing])
+
+
+def main():
+    print(f"{'vectors':>8} {'one by one, s':>14} {'batched query, s':>17} {'index, s':>9} {'stored':>8}")
+
+    for count in (1_000, 5_000, 10_000):
+        vectors = make_vectors(2 * count)
+        existing, vectors = vectors[::2], vectors[1::2]  # a half is already in the collection
+        chunks = [Chunk(uuid4(), "benchmark.txt", 0, 0, 0, 0, str(i)) for i in range(count)]
+        db = make_db()
+
+        make_collection(db, "benchmark_one_by_one", existing)
+        start = time.perf_counter()
+        accepted = sum(db.accept_vector("benchmark_one_by_one", vector.tolist()) for vector in vectors)
+        one_by_one_time = time.perf_counter() - start
+
+        timings, results = [], []
+        for use_index in (False, True):
+            settings.dedupe_index.enabled = use_index
+            make_collection(db, "benchmark_batched", existing)
+            db.dedupe_indexes.clear()
+            db._dedupe_checked.clear()
+            start = time.perf_counter()
+            results.append(db.store_vectors("benchmark_batched", chunks, vectors))
+            timings.append(time.perf_counter() - start)
+
+        # the one by one check does not see duplicates inside the upload, so it accepts more
+        assert results[1] <= accepted and results[0] <= accepted  # nosec B101 - benchmark self-check
+        print(f"{count:>8} {one_by_one_time:>14.2f} {timings[0]:>17.2f} {timings[1]:>9.2f} {results[1]:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Compares the streaming docx loader with UnstructuredWordDocumentLoader on generated Word files.
+Reports loading time and peak python memory of the parsing itself.
+
+Run from base dir ---> python -m app.benchmarks.docx_loading
+"""
+
+from langchain_community.document_loaders import UnstructuredWordDocumentLoader
+from app.core.loaders import load_docx, iter_docx_paragraphs
+from app.settings import settings
+import tempfile
+import tracemalloc
+import random
+import zipfile
+import time
+import os
+
+CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    "</Types>"
+)
+RELATIONSHIPS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    "</Relationships>"
+)
+
+
+def generate_docx(path: str, paragraphs: int, seed: int = 5) -> None:
+    rnd = random.Random(seed)  # nosec B311 - generated benchmark data, not security
+    words = ["retrieval", "augmented", "generation", "chunk", "citation", "paragraph", "of", "the"]
+
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", CONTENT_TYPES)
+        archive.writestr("_rels/.rels", RELATIONSHIPS)
+        with archive.open("word/document.xml", "w") as xml:
+            xml.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+            )
+            for _ in range(paragraphs):
+                text = " ".join(rnd.choice(words) for _ in range(rnd.randint(5, 60)))
+                xml.write(f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>".encode())
+            xml.write(b"</w:body></w:document>")
+
+
+def measure(load) -> tuple[float, float]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    load()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    print(f"{'paragraphs':>10} {'size, MB':>9} {'stream, s':>10} {'stream, MB':>11} "
+          f"{'paragraphs only, MB':>20} {'unstructured, s':>16} {'unstructured, MB':>17}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for paragraphs in (2_000, 10_000, 50_000):
+            path = os.path.join(directory, f"benchmark_{paragraphs}.docx")
+            generate_docx(path, paragraphs)
+            size = os.path.getsize(path) / 2**20
+
+            stream_time, stream_memory = measure(lambda: load_docx(path, settings.processor.text_window_size))
+            _, iter_memory = measure(lambda: sum(1 for _ in iter_docx_paragraphs(path)))
+            unstructured_time, unstructured_memory = measure(
+                lambda: UnstructuredWordDocumentLoader(file_path=path).load()
+            )
+
+            print(f"{paragraphs:>10} {size:>9.2f} {stream_time:>10.3f} {stream_memory:>11.1f} "
+                  f"{iter_memory:>20.2f} {unstructured_time:>16.3f} {unstructured_memory:>17.1f}")
+
+
+if __name__ == "__main__":
+    main()
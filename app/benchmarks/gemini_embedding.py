@@ -0,0 +1,90 @@
+"""
+Measures GeminiEmbed.encode against a local stub of the Gemini embedding api, so no real requests are made.
+The stub answers every batch after a fixed latency and throttles a part of requests with 429.
+Compares batches sent one after another with concurrent ones and checks the order of returned vectors.
+
+Run from base dir ---> python -m app.benchmarks.gemini_embedding
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from google import genai
+from google.genai import types
+from app.core.models import GeminiEmbed
+from app.settings import settings
+import random
+import json
+import time
+
+LATENCY = 0.3  # Seconds the stub spends on one batch
+THROTTLED = 0.05  # The part of requests answered with 429
+
+
+def stub_vector(text: str, dimensionality: int) -> list[float]:
+    return [float(len(text))] + [float(ord(text[-1]) if text else 0)] * (dimensionality - 1)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(LATENCY)
+
+        if random.random() < THROTTLED:  # nosec B311
+            self.answer(429, {"error": {"code": 429, "message": "Quota exceeded", "status": "RESOURCE_EXHAUSTED"}})
+            return
+
+        embeddings = [
+            {"values": stub_vector(request["content"]["parts"][0]["text"], request.get("outputDimensionality", 8))}
+            for request in body["requests"]
+        ]
+        self.answer(200, {"embeddings": embeddings})
+
+    def answer(self, code: int, data: dict):
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def measure(embedder: GeminiEmbed, texts: list[str], concurrency: int) -> float:
+    embedder.requests = settings.gemini_embedding_requests.model_copy(
+        update={"concurrency": concurrency, "backoff": 0.1}
+    )
+    embedder.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    start = time.perf_counter()
+    vectors = embedder.encode(texts)
+    elapsed = time.perf_counter() - start
+
+    dimensionality = embedder.get_vector_dimensionality()
+    assert vectors == [stub_vector(text, dimensionality) for text in texts], "Order of vectors is broken"  # nosec B101 - benchmark self-check
+    return elapsed
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    embedder = GeminiEmbed()
+    embedder.cache = None
+    embedder.client = genai.Client(
+        api_key="stub", http_options=types.HttpOptions(base_url=f"http://127.0.0.1:{server.server_port}")
+    )
+
+    texts = [f"chunk number {i} " + "x" * (i % 50) for i in range(5_000)]
+    print(f"{'texts':>6} {'concurrency':>12} {'time, s':>8} {'texts/s':>8}")
+    for concurrency in (1, 4, 8, 16):
+        elapsed = measure(embedder, texts, concurrency)
+        print(f"{len(texts):>6} {concurrency:>12} {elapsed:>8.2f} {len(texts) / elapsed:>8.0f}")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
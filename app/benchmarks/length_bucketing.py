@@ -0,0 +1,59 @@
+"""
+Measures CPU time of local Embedder.encode and Reranker.rank on a mixed corpus: mostly short chunks (csv rows,
+headings, short paragraphs) with some full-size ones. Compares batches of 32 in arrival order with
+length buckets under the token budget and checks both give the same vectors and the same ranking.
+
+Run from base dir ---> python -m app.benchmarks.length_bucketing
+"""
+
+from app.benchmarks.chunking import generate_text
+from app.core.chunks import Chunk
+from app.core.models import Embedder, Reranker
+from app.settings import settings
+import numpy as np
+import random
+import time
+
+QUERY = "How are citations of retrieval augmented generation chunks built?"
+
+
+def mixed_corpus(size: int, seed: int = 5) -> list[str]:
+    rnd = random.Random(seed)  # nosec B311 - generated benchmark data, not security
+    text = generate_text(size * settings.text_splitter.chunk_size, seed=seed)
+    corpus = []
+
+    for _ in range(size):
+        length = settings.text_splitter.chunk_size if rnd.random() < 0.15 else rnd.randint(20, 200)
+        start = rnd.randint(0, len(text) - length)
+        corpus.append(text[start : start + length])
+
+    return corpus
+
+
+def cpu_time(function) -> tuple[float, object]:
+    start = time.process_time()
+    result = function()
+    return time.process_time() - start, result
+
+
+def main():
+    embedder = Embedder(model=settings.models.embedder_model)
+    reranker = Reranker(model=settings.models.reranker_model)
+    corpus = mixed_corpus(4_000)
+    chunks = [Chunk(None, "benchmark.txt", 0, 0, 0, 0, text) for text in corpus[:300]]
+
+    arrival_time, expected = cpu_time(
+        lambda: embedder.model.encode(sentences=corpus, show_progress_bar=False, batch_size=32)
+    )
+    bucketed_time, vectors = cpu_time(lambda: embedder._encode_model(corpus))
+    assert np.allclose(expected, vectors, atol=1e-4), "Vectors differ"  # nosec B101 - benchmark self-check
+    print(f"embedder: {len(corpus)} texts, arrival order {arrival_time:.2f} s, buckets {bucketed_time:.2f} s CPU")
+
+    arrival_time, expected = cpu_time(lambda: reranker.model.rank(QUERY, corpus[:300]))
+    bucketed_time, ranks = cpu_time(lambda: reranker.rank(QUERY, chunks))
+    assert [rank["corpus_id"] for rank in ranks[:10]] == [rank["corpus_id"] for rank in expected[:10]], "Ranking differs"  # nosec B101 - benchmark self-check
+    print(f"reranker: {len(chunks)} chunks, arrival order {arrival_time:.2f} s, buckets {bucketed_time:.2f} s CPU")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Measures encoding of single queries by concurrent callers (like parallel searches) with the local Embedder.
+Compares calls of the model one by one with the micro-batcher, prints throughput and latency percentiles.
+
+Run from base dir ---> python -m app.benchmarks.micro_batching
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from app.core.micro_batcher import MicroBatcher
+from app.core.models import Embedder
+from app.settings import settings
+import numpy as np
+import time
+
+QUERIES = 2_000
+
+
+def measure(encode, callers: int) -> tuple[float, float, float]:
+    queries = [f"what does the document say about topic number {i}?" for i in range(QUERIES)]
+
+    def timed(query: str) -> float:
+        start = time.perf_counter()
+        encode([query])
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=callers) as executor:
+        latencies = list(executor.map(timed, queries))
+    elapsed = time.perf_counter() - start
+
+    return QUERIES / elapsed, float(np.percentile(latencies, 50)), float(np.percentile(latencies, 99))
+
+
+def main():
+    embedder = Embedder(model=settings.models.embedder_model)
+    batcher = MicroBatcher(embedder._encode_model)
+
+    print(f"{'callers':>8} {'mode':>8} {'queries/s':>10} {'p50, ms':>8} {'p99, ms':>8}")
+    for callers in (1, 8, 32, 64):
+        for mode, encode in (("direct", embedder._encode_model), ("batched", batcher)):
+            throughput, p50, p99 = measure(encode, callers)
+            print(f"{callers:>8} {mode:>8} {throughput:>10.0f} {p50 * 1000:>8.1f} {p99 * 1000:>8.1f}")
+
+    print(batcher.stats())
+
+
+if __name__ == "__main__":
+    main()
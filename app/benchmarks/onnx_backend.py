@@ -0,0 +1,75 @@
+"""
+Compares inference backends of local embedder and reranker: torch, onnx and onnx with int8 quantization.
+Checks the accuracy drift against torch (cosine between vectors, overlap of top results, agreement of
+reranker order) and measures latency of a single query and throughput of bulk encoding.
+
+Run from base dir ---> python -m app.benchmarks.onnx_backend
+"""
+
+from sentence_transformers import SentenceTransformer, CrossEncoder
+from app.benchmarks.length_bucketing import mixed_corpus, QUERY
+from app.core.backends import load_model
+from app.settings import settings
+import numpy as np
+import time
+
+BACKENDS = {"torch": ("torch", False), "onnx": ("onnx", False), "onnx-int8": ("onnx", True)}
+MIN_COSINE = 0.98  # Vectors of a backend must stay at least this close to torch ones
+MIN_TOP_OVERLAP = 0.8  # The part of torch top-10 search results the backend must find
+
+
+def load(model_class, model: str, backend: str, quantize: bool):
+    settings.models.backend, settings.models.quantize = backend, quantize
+    return load_model(model_class, model, settings.device)
+
+
+def top_k(vectors: np.ndarray, query: np.ndarray, k: int = 10) -> set[int]:
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return set(np.argsort(-(normalized @ (query / np.linalg.norm(query))))[:k].tolist())
+
+
+def main():
+    corpus = mixed_corpus(2_000)
+    queries = [f"what does the document say about {word}?" for word in ("retrieval", "chunk", "citation", "line")]
+    reference = {}
+
+    print(f"{'backend':>10} {'min cos':>8} {'top-10':>7} {'rerank top-5':>13} {'query, ms':>10} {'texts/s':>8} {'pairs/s':>8}")
+    for name, (backend, quantize) in BACKENDS.items():
+        embedder = load(SentenceTransformer, settings.models.embedder_model, backend, quantize)
+        reranker = load(CrossEncoder, settings.models.reranker_model, backend, quantize)
+
+        start = time.perf_counter()
+        vectors = embedder.encode(corpus, show_progress_bar=False, batch_size=32)
+        texts_per_second = len(corpus) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        query_vectors = [embedder.encode(query, show_progress_bar=False) for query in queries * 25]
+        query_latency = (time.perf_counter() - start) / len(query_vectors) * 1000
+
+        start = time.perf_counter()
+        ranks = reranker.rank(QUERY, corpus[:300])
+        pairs_per_second = 300 / (time.perf_counter() - start)
+
+        if name == "torch":
+            reference = {"vectors": vectors, "queries": query_vectors, "ranks": ranks}
+
+        cosine = np.sum(vectors * reference["vectors"], axis=1) / (
+            np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference["vectors"], axis=1)
+        )
+        overlap = np.mean([
+            len(top_k(vectors, query) & top_k(reference["vectors"], reference_query)) / 10
+            for query, reference_query in zip(query_vectors[: len(queries)], reference["queries"])
+        ])
+        rerank_agreement = len(
+            {rank["corpus_id"] for rank in ranks[:5]} & {rank["corpus_id"] for rank in reference["ranks"][:5]}
+        ) / 5
+
+        print(
+            f"{name:>10} {cosine.min():>8.4f} {overlap:>7.2f} {rerank_agreement:>13.2f} "
+            f"{query_latency:>10.2f} {texts_per_second:>8.0f} {pairs_per_second:>8.0f}"
+        )
+        assert cosine.min() >= MIN_COSINE and overlap >= MIN_TOP_OVERLAP, f"{name} drifted too far from torch"  # nosec B101 - benchmark self-check
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Measures the relevance path of DocumentProcessor.generate_chunks on a synthetic document of about 10k chunks.
+Compares the previous path (encode every chunk separately, cosine pair by pair, insertion into the top list)
+with the batched one (one encode call, one matrix product, partial sort) and checks they select the same chunks.
+
+Run from base dir ---> python -m app.benchmarks.relevance
+"""
+
+from langchain_core.documents import Document
+from app.benchmarks.chunking import generate_text
+from app.core.processor import DocumentProcessor
+from app.core.models import Embedder
+from app.settings import settings
+import numpy as np
+import time
+
+QUERY = "How are citations of retrieval augmented generation chunks built?"
+
+
+def one_by_one(processor: DocumentProcessor, chunks: list) -> list:
+    query_embedded = processor.embedder.encode(QUERY)
+    most_relevant = []
+
+    for chunk in chunks:
+        chunk_embedded = processor.embedder.encode(chunk.text)
+        similarity = processor.cosine_similarity(query_embedded, chunk_embedded)
+        processor.update_most_relevant_chunk([similarity, chunk], most_relevant)
+
+    return most_relevant
+
+
+def batched(processor: DocumentProcessor, chunks: list) -> list:
+    query_embedded = np.asarray(processor.embedder.encode(QUERY), dtype=np.float32)
+    return processor.update_most_relevant_chunks(query_embedded / np.linalg.norm(query_embedded), chunks, [])
+
+
+def main():
+    processor = DocumentProcessor(embedder=Embedder(settings.models.embedder_model))
+    size = 10_000 * settings.text_splitter.chunk_size
+    document = Document(page_content=generate_text(size), metadata={"source": "benchmark.txt"})
+
+    chunks = processor.split_document(document)
+
+    start = time.perf_counter()
+    result = batched(processor, chunks)
+    batched_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = one_by_one(processor, chunks)
+    one_by_one_time = time.perf_counter() - start
+
+    assert [chunk.text for _, chunk in result] == [chunk.text for _, chunk in expected], "Selected chunks differ"  # nosec B101 - benchmark self-check
+    assert np.allclose([score for score, _ in result], [score for score, _ in expected], atol=1e-5)  # nosec B101 - benchmark self-check
+
+    print(f"{'chunks':>8} {'one by one, s':>14} {'batched, s':>11} {'speedup':>8}")
+    print(f"{len(chunks):>8} {one_by_one_time:>14.2f} {batched_time:>11.2f} {one_by_one_time / batched_time:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+from sentence_transformers import SentenceTransformer, CrossEncoder
+from app.settings import settings, logging
+import os
+
+"""
+Loads SentenceTransformer or CrossEncoder with the inference backend chosen in settings.models:
+    torch -> full precision PyTorch model (default)
+    onnx -> the model exported to ONNX and run with ONNX Runtime, needs sentence-transformers[onnx]
+    onnx + quantize -> the ONNX model with dynamic int8 quantization of weights. It is exported once
+        to settings.models.onnx_path/<model> and loaded from there afterwards
+"""
+
+
+def load_model(model_class: type[SentenceTransformer] | type[CrossEncoder], model: str, device: str):
+    backend = settings.models.backend
+    if backend == "torch":
+        return model_class(model, device=device)
+    if backend != "onnx":
+        raise ValueError(f"Unknown inference backend {backend}")
+
+    if not settings.models.quantize:
+        return model_class(model, device=device, backend="onnx")
+
+    config = settings.models.quantization_config
+    path = os.path.join(settings.models.onnx_path, model.replace("/", "_"))
+    file_name = f"onnx/model_qint8_{config}.onnx"
+
+    if not os.path.exists(os.path.join(path, file_name)):
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+
+        logging.info("Exporting %s to int8 ONNX model at %s", model, path)
+        exported = model_class(model, device=device, backend="onnx")
+        exported.save_pretrained(path)
+        export_dynamic_quantized_onnx_model(exported, quantization_config=config, model_name_or_path=path)
+
+    return model_class(path, device=device, backend="onnx", model_kwargs={"file_name": file_name})
+
+
+"""
+Name of the backend chosen in settings.models, quantized models are told apart by the target of
+quantization. Is a part of cache keys, because vectors of different backends are not the same
+"""
+
+
+def backend_name() -> str:
+    if settings.models.backend == "onnx" and settings.models.quantize:
+        return f"onnx-qint8-{settings.models.quantization_config}"
+    return settings.models.backend
@@ -0,0 +1,28 @@
+"""
+Groups inputs of different length into batches by token budget: inputs are sorted by length, so
+neighbours in a batch need almost no padding, and a batch is closed when its padded size
+(number of inputs * the longest of them) would exceed 'token_budget'. Short inputs make large
+batches, long ones make small batches
+
+lengths -> the number of tokens of every input
+Returns lists of positions of inputs in the original order, the caller puts results back by them
+"""
+
+
+def token_budget_batches(lengths: list[int], token_budget: int, max_batch_size: int) -> list[list[int]]:
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    longest = 0
+
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        length = max(1, lengths[i])
+        if batch and ((len(batch) + 1) * max(longest, length) > token_budget or len(batch) == max_batch_size):
+            batches.append(batch)
+            batch, longest = [], 0
+
+        batch.append(i)
+        longest = max(longest, length)
+
+    if batch:
+        batches.append(batch)
+    return batches
@@ -1,3 +1,4 @@
+import hashlib
 import uuid
 
 
@@ -5,6 +6,7 @@ class Chunk:
     """
     id -> unique number in uuid format, can be tried https://www.uuidgenerator.net/
     start_index -> the index of the first char from the beginning of the original document
+    source -> name of the document as it was uploaded, stays the same for edited versions of the file
 
     TODO: implement access modifiers and set of getters and setters
     """
@@ -18,6 +20,7 @@ class Chunk:
         start_line: int,
         end_line: int,
         text: str,
+        source: str = "",
     ):
         self.id: uuid.UUID = id
         self.filename: str = filename
@@ -26,6 +29,7 @@ class Chunk:
         self.start_line: int = start_line
         self.end_line: int = end_line
         self.text: str = text
+        self.source: str = source
 
     def get_raw_text(self) -> str:
         return self.text
@@ -41,6 +45,7 @@ class Chunk:
             "start_index": self.start_index,
             "start_line": self.start_line,
             "end_line": self.end_line,
+            "source": self.source,
         }
 
     # TODO: remove kostyly
@@ -52,3 +57,30 @@ class Chunk:
             f"end - {self.end_line}, "
             f"and text - {self.text[:100]}... ({len(self.text)})\n"
         )
+
+
+"""
+Replaces random ids of chunks from one document with stable ones, derived from the source name
+and the text of chunk. Repeated texts are told apart by the number of occurrence, so the same
+document always gets the same ids and an edited one keeps ids of unchanged chunks
+
+occurrences -> counters of texts keyed by their sha256 digest (the counters of a large file would hold
+    a copy of its text otherwise), pass the same dict to number chunks of one document given in parts
+"""
+
+
+def assign_stable_ids(
+    chunks: list[Chunk], source: str, occurrences: dict[bytes, int] | None = None
+) -> list[Chunk]:
+    if occurrences is None:
+        occurrences = {}
+
+    for chunk in chunks:
+        digest = hashlib.sha256(chunk.text.encode("utf-8", errors="surrogatepass")).digest()
+        occurrence = occurrences.get(digest, 0)
+        occurrences[digest] = occurrence + 1
+
+        chunk.source = source
+        chunk.id = uuid.uuid5(uuid.NAMESPACE_URL, f"{source}\x00{occurrence}\x00{chunk.text}")
+
+    return chunks
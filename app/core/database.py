@@ -3,16 +3,33 @@ from qdrant_client.http.models import (
     ScoredPoint,
     Filter,
     FieldCondition,
-    MatchText
+    HasIdCondition,
+    MatchText,
+    MatchValue,
 )
 from qdrant_client.models import (
     VectorParams,
     Distance,
     PointStruct,
     TextIndexParams,
-    TokenizerType
+    TokenizerType,
+    PayloadSchemaType,
+    PointIdsList,
+    QueryRequest,
+    SetPayload,
+    SetPayloadOperation,
+    SparseVectorParams,
+    Modifier,
+    Prefetch,
+    FusionQuery,
+    Fusion,
 )  # VectorParams -> config of vectors that will be used as primary keys
 from app.core.models import Embedder  # Distance -> defines the metric
+from app.core.embedding_pool import EmbeddingPool
+from app.core.dedupe_index import NearDuplicateIndex
+from app.core.sparse import sparse_document_vector, sparse_query_vector
+from collections import OrderedDict
+from threading import Lock
 from app.core.chunks import Chunk  # PointStruct -> instance that will be stored in db
 import numpy as np
 from uuid import UUID
@@ -27,38 +44,351 @@ class VectorDatabase:
         self.host: str = host
         self.client: QdrantClient = self._initialize_qdrant_client()
         self.embedder: Embedder = embedder  # embedder is used to convert a user's query
-        self.already_stored: np.array[np.array] = np.array([]).reshape(
-            0, embedder.get_vector_dimensionality()
+        self.dedupe_indexes: OrderedDict[str, NearDuplicateIndex | None] = OrderedDict()
+        self._dedupe_lock = Lock()  # guards the dicts only, indexes are built under the lock of their collection
+        self._dedupe_locks: dict[str, Lock] = {}
+        self._dedupe_checked: dict[str, int] = {}  # collection -> vectors checked with db queries, while it has no index
+        self.sparse_collections: dict[str, bool] = {}  # collection -> has sparse vectors (created before hybrid search)
+        self.embedding_pool: EmbeddingPool | None = (
+            EmbeddingPool(embedder.model_name)
+            if settings.embedding_pool.enabled and isinstance(embedder, Embedder) and settings.device == "cpu"
+            else None
         )
 
     def store(
         self, collection_name: str, chunks: list[Chunk], batch_size: int = 1000
-    ) -> None:
-        points: list[PointStruct] = []
+    ) -> int:
+        vectors = self.encode_bulk([chunk.get_raw_text() for chunk in chunks])
+        return self.store_vectors(collection_name, chunks, vectors, batch_size)
+
+    """
+    Encodes many texts at once. From 'embedding_pool.min_chunks' texts on, the pool of worker processes
+    is used (local embedder on cpu only), vectors of cached texts are still taken from the embedding cache
+    """
+
+    def encode_bulk(self, texts: list[str]):
+        if self.embedding_pool is None or len(texts) < settings.embedding_pool.min_chunks:
+            return self.embedder.encode(texts)
+
+        if self.embedder.cache is None:
+            return self.embedding_pool.encode(texts)
+        return self.embedder.cache.get_or_compute(self.embedder.cache_key, texts, self.embedding_pool.encode)
+
+    """
+    Saves already embedded chunks, returns the number of points sent to the db
+
+    exclude -> ids of points the chunks are not checked against for near-duplicates (the old version of
+        a re-uploaded source, an edited chunk would be rejected as a duplicate of the text it replaces)
+    """
+
+    def store_vectors(
+        self,
+        collection_name: str,
+        chunks: list[Chunk],
+        vectors: list,
+        batch_size: int = 1000,
+        exclude: set[str] | None = None,
+    ) -> int:
+        stored = 0
+        accepted: np.ndarray | None = None  # normalized vectors accepted in previous groups
+        sparse = self.has_sparse_vectors(collection_name)
+
+        for group in range(0, len(chunks), batch_size):
+            group_chunks = chunks[group : group + batch_size]
+            group_vectors = np.asarray(vectors[group : group + batch_size], dtype=np.float32)
+
+            keep = self.filter_duplicates(
+                collection_name,
+                group_vectors,
+                accepted,
+                texts=[chunk.get_raw_text() for chunk in group_chunks],
+                exclude=exclude,
+            )
+            if not keep:
+                continue
 
-        vectors = self.embedder.encode([chunk.get_raw_text() for chunk in chunks])
+            normalized = self.normalize(group_vectors[keep])
+            accepted = normalized if accepted is None else np.concatenate([accepted, normalized])
 
-        for vector, chunk in zip(vectors, chunks):
-            if self.accept_vector(collection_name, vector):
-                points.append(
+            self.client.upsert(
+                collection_name=collection_name,
+                points=[
                     PointStruct(
-                        id=str(chunk.id),
-                        vector=vector,
+                        id=str(group_chunks[i].id),
+                        vector=(
+                            {
+                                "": group_vectors[i].tolist(),
+                                settings.hybrid_search.sparse_vector_name: sparse_document_vector(
+                                    group_chunks[i].get_raw_text()
+                                ),
+                            }
+                            if sparse
+                            else group_vectors[i].tolist()
+                        ),
                         payload={
-                            "metadata": chunk.get_metadata(),
-                            "text": chunk.get_raw_text(),
+                            "metadata": group_chunks[i].get_metadata(),
+                            "text": group_chunks[i].get_raw_text(),
                         },
                     )
+                    for i in keep
+                ],
+                wait=False,
+            )
+            stored += len(keep)
+            self._add_to_dedupe_index(
+                collection_name, [group_chunks[i] for i in keep], normalized
+            )
+
+        return stored
+
+    """
+    Returns True if points of the collection have sparse vectors for hybrid search. Collections
+    created before it have only dense ones, they are searched the old way
+    """
+
+    def has_sparse_vectors(self, collection_name: str) -> bool:
+        if collection_name not in self.sparse_collections:
+            sparse_vectors = self.client.get_collection(collection_name).config.params.sparse_vectors or {}
+            self.sparse_collections[collection_name] = settings.hybrid_search.sparse_vector_name in sparse_vectors
+        return self.sparse_collections[collection_name]
+
+    """
+    Returns the dense vector of a point, points of collections with sparse vectors carry all their
+    vectors by name, the dense one is unnamed
+    """
+
+    @staticmethod
+    def dense_vector(vector) -> list[float]:
+        return vector[""] if isinstance(vector, dict) else vector
+
+    @staticmethod
+    def normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    """
+    Returns positions of vectors that should be stored. The same rule as accept_vector (a vector is
+    rejected if 1 - cosine with the most similar one is below max_delta), but for the whole batch:
+    the collection is checked with the in-process near-duplicate index (or with one batched query,
+    if there is no index), vectors of the batch are compared with each other (and with 'accepted'
+    ones of the same upload) with one matrix product, an earlier accepted vector rejects later duplicates
+
+    texts -> texts of vectors, are used by the text signatures of the index
+    exclude -> ids of points of the collection that are not taken into account
+    """
+
+    def filter_duplicates(
+        self,
+        collection_name: str,
+        vectors: np.ndarray,
+        accepted: np.ndarray | None = None,
+        texts: list[str] | None = None,
+        exclude: set[str] | None = None,
+    ) -> list[int]:
+        normalized = self.normalize(vectors)
+
+        index = self.get_dedupe_index(collection_name, checked=len(vectors))
+        if index is not None:
+            in_collection = index.find_duplicates(normalized, texts, exclude)
+        else:
+            query_filter = Filter(must_not=[HasIdCondition(has_id=list(exclude))]) if exclude else None
+            responses = self.client.query_batch_points(
+                collection_name=collection_name,
+                requests=[
+                    QueryRequest(query=vector.tolist(), filter=query_filter, limit=1, with_payload=False)
+                    for vector in vectors
+                ],
+            )
+            in_collection = [
+                bool(response.points) and 1 - response.points[0].score < settings.max_delta
+                for response in responses
+            ]
+
+        similar = 1 - normalized @ normalized.T < settings.max_delta
+        if accepted is not None and len(accepted):
+            similar_to_accepted = (1 - normalized @ accepted.T < settings.max_delta).any(axis=1)
+        else:
+            similar_to_accepted = np.zeros(len(vectors), dtype=bool)
+
+        keep: list[int] = []
+        for i in range(len(vectors)):
+            if in_collection[i] or similar_to_accepted[i] or similar[i, keep].any():
+                continue
+            keep.append(i)
+
+        return keep
+
+    """
+    Returns the near-duplicate index of the collection. Building it scrolls the whole collection, so
+    it is built (e.g. after restart or eviction) only when the vectors checked with db queries since
+    then reach 'dedupe_index.build_ratio' of the points of the collection - a small upload to a large
+    collection is checked with db queries. Returns None if indexes are turned off, the index is not
+    worth building yet or the collection has more points than an index may hold. At most
+    'dedupe_index.max_collections' indexes are kept, the least recently used are dropped
+
+    checked -> the number of vectors about to be checked
+
+    NOTE: the index sees only points stored by this process and ones that were in the collection
+    when it was built, points stored by other workers in the meantime are not checked
+    """
+
+    def get_dedupe_index(self, collection_name: str, checked: int = 0) -> NearDuplicateIndex | None:
+        if not settings.dedupe_index.enabled:
+            return None
+
+        with self._dedupe_lock:
+            if collection_name in self.dedupe_indexes:
+                self.dedupe_indexes.move_to_end(collection_name)
+                return self.dedupe_indexes[collection_name]
+            collection_lock = self._dedupe_locks.setdefault(collection_name, Lock())
+
+        with collection_lock:  # uploads to other collections do not wait for the build
+            with self._dedupe_lock:
+                if collection_name in self.dedupe_indexes:  # built while this call was waiting
+                    return self.dedupe_indexes[collection_name]
+
+            checked += self._dedupe_checked.get(collection_name, 0)
+            count = self.client.count(collection_name=collection_name, exact=False).count
+            if count <= settings.dedupe_index.max_points and checked < count * settings.dedupe_index.build_ratio:
+                self._dedupe_checked[collection_name] = checked
+                return None
+
+            index = self._build_dedupe_index(collection_name)
+            with self._dedupe_lock:
+                self._dedupe_checked.pop(collection_name, None)
+                self.dedupe_indexes[collection_name] = index
+                while len(self.dedupe_indexes) > settings.dedupe_index.max_collections:
+                    self.dedupe_indexes.popitem(last=False)
+            return index
+
+    def _build_dedupe_index(self, collection_name: str, batch_size: int = 1000) -> NearDuplicateIndex | None:
+        index = NearDuplicateIndex(self.embedder.get_vector_dimensionality())
+        if self.client.count(collection_name=collection_name, exact=True).count > index.max_points:
+            return None
+
+        offset = None
+        while True:
+            records, offset = self.client.scroll(
+                collection_name=collection_name,
+                limit=batch_size,
+                offset=offset,
+                with_payload=["text"],
+                with_vectors=True,
+            )
+            if records:
+                added = index.add(
+                    [str(record.id) for record in records],
+                    self.normalize(
+                        np.asarray([self.dense_vector(record.vector) for record in records], dtype=np.float32)
+                    ),
+                    [record.payload.get("text", "") for record in records],
                 )
+                if not added:
+                    return None
+
+            if offset is None:
+                return index
+
+    def _add_to_dedupe_index(self, collection_name: str, chunks: list[Chunk], normalized: np.ndarray) -> None:
+        if not settings.dedupe_index.enabled:
+            return
+
+        with self._dedupe_lock:
+            index = self.dedupe_indexes.get(collection_name)  # only an existing one, it is built on a check
+        if index is None:
+            return
+
+        if not index.add([str(chunk.id) for chunk in chunks], normalized, [chunk.get_raw_text() for chunk in chunks]):
+            with self._dedupe_lock:
+                self.dedupe_indexes[collection_name] = None  # too large, dedupe goes to the db from now on
+
+    """
+    Returns ids and metadata of all points that were produced from the given source
+    """
+
+    def get_source_points(
+        self, collection_name: str, source: str, batch_size: int = 1000
+    ) -> dict[str, dict]:
+        points: dict[str, dict] = {}
+        offset = None
+
+        while True:
+            records, offset = self.client.scroll(
+                collection_name=collection_name,
+                scroll_filter=Filter(
+                    must=[FieldCondition(key="metadata.source", match=MatchValue(value=source))]
+                ),
+                limit=batch_size,
+                offset=offset,
+                with_payload=["metadata"],
+                with_vectors=False,
+            )
+
+            for record in records:
+                points[str(record.id)] = record.payload.get("metadata", {})
+
+            if offset is None:
+                return points
+
+    """
+    Compares a part of the new version of a source with the points stored for it. Returns the chunks
+    that are not stored yet (only they need to be embedded and saved) and metadata updates (lines,
+    pages, path) of unchanged chunks that moved. Ids of matched chunks are removed from 'existing',
+    so after the last part of the source it holds the stale points - the ones whose chunks are gone
+
+    chunks -> chunks of the new version with stable ids (see assign_stable_ids)
+    existing -> result of get_source_points, changed in place
+    """
+
+    @staticmethod
+    def diff_source(
+        chunks: list[Chunk], existing: dict[str, dict]
+    ) -> tuple[list[Chunk], list[SetPayloadOperation]]:
+        fresh: list[Chunk] = []
+        moved: list[SetPayloadOperation] = []
+
+        for chunk in chunks:
+            stored_metadata = existing.pop(str(chunk.id), None)
+            if stored_metadata is None:
+                fresh.append(chunk)
+                continue
 
-        if len(points):
-            for group in range(0, len(points), batch_size):
-                self.client.upsert(
-                    collection_name=collection_name,
-                    points=points[group : group + batch_size],
-                    wait=False,
+            metadata = chunk.get_metadata()
+            if any(stored_metadata.get(key) != value for key, value in metadata.items() if key != "id"):
+                moved.append(
+                    SetPayloadOperation(
+                        set_payload=SetPayload(payload={"metadata": metadata}, points=[str(chunk.id)])
+                    )
                 )
 
+        return fresh, moved
+
+    def update_payloads(
+        self, collection_name: str, operations: list[SetPayloadOperation], batch_size: int = 1000
+    ) -> None:
+        for group in range(0, len(operations), batch_size):
+            self.client.batch_update_points(
+                collection_name=collection_name,
+                update_operations=operations[group : group + batch_size],
+                wait=False,
+            )
+
+    """
+    Deletes points by ids, they are also forgotten by the near-duplicate index of the collection
+    """
+
+    def delete_points(self, collection_name: str, ids: list[str], batch_size: int = 1000) -> None:
+        for group in range(0, len(ids), batch_size):
+            self.client.delete(
+                collection_name=collection_name,
+                points_selector=PointIdsList(points=ids[group : group + batch_size]),
+                wait=True,
+            )
+
+        index = self.dedupe_indexes.get(collection_name)
+        if index is not None and ids:
+            index.remove(ids)
+
     """
     Measures a cosine of angle between tow vectors
     """
@@ -83,7 +413,7 @@ class VectorDatabase:
         else:
             most_similar = most_similar[0]
 
-        if 1 - self.cosine_similarity(vector, most_similar.vector) < settings.max_delta:
+        if 1 - self.cosine_similarity(vector, self.dense_vector(most_similar.vector)) < settings.max_delta:
             return False
         return True
 
@@ -103,7 +433,10 @@ class VectorDatabase:
     """
     According to tests, re-ranker needs ~7-10 chunks to generate the most accurate hit
 
-    TODO: implement hybrid search
+    Hybrid search: dense and sparse (bm25) sub-queries are prefetched and fused with reciprocal
+    rank fusion by qdrant in one query, so chunks found by both are ranked higher and every point
+    is returned once. Collections without sparse vectors are searched with dense and keyword-filtered
+    queries sent in one batched request
     """
 
     def search(self, collection_name: str, query: str, top_k: int = 5) -> list[Chunk]:
@@ -111,21 +444,14 @@ class VectorDatabase:
 
         if isinstance(query_embedded, list):
             query_embedded = query_embedded[0]
+        query_embedded = np.asarray(query_embedded, dtype=np.float32).tolist()
 
-        keywords = self.construct_keywords_list(query)
-
-        dense_result: list[ScoredPoint] = self.client.query_points(
-            collection_name=collection_name, query=query_embedded, limit=int(top_k * 0.7)
-        ).points
-
-        sparse_result: list[ScoredPoint] = self.client.query_points(
-            collection_name=collection_name, query=query_embedded, limit=int(top_k * 0.3),
-            query_filter=Filter(should=keywords)
-        ).points
-
-        combined = [*dense_result, *sparse_result]
+        if self.has_sparse_vectors(collection_name):
+            points = self._hybrid_search(collection_name, query, query_embedded, top_k)
+        else:
+            points = self._dense_search(collection_name, query, query_embedded, top_k)
 
-        print(len(combined))
+        print(len(points))
 
         return [
             Chunk(
@@ -136,10 +462,53 @@ class VectorDatabase:
                 start_line=point.payload.get("metadata", {}).get("start_line", 0),
                 end_line=point.payload.get("metadata", {}).get("end_line", 0),
                 text=point.payload.get("text", ""),
+                source=point.payload.get("metadata", {}).get("source", ""),
             )
-            for point in combined
+            for point in points
         ]
 
+    def _hybrid_search(
+        self, collection_name: str, query: str, query_embedded: list[float], top_k: int
+    ) -> list[ScoredPoint]:
+        config = settings.hybrid_search
+        prefetch = [Prefetch(query=query_embedded, limit=top_k * config.prefetch_multiplier)]
+
+        query_sparse = sparse_query_vector(query)
+        if query_sparse.indices:
+            prefetch.append(
+                Prefetch(query=query_sparse, using=config.sparse_vector_name, limit=top_k * config.prefetch_multiplier)
+            )
+
+        return self.client.query_points(
+            collection_name=collection_name,
+            prefetch=prefetch,
+            query=FusionQuery(fusion=Fusion.RRF),
+            limit=top_k,
+            with_payload=True,
+        ).points
+
+    def _dense_search(
+        self, collection_name: str, query: str, query_embedded: list[float], top_k: int
+    ) -> list[ScoredPoint]:
+        keywords = self.construct_keywords_list(query)
+
+        requests = [QueryRequest(query=query_embedded, limit=int(top_k * 0.7), with_payload=True)]
+        if keywords:
+            requests.append(
+                QueryRequest(
+                    query=query_embedded, limit=int(top_k * 0.3), filter=Filter(should=keywords), with_payload=True
+                )
+            )
+
+        responses = self.client.query_batch_points(collection_name=collection_name, requests=requests)
+
+        combined: dict[str, ScoredPoint] = {}
+        for response in responses:
+            for point in response.points:
+                combined.setdefault(str(point.id), point)
+
+        return list(combined.values())
+
     def _initialize_qdrant_client(self, max_retries=5, delay=2) -> QdrantClient:
         for attempt in range(max_retries):
             try:
@@ -179,7 +548,13 @@ class VectorDatabase:
                     size=self.embedder.get_vector_dimensionality(),
                     distance=Distance.COSINE,
                 ),
+                sparse_vectors_config=(
+                    {settings.hybrid_search.sparse_vector_name: SparseVectorParams(modifier=Modifier.IDF)}
+                    if settings.hybrid_search.enabled
+                    else None
+                ),
             )
+            self.sparse_collections[collection_name] = settings.hybrid_search.enabled
             self.client.create_payload_index(
                 collection_name=collection_name,
                 field_name="text",
@@ -191,6 +566,11 @@ class VectorDatabase:
                     lowercase=True
                 )
             )
+            self.client.create_payload_index(
+                collection_name=collection_name,
+                field_name="metadata.source",
+                field_schema=PayloadSchemaType.KEYWORD,
+            )
         except Exception as e:
             raise HTTPException(
                 500, f"Failed to create collection {self.collection_name}: {str(e)}"
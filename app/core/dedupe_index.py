@@ -0,0 +1,158 @@
+from threading import Lock
+from app.settings import settings
+import numpy as np
+import hashlib
+import re
+
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+class NearDuplicateIndex:
+    """
+    In-process index of points of one collection for near-duplicate checks without requests to the db.
+
+    Candidates are found with locality sensitive hashing, every signature is split into bands and
+    points sharing at least one band with the query are candidates:
+        MinHash of word 3-grams of the text -> finds chunks with (almost) the same text
+        random projections (SimHash) of the vector -> finds chunks with close vectors, can be turned off
+    Candidates are verified with the exact cosine, so the rule is the same as in accept_vector:
+    a vector is a duplicate if 1 - cosine with some stored one is below max_delta. Like any LSH, the
+    index may rarely miss a duplicate that shares no band with the query, it is stored then
+
+    Holds at most 'max_points' points (normalized float32 vectors and their band keys), add returns
+    False when the limit is exceeded, then the index should not be used for the collection anymore
+    """
+
+    def __init__(self, dimensionality: int, max_points: int | None = None):
+        config = settings.dedupe_index
+        self.dimensionality: int = dimensionality
+        self.max_points: int = max_points or config.max_points
+        self.vector_signatures: bool = config.vector_signatures
+
+        rnd = np.random.default_rng(config.seed)  # the same seed gives the same signatures after restart
+        self._planes = rnd.standard_normal((config.vector_bands * config.vector_band_bits, dimensionality)).astype(
+            np.float32
+        )
+        self._vector_bands: int = config.vector_bands
+        self._minhash_a = rnd.integers(1, _MERSENNE_PRIME, size=config.minhash_bands * config.minhash_band_rows, dtype=np.uint64)
+        self._minhash_b = rnd.integers(0, _MERSENNE_PRIME, size=config.minhash_bands * config.minhash_band_rows, dtype=np.uint64)
+        self._minhash_bands: int = config.minhash_bands
+
+        self._vectors = np.empty((0, dimensionality), dtype=np.float32)
+        self._ids: list[str | None] = []
+        self._keys: list[list[tuple[int, bytes]]] = []
+        self._slots: dict[str, int] = {}
+        self._free: list[int] = []
+        self._buckets: dict[tuple[int, bytes], set[int]] = {}
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    """
+    Returns True for every vector that has a near duplicate in the index
+
+    vectors -> normalized vectors
+    texts -> texts of the vectors, None if only vector signatures should be used
+    exclude -> ids of points that are not taken into account
+    """
+
+    def find_duplicates(
+        self, vectors: np.ndarray, texts: list[str] | None = None, exclude: set[str] | None = None
+    ) -> np.ndarray:
+        keys = self._signatures(vectors, texts)
+        duplicates = np.zeros(len(vectors), dtype=bool)
+
+        with self._lock:
+            for i, point_keys in enumerate(keys):
+                candidates: set[int] = set()
+                for key in point_keys:
+                    candidates.update(self._buckets.get(key, ()))
+                if exclude:
+                    candidates = {slot for slot in candidates if self._ids[slot] not in exclude}
+                if candidates:
+                    similarities = self._vectors[list(candidates)] @ vectors[i]
+                    duplicates[i] = 1 - similarities.max() < settings.max_delta
+
+        return duplicates
+
+    def add(self, ids: list[str], vectors: np.ndarray, texts: list[str] | None = None) -> bool:
+        keys = self._signatures(vectors, texts)
+
+        with self._lock:
+            for point_id, vector, point_keys in zip(ids, vectors, keys):
+                if point_id in self._slots:
+                    self._remove(point_id)
+                if len(self._slots) >= self.max_points:
+                    return False
+
+                slot = self._free.pop() if self._free else self._new_slot()
+                self._vectors[slot] = vector
+                self._ids[slot] = point_id
+                self._keys[slot] = point_keys
+                self._slots[point_id] = slot
+                for key in point_keys:
+                    self._buckets.setdefault(key, set()).add(slot)
+
+        return True
+
+    def remove(self, ids: list[str]) -> None:
+        with self._lock:
+            for point_id in ids:
+                if point_id in self._slots:
+                    self._remove(point_id)
+
+    def _remove(self, point_id: str) -> None:
+        slot = self._slots.pop(point_id)
+        for key in self._keys[slot]:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(slot)
+                if not bucket:
+                    del self._buckets[key]
+        self._ids[slot] = None
+        self._keys[slot] = []
+        self._free.append(slot)
+
+    def _new_slot(self) -> int:
+        slot = len(self._ids)
+        if slot == len(self._vectors):
+            grown = np.zeros((min(max(16, 2 * slot), self.max_points), self.dimensionality), dtype=np.float32)
+            grown[:slot] = self._vectors
+            self._vectors = grown
+        self._ids.append(None)
+        self._keys.append([])
+        return slot
+
+    def _signatures(self, vectors: np.ndarray, texts: list[str] | None) -> list[list[tuple[int, bytes]]]:
+        keys: list[list[tuple[int, bytes]]] = [[] for _ in range(len(vectors))]
+
+        if self.vector_signatures and len(vectors):
+            bits = np.packbits(((vectors @ self._planes.T) > 0).reshape(len(vectors), self._vector_bands, -1), axis=2)
+            for i, bands in enumerate(bits):
+                keys[i].extend((band, value.tobytes()) for band, value in enumerate(bands))
+
+        if texts is not None:
+            for i, text in enumerate(texts):
+                signature = self._minhash(text)
+                if signature is not None:
+                    keys[i].extend(
+                        (self._vector_bands + band, value.tobytes())
+                        for band, value in enumerate(signature.reshape(self._minhash_bands, -1))
+                    )
+
+        return keys
+
+    def _minhash(self, text: str) -> np.ndarray | None:
+        words = re.findall(r"\w+", text.lower())
+        shingles = {" ".join(words[i : i + 3]) for i in range(max(1, len(words) - 2))} if words else set()
+        if not shingles:
+            return None
+
+        hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little") for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        # a * x + b < 2^63 for x < 2^32 and a, b < 2^31, so uint64 does not overflow
+        return ((np.outer(self._minhash_a, hashes) + self._minhash_b[:, None]) % _MERSENNE_PRIME).min(axis=1)
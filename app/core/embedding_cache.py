@@ -0,0 +1,128 @@
+from app.settings import settings
+from threading import Lock
+from typing import Callable
+import numpy as np
+import hashlib
+import sqlite3
+import time
+import os
+
+
+class EmbeddingCache:
+    """
+    Disk-backed cache of embeddings, so the same text (re-uploaded file, shared boilerplate page,
+    repeated question) is encoded by the model only once. Vectors are kept in sqlite as float32 bytes
+    under the key (model key, sha256 of text), model key includes the name of the model and the
+    dimensionality of its vectors
+
+    Holds at most 'max_entries' vectors, the least recently used ones are evicted first
+
+    hits, misses -> the number of texts found in the cache and encoded by the model
+    """
+
+    def __init__(self, path: str | None = None, max_entries: int | None = None):
+        self.path: str = str(path or settings.embedding_cache.path)
+        self.max_entries: int = max_entries or settings.embedding_cache.max_entries
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock = Lock()  # one connection is shared by threads of pipeline and requests
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, hash BLOB NOT NULL, vector BLOB NOT NULL, used REAL NOT NULL, "
+            "PRIMARY KEY (model, hash))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self._connection.commit()
+
+    @staticmethod
+    def model_key(model_name: str, dimensionality: int | None, backend: str | None = None) -> str:
+        return f"{model_name}-{dimensionality}" + (f"-{backend}" if backend else "")
+
+    @staticmethod
+    def text_hash(text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).digest()
+
+    """
+    Returns float32 vectors of texts (in the same order), only texts missing in the cache are passed
+    to 'compute' (in one call, duplicates once) and saved
+    """
+
+    def get_or_compute(
+        self, model_key: str, texts: list[str], compute: Callable[[list[str]], object]
+    ) -> np.ndarray:
+        hashes = [self.text_hash(text) for text in texts]
+        found = self._get(model_key, hashes)
+
+        missing: dict[bytes, str] = {}
+        for key, text in zip(hashes, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            vectors = np.asarray(compute(list(missing.values())), dtype=np.float32)
+            computed = dict(zip(missing.keys(), vectors))
+            self._put(model_key, computed)
+            found.update(computed)
+
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([found[key] for key in hashes])
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def _get(self, model_key: str, hashes: list[bytes]) -> dict[bytes, np.ndarray]:
+        found: dict[bytes, np.ndarray] = {}
+        unique = list(set(hashes))
+        step = 500  # sqlite limits the number of parameters of one query
+
+        with self._lock:
+            for i in range(0, len(unique), step):
+                part = unique[i : i + step]
+                placeholders = ",".join("?" * len(part))  # only "?" are formatted in, values are bound
+                rows = self._connection.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({placeholders})",  # nosec B608
+                    (model_key, *part),
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+
+            if found:
+                now = time.time()
+                self._connection.executemany(
+                    "UPDATE embeddings SET used = ? WHERE model = ? AND hash = ?",
+                    [(now, model_key, key) for key in found],
+                )
+                self._connection.commit()
+
+        return found
+
+    def _put(self, model_key: str, vectors: dict[bytes, np.ndarray]) -> None:
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector, used) VALUES (?, ?, ?, ?)",
+                [(model_key, key, vector.tobytes(), now) for key, vector in vectors.items()],
+            )
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self) -> None:
+        count = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,92 @@
+from concurrent.futures import ProcessPoolExecutor
+from sentence_transformers import SentenceTransformer
+from app.core.backends import load_model
+from app.core.models import encode_by_buckets
+from app.settings import settings, logging
+from threading import Lock
+import multiprocessing
+import numpy as np
+import torch
+import os
+
+_worker_model: SentenceTransformer | None = None
+
+
+"""
+Runs once in every worker process: pins it to its cores and loads its own replica of the model
+"""
+
+
+def _init_worker(model: str, cores: list[int]) -> None:
+    global _worker_model
+
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    _worker_model = load_model(SentenceTransformer, model, "cpu")
+
+
+def _encode_shard(texts: list[str]) -> np.ndarray:
+    return np.asarray(encode_by_buckets(_worker_model, texts), dtype=np.float32)
+
+
+"""
+Returns the cores this process may run on
+"""
+
+
+def available_cores() -> list[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class EmbeddingPool:
+    """
+    Pool of worker processes for bulk encoding on many-core cpu machines. Every worker has its own
+    replica of the model and is pinned to its own group of 'cores_per_worker' cores, so workers do
+    not fight for the same cores. Texts are sharded across workers, vectors are merged in order
+
+    Workers are started on the first call, loading several replicas of the model takes time
+    """
+
+    def __init__(self, model: str, workers: int | None = None, cores_per_worker: int | None = None):
+        self.model: str = model
+        cores = available_cores()
+        cores_per_worker = max(1, cores_per_worker or settings.embedding_pool.cores_per_worker)
+        workers = workers or settings.embedding_pool.workers or max(1, len(cores) // cores_per_worker)
+
+        self.core_groups: list[list[int]] = [
+            cores[i * cores_per_worker : (i + 1) * cores_per_worker] or cores for i in range(workers)
+        ]
+        self._executors: list[ProcessPoolExecutor] = []
+        self._lock = Lock()
+
+    def _start(self) -> list[ProcessPoolExecutor]:
+        with self._lock:
+            if not self._executors:
+                logging.info("Starting %s embedding workers on cores %s", len(self.core_groups), self.core_groups)
+                context = multiprocessing.get_context("spawn")  # torch does not survive fork
+                self._executors = [
+                    ProcessPoolExecutor(
+                        max_workers=1, mp_context=context, initializer=_init_worker, initargs=(self.model, cores)
+                    )
+                    for cores in self.core_groups
+                ]
+            return self._executors
+
+    def encode(self, texts: list[str], shard_size: int | None = None) -> np.ndarray:
+        executors = self._start()
+        shard_size = shard_size or settings.embedding_pool.shard_size
+
+        futures = [
+            executors[number % len(executors)].submit(_encode_shard, texts[start : start + shard_size])
+            for number, start in enumerate(range(0, len(texts), shard_size))
+        ]
+        return np.concatenate([future.result() for future in futures])
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for executor in self._executors:
+                executor.shutdown(wait=False, cancel_futures=True)
+            self._executors = []
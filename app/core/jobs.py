@@ -0,0 +1,136 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict
+from enum import Enum
+from threading import Lock
+from typing import Callable
+from uuid import uuid4
+from app.core.pipeline import IngestionPipeline
+from app.settings import logging, settings
+import asyncio
+import time
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class IngestionJob:
+    """
+    A single background upload of several files into one collection
+
+    id -> unique hex, is returned to the client right after the upload
+    owner_id -> id of the user who started the job, only they can see its progress
+    pipeline -> the pipeline that does the work, progress counters are read from its stats
+    sources -> maps paths of documents to the names of uploaded files
+    future -> resolved when the job is finished (successfully or not), set by JobManager.submit
+    """
+
+    def __init__(
+        self,
+        collection_name: str,
+        documents: list[str],
+        pipeline: IngestionPipeline,
+        owner_id: int | None = None,
+        sources: dict[str, str] | None = None,
+    ):
+        self.id: str = uuid4().hex
+        self.collection_name: str = collection_name
+        self.documents: list[str] = documents
+        self.sources: dict[str, str] = sources or {}
+        self.pipeline: IngestionPipeline = pipeline
+        self.owner_id: int | None = owner_id
+        self.status: JobStatus = JobStatus.QUEUED
+        self.error: str | None = None
+        self.created_at: float = time.time()
+        self.finished_at: float | None = None
+        self.future: Future | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JobStatus.DONE, JobStatus.FAILED)
+
+    """
+    Waits for the job without blocking the event loop
+    """
+
+    async def wait(self) -> None:
+        if self.future is not None:
+            await asyncio.wrap_future(self.future)
+
+    def get_progress(self) -> dict:
+        stats = self.pipeline.stats
+        return {
+            "job_id": self.id,
+            "status": self.status.value,
+            "files_total": len(self.documents),
+            "files_parsed": self.pipeline.files_loaded,
+            "chunks_embedded": stats["embedder"].items,
+            "points_upserted": stats["upserter"].items,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """
+    Runs ingestion jobs in a small pool of threads, so the event loop is never blocked by
+    parsing or embedding. Keeps at most 'max_kept_jobs' jobs, the oldest finished ones are
+    forgotten first
+
+    run_job -> callable doing the actual ingestion (RagSystem.upload_documents)
+    """
+
+    def __init__(
+        self,
+        run_job: Callable[..., object],
+        workers: int | None = None,
+        max_kept_jobs: int | None = None,
+    ):
+        self.run_job = run_job
+        self.max_kept_jobs: int = max_kept_jobs or settings.ingestion.max_kept_jobs
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers or settings.ingestion.job_workers,
+            thread_name_prefix="ingestion",
+        )
+        self.jobs: OrderedDict[str, IngestionJob] = OrderedDict()
+        self._lock = Lock()
+
+    def submit(self, job: IngestionJob) -> IngestionJob:
+        with self._lock:
+            self.jobs[job.id] = job
+            self._forget_finished()
+
+        job.future = self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> IngestionJob | None:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def _run(self, job: IngestionJob) -> None:
+        job.status = JobStatus.RUNNING
+        try:
+            self.run_job(
+                collection_name=job.collection_name,
+                documents=job.documents,
+                sources=job.sources,
+                pipeline=job.pipeline,
+            )
+            job.status = JobStatus.DONE
+        except Exception as e:
+            logging.error("Error at ingestion job %s", job.id, exc_info=e)
+            job.error = str(e)
+            job.status = JobStatus.FAILED
+        finally:
+            job.finished_at = time.time()
+
+    def _forget_finished(self) -> None:
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished]:
+            if len(self.jobs) <= self.max_kept_jobs:
+                break
+            del self.jobs[job_id]
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
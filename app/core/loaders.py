@@ -0,0 +1,258 @@
+from langchain_core.documents import Document
+from pypdf import PdfReader
+from typing import Iterator
+from uuid import uuid4
+from app.core.chunks import Chunk
+from defusedxml import ElementTree
+import zipfile
+import mmap
+import csv
+import os
+
+_WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+"""
+Returns the number of pages in pdf file without extracting any text
+"""
+
+
+def count_pdf_pages(filepath: str) -> int:
+    return len(PdfReader(filepath).pages)
+
+
+"""
+Lazily extracts text of pdf pages in range [start, end), one Document per page.
+Metadata is the same as PyPDFLoader produces: source and 0-based page number
+
+start -> the first page
+end -> the page after the last one, all remaining pages by default
+"""
+
+
+def iter_pdf_pages(filepath: str, start: int = 0, end: int | None = None) -> Iterator[Document]:
+    reader = PdfReader(filepath)
+    total_pages = len(reader.pages)
+    end = total_pages if end is None else min(end, total_pages)
+
+    for page_number in range(start, end):
+        yield Document(
+            page_content=reader.pages[page_number].extract_text(),
+            metadata={
+                "source": filepath,
+                "page": page_number,
+                "total_pages": total_pages,
+            },
+        )
+
+
+"""
+Same as iter_pdf_pages, but returns the list. Defined on the module level so a range of pages can
+be extracted in a worker process
+"""
+
+
+def extract_pdf_pages(filepath: str, start: int = 0, end: int | None = None) -> list[Document]:
+    return list(iter_pdf_pages(filepath, start, end))
+
+
+"""
+Splits the pages of pdf into ranges of 'pages_per_task' pages
+"""
+
+
+def pdf_page_ranges(filepath: str, pages_per_task: int) -> list[tuple[int, int]]:
+    total_pages = count_pdf_pages(filepath)
+    return [
+        (start, min(start + pages_per_task, total_pages))
+        for start in range(0, total_pages, max(1, pages_per_task))
+    ]
+
+
+"""
+Streams the text of docx paragraphs straight out of word/document.xml. The xml is parsed
+incrementally and processed elements are dropped, so memory does not depend on the size of the file.
+defusedxml refuses entity declarations, so a crafted upload can not expand into gigabytes of text
+
+Every paragraph is one line, line breaks inside paragraph (<w:br/>, <w:cr/>) start a new line, so
+the lines of the loaded text match the paragraphs of the document
+"""
+
+
+def iter_docx_paragraphs(filepath: str) -> Iterator[str]:
+    with zipfile.ZipFile(filepath) as archive, archive.open("word/document.xml") as xml:
+        parts: list[str] = []
+        body = None
+        runs = 0  # depth of w:r, tabs outside of runs are tab stops of paragraph properties, not text
+
+        for event, element in ElementTree.iterparse(xml, events=("start", "end")):
+            tag = element.tag
+            if event == "start":
+                if body is None and tag == _WORD_NAMESPACE + "body":
+                    body = element
+                elif tag == _WORD_NAMESPACE + "r":
+                    runs += 1
+                continue
+
+            if tag == _WORD_NAMESPACE + "r":
+                runs -= 1
+            elif tag == _WORD_NAMESPACE + "t":
+                parts.append(element.text or "")
+            elif tag == _WORD_NAMESPACE + "tab" and runs:
+                parts.append("\t")
+            elif tag in (_WORD_NAMESPACE + "br", _WORD_NAMESPACE + "cr"):
+                parts.append("\n")
+            elif tag == _WORD_NAMESPACE + "p":
+                yield "".join(parts)
+                parts = []
+                if body is not None:
+                    body.clear()
+
+
+"""
+Packs docx paragraphs into Documents of about 'window_size' symbols, a window is cut only between
+paragraphs (a longer paragraph becomes a window of its own). Every paragraph ends with a line break,
+so the windows carry char_offset and line_offset the same way as in iter_text_windows
+"""
+
+
+def iter_docx_windows(filepath: str, window_size: int) -> Iterator[Document]:
+    lines: list[str] = []
+    size = char_offset = line_offset = 0
+
+    def pack() -> Document:
+        return Document(
+            page_content="".join(lines),
+            metadata={
+                "source": filepath,
+                "char_offset": char_offset,
+                "line_offset": line_offset,
+            },
+        )
+
+    for paragraph in iter_docx_paragraphs(filepath):
+        line = paragraph + "\n"
+        if lines and size + len(line) > window_size:
+            document = pack()
+            yield document
+            char_offset += size
+            line_offset += document.page_content.count("\n")
+            lines, size = [], 0
+
+        lines.append(line)
+        size += len(line)
+
+    if lines:
+        yield pack()
+
+
+"""
+Same as iter_docx_windows, but returns the list (docx has no reliable pages)
+"""
+
+
+def load_docx(filepath: str, window_size: int) -> list[Document]:
+    return list(iter_docx_windows(filepath, window_size))
+
+
+"""
+Packs csv rows into chunks of at most 'chunk_size' symbols instead of making a Document of every
+row. Rows are read in blocks with the C csv reader, every row is rendered the same way CSVLoader
+does ("column: value" per line) with column prefixes prepared once, and consecutive rows are joined
+until the chunk is full. A row longer than 'chunk_size' becomes a chunk of its own
+
+start_line and end_line of a chunk are the lines of the file where its first row starts and its last
+row ends (quoted values with line breaks are taken into account), the header is line 1
+
+chunks_per_batch -> the number of chunks yielded at once
+"""
+
+
+def iter_csv_chunks(filepath: str, chunk_size: int, chunks_per_batch: int = 256) -> Iterator[list[Chunk]]:
+    with open(filepath, newline="", encoding="utf-8", errors="replace") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+
+        prefixes = [f"{column.strip()}: " for column in header]
+        batch: list[Chunk] = []
+        rows: list[str] = []
+        size = 0
+        first_line = last_line = reader.line_num
+
+        def pack() -> Chunk:
+            return Chunk(
+                id=uuid4(),
+                filename=filepath,
+                page_number=0,
+                start_index=0,
+                start_line=first_line,
+                end_line=last_line,
+                text="\n".join(rows),
+            )
+
+        for row in reader:
+            text = "\n".join([prefix + value.strip() for prefix, value in zip(prefixes, row)])
+
+            if rows and size + len(text) + 1 > chunk_size:
+                batch.append(pack())
+                rows, size = [], 0
+                if len(batch) == chunks_per_batch:
+                    yield batch
+                    batch = []
+
+            if not rows:
+                first_line = last_line + 1
+            rows.append(text)
+            size += len(text) + (1 if len(rows) > 1 else 0)
+            last_line = reader.line_num
+
+        if rows:
+            batch.append(pack())
+        if batch:
+            yield batch
+
+
+"""
+Memory-maps a plain text file (txt, json, md) and yields it as Documents of about 'window_size'
+bytes, cut after the last line break of the window (or on a utf-8 symbol border for very long lines).
+Only the current window is decoded, so the whole text is never held in memory.
+
+Every window keeps the absolute position of its first symbol in the metadata: char_offset (number
+of symbols before the window) and line_offset (number of line breaks before the window). Chunks
+made from the window add them to their start_index and lines
+"""
+
+
+def iter_text_windows(filepath: str, window_size: int) -> Iterator[Document]:
+    if os.path.getsize(filepath) == 0:
+        return
+
+    with open(filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        start = char_offset = line_offset = 0
+
+        while start < size:
+            end = min(start + window_size, size)
+            if end < size:
+                line_end = mm.rfind(b"\n", start, end)
+                if line_end != -1:
+                    end = line_end + 1
+                else:
+                    while end > start + 1 and mm[end] & 0xC0 == 0x80:  # do not cut a symbol in two
+                        end -= 1
+
+            text = mm[start:end].decode("utf-8", errors="replace")
+            yield Document(
+                page_content=text,
+                metadata={
+                    "source": filepath,
+                    "char_offset": char_offset,
+                    "line_offset": line_offset,
+                },
+            )
+
+            char_offset += len(text)
+            line_offset += text.count("\n")
+            start = end
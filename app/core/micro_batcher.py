@@ -0,0 +1,87 @@
+from concurrent.futures import Future
+from threading import Thread, Lock
+from queue import Queue, Empty
+from typing import Callable
+from app.settings import settings
+import numpy as np
+import time
+
+
+class MicroBatcher:
+    """
+    Collects texts from concurrent callers and encodes them with one call of the model. A batch is
+    sent when it has 'max_batch_size' texts or 'max_wait' seconds passed since its first request,
+    so a single request waits at most 'max_wait' longer than before
+
+    encode -> encodes the list of texts, returns vectors in the same order
+    batches, texts -> the number of model calls made and texts encoded by them
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[list[str]], object],
+        max_batch_size: int | None = None,
+        max_wait: float | None = None,
+    ):
+        self.encode = encode
+        self.max_batch_size: int = max_batch_size or settings.micro_batching.max_batch_size
+        self.max_wait: float = max_wait if max_wait is not None else settings.micro_batching.max_wait
+        self.batches: int = 0
+        self.texts: int = 0
+        self._lock = Lock()
+        self._queue: Queue[tuple[list[str], Future]] = Queue()
+        self._thread = Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, texts: list[str]) -> Future:
+        future: Future = Future()
+        self._queue.put((texts, future))
+        return future
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        return self.submit(texts).result()
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "texts": self.texts,
+                "average_batch": self.texts / self.batches if self.batches else 0.0,
+            }
+
+    def _run(self) -> None:
+        while True:
+            requests = [self._queue.get()]
+            size = len(requests[0][0])
+            deadline = time.monotonic() + self.max_wait
+
+            while size < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except Empty:
+                    break
+                requests.append(request)
+                size += len(request[0])
+
+            self._process(requests)
+
+    def _process(self, requests: list[tuple[list[str], Future]]) -> None:
+        texts = [text for request_texts, _ in requests for text in request_texts]
+        try:
+            vectors = np.asarray(self.encode(texts))
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+
+        with self._lock:
+            self.batches += 1
+            self.texts += len(texts)
+
+        offset = 0
+        for request_texts, future in requests:
+            future.set_result(vectors[offset : offset + len(request_texts)])
+            offset += len(request_texts)
@@ -8,25 +8,105 @@ from sentence_transformers import (
 from ctransformers import AutoModelForCausalLM
 from torch import Tensor
 from google import genai
-from google.genai import types
+from google.genai import types, errors
 from app.core.chunks import Chunk
-from app.settings import settings, BASE_DIR, GeminiEmbeddingSettings
+from app.core.embedding_cache import EmbeddingCache
+from app.core.rate_limiter import RateLimiter
+from app.core.micro_batcher import MicroBatcher
+from app.core.batching import token_budget_batches
+from app.core.backends import load_model, backend_name
+from app.settings import settings, BASE_DIR, GeminiEmbeddingSettings, logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import random
+import time
 
 load_dotenv()
 
 
+"""
+Returns the shared embedding cache if it is enabled in settings
+"""
+
+
+def default_embedding_cache() -> EmbeddingCache | None:
+    return EmbeddingCache() if settings.embedding_cache.enabled else None
+
+
+"""
+Returns the number of tokens of every text as the model sees it (truncated to 'max_length' if it is set)
+"""
+
+
+def token_lengths(tokenizer, texts: list[str], max_length: int | None) -> list[int]:
+    encoded = tokenizer(
+        texts,
+        add_special_tokens=True,
+        truncation=max_length is not None,
+        max_length=max_length,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+    )
+    return [len(ids) for ids in encoded["input_ids"]]
+
+
+"""
+Encodes texts with SentenceTransformer. Lists of texts are encoded by length buckets under the token
+budget (see token_budget_batches), vectors are returned in the order of texts
+"""
+
+
+def encode_by_buckets(model: SentenceTransformer, text: str | list[str]) -> Tensor | list[Tensor]:
+    if isinstance(text, str) or len(text) <= 1:
+        return model.encode(sentences=text, show_progress_bar=False, batch_size=32)
+
+    lengths = token_lengths(model.tokenizer, text, model.max_seq_length)
+    vectors = np.empty((len(text), model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    for batch in token_budget_batches(lengths, settings.batching.token_budget, settings.batching.max_batch_size):
+        vectors[batch] = model.encode(sentences=[text[i] for i in batch], show_progress_bar=False, batch_size=len(batch))
+
+    return vectors
+
+
 class Embedder:
-    def __init__(self, model: str = "BAAI/bge-m3"):
+    """
+    cache -> texts encoded before are taken from it instead of the model, default_embedding_cache() by default
+    batcher -> joins small requests of concurrent callers (search queries) into one forward pass, large
+        batches (ingestion) go to the model directly
+    """
+
+    def __init__(self, model: str = "BAAI/bge-m3", cache: EmbeddingCache | None = None):
         self.device: str = settings.device
         self.model_name: str = model
-        self.model: SentenceTransformer = SentenceTransformer(model, device=self.device)
+        self.backend: str = backend_name()
+        self.model: SentenceTransformer = load_model(SentenceTransformer, model, self.device)
+        self.cache: EmbeddingCache | None = cache if cache is not None else default_embedding_cache()
+        self.cache_key: str = EmbeddingCache.model_key(model, self.get_vector_dimensionality(), self.backend)
+        self.batcher: MicroBatcher | None = (
+            MicroBatcher(self._encode_model) if settings.micro_batching.enabled else None
+        )
 
     """
     Encodes string to dense vector
     """
 
     def encode(self, text: str | list[str]) -> Tensor | list[Tensor]:
-        return self.model.encode(sentences=text, show_progress_bar=False, batch_size=32)
+        if self.cache is None:
+            return self._encode(text)
+
+        vectors = self.cache.get_or_compute(self.cache_key, [text] if isinstance(text, str) else text, self._encode)
+        return vectors[0] if isinstance(text, str) else vectors
+
+    def _encode(self, text: str | list[str]) -> Tensor | list[Tensor]:
+        if self.batcher is None or (isinstance(text, list) and len(text) >= self.batcher.max_batch_size):
+            return self._encode_model(text)
+
+        vectors = self.batcher([text] if isinstance(text, str) else text)
+        return vectors[0] if isinstance(text, str) else vectors
+
+    def _encode_model(self, text: str | list[str]) -> Tensor | list[Tensor]:
+        return encode_by_buckets(self.model, text)
 
     """
     Returns the dimensionality of dense vector
@@ -40,7 +120,7 @@ class Reranker:
     def __init__(self, model: str = "cross-encoder/ms-marco-MiniLM-L6-v2"):
         self.device: str = settings.device
         self.model_name: str = model
-        self.model: CrossEncoder = CrossEncoder(model, device=self.device)
+        self.model: CrossEncoder = load_model(CrossEncoder, model, self.device)
 
     """
     Returns re-sorted (by relevance) vector with dicts, from which we need only the 'corpus_id'
@@ -48,7 +128,21 @@ class Reranker:
     """
 
     def rank(self, query: str, chunks: list[Chunk]) -> list[dict[str, int]]:
-        return self.model.rank(query, [chunk.get_raw_text() for chunk in chunks])
+        texts = [chunk.get_raw_text() for chunk in chunks]
+        if len(texts) <= 1:
+            return self.model.rank(query, texts)
+
+        query_length = token_lengths(self.model.tokenizer, [query], self.model.max_length)[0]
+        lengths = [query_length + length for length in token_lengths(self.model.tokenizer, texts, self.model.max_length)]
+        scores = np.empty(len(texts), dtype=np.float32)
+
+        for batch in token_budget_batches(lengths, settings.batching.token_budget, settings.batching.max_batch_size):
+            scores[batch] = self.model.predict(
+                [(query, texts[i]) for i in batch], batch_size=len(batch), show_progress_bar=False
+            )
+
+        # the same order as CrossEncoder.rank gives, equal scores keep the order of chunks
+        return [{"corpus_id": int(i), "score": scores[i]} for i in np.argsort(-scores, kind="stable")]
 
 
 # TODO: add models parameters to global config file
@@ -156,33 +250,73 @@ class GeminiLLM:
 
 
 class GeminiEmbed:
-    def __init__(self, model="text-embedding-004"):
+    """
+    Batches of one call are sent concurrently (at most 'concurrency' in flight for all callers) under
+    the requests per minute limit, throttled batches are retried with exponential backoff. Vectors are
+    returned in the order of texts
+
+    cache -> texts encoded before are taken from it instead of paid API calls, default_embedding_cache() by default
+    """
+
+    def __init__(self, model="text-embedding-004", cache: EmbeddingCache | None = None):
         self.client = genai.Client(api_key=settings.api_key)
         self.model = model
+        self.model_name: str = model
+        self.backend: str | None = None  # vectors are computed by the api
         self.settings = GeminiEmbeddingSettings()
+        self.cache: EmbeddingCache | None = cache if cache is not None else default_embedding_cache()
+        self.cache_key: str = EmbeddingCache.model_key(model, self.get_vector_dimensionality())
+        self.requests = settings.gemini_embedding_requests
+        self.limiter = RateLimiter(self.requests.requests_per_minute)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, self.requests.concurrency), thread_name_prefix="gemini-embed"
+        )
 
     def encode(self, text: str | list[str]) -> list[Tensor]:
+        if self.cache is None:
+            return self._encode(text)
+
+        return self.cache.get_or_compute(self.cache_key, [text] if isinstance(text, str) else text, self._encode).tolist()
+
+    def _encode(self, text: str | list[str]) -> list[Tensor]:
 
         if isinstance(text, str):
             text = [text]
 
-        output: list[Tensor] = []
         max_batch_size = 100  # can not be changed due to google restrictions
+        batches = [text[i : i + max_batch_size] for i in range(0, len(text), max_batch_size)]
+
+        if len(batches) > 1 and self.requests.concurrency > 1:
+            responses = self.executor.map(self._embed_batch, batches)  # keeps the order of batches
+        else:
+            responses = map(self._embed_batch, batches)
 
-        for i in range(0, len(text), max_batch_size):
-            batch = text[i : i + max_batch_size]
-            response = self.client.models.embed_content(
-                model=self.model,
-                contents=batch,
-                config=types.EmbedContentConfig(
-                    **settings.gemini_embedding.model_dump()
-                ),
-            ).embeddings
+        return [values for response in responses for values in response]
 
-            for i, emb in enumerate(response):
-                output.append(emb.values)
+    """
+    Sends one batch, retries it when the api is throttling or temporarily unavailable
+    """
 
-        return output
+    def _embed_batch(self, batch: list[str]) -> list[Tensor]:
+        for attempt in range(self.requests.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.client.models.embed_content(
+                    model=self.model,
+                    contents=batch,
+                    config=types.EmbedContentConfig(
+                        **settings.gemini_embedding.model_dump()
+                    ),
+                ).embeddings
+                return [emb.values for emb in response]
+            except errors.APIError as e:
+                if e.code not in (429, 500, 503) or attempt == self.requests.max_retries:
+                    raise
+
+                delay = min(self.requests.max_backoff, self.requests.backoff * 2**attempt)
+                delay *= 0.5 + random.random() / 2  # nosec B311 - jitter, not security
+                logging.warning("Gemini embedding got %s, retrying in %.1f s", e.code, delay)
+                time.sleep(delay)
 
     def get_vector_dimensionality(self) -> int | None:
         return getattr(self.settings, "output_dimensionality")
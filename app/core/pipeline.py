@@ -0,0 +1,577 @@
+from concurrent.futures import ProcessPoolExecutor, Future
+from collections import deque, Counter
+from threading import Thread, Event, Lock
+from queue import Queue, Empty, Full
+from typing import Callable
+from app.core.processor import DocumentProcessor, extract_documents, parsing_context
+from app.core.loaders import extract_pdf_pages, pdf_page_ranges, iter_csv_chunks, iter_text_windows, iter_docx_windows
+from app.core.database import VectorDatabase
+from app.core.chunks import Chunk, assign_stable_ids
+from app.core.upload_store import UploadStore
+from app.settings import logging, settings
+import time
+
+
+_END = object()  # marks the end of the stream between two stages
+
+
+class _FileEnd:
+    """
+    Follows the last document of a file in the queue between loader and splitter
+
+    failed -> the file was loaded only partly, points already added for it are deleted, the old version is kept
+    """
+
+    def __init__(self, path: str, failed: bool = False):
+        self.path: str = path
+        self.failed: bool = failed
+
+
+class _LoadingTask:
+    """
+    A piece of loading work: a whole file, a range of pdf pages, or a csv packed into chunks
+
+    last -> it is the last task of the file
+    inline -> the function returns an iterator and is run in the loader thread, its items are passed
+    on as soon as they are produced instead of waiting for the whole result
+    """
+
+    def __init__(self, path: str, function: Callable, args: tuple, last: bool = True, inline: bool = False):
+        self.path: str = path
+        self.function: Callable = function
+        self.args: tuple = args
+        self.last: bool = last
+        self.inline: bool = inline
+
+
+class _FileState:
+    """
+    What splitter knows about the file it is working on
+
+    existing -> points the collection already holds for the source and that are not matched by chunks of
+        the new version yet (empty for the first upload), at the end of the file they are the stale ones
+    moved -> metadata updates of unchanged chunks that moved
+    added -> ids of fresh chunks passed on, they are deleted if the file fails
+    occurrences -> counters of repeated texts for stable ids, shared by all documents of the file
+    """
+
+    def __init__(self, source: str, existing: dict[str, dict]):
+        self.source: str = source
+        self.existing: dict[str, dict] = existing
+        self.moved: list = []
+        self.added: list[str] = []
+        self.occurrences: dict[bytes, int] = {}
+
+
+class _SourceEnd:
+    """
+    Follows the fresh chunks of a source on the way to the upserter, which completes the sync of the
+    source after all of them are stored: updates metadata of moved chunks and only then deletes the
+    points of the old version that are gone, so a failure before keeps the old version searchable
+
+    stale -> ids of points whose chunks are gone from the new version
+    moved -> metadata updates of unchanged chunks that moved
+    added -> ids of fresh chunks of the source
+    failed -> the file was loaded only partly, its added points are deleted instead and the old version
+        stays as it was
+    """
+
+    def __init__(self, source: str, stale: list[str], moved: list, added: list[str], failed: bool = False):
+        self.source: str = source
+        self.stale: list[str] = stale
+        self.moved: list = moved
+        self.added: list[str] = added
+        self.failed: bool = failed
+
+
+class StageStats:
+    """
+    name -> the name of the stage
+    items -> the number of produced items (documents, chunks, vectors or points)
+    busy_time -> seconds spent on the actual work (waiting for the queues is excluded)
+    """
+
+    def __init__(self, name: str):
+        self.name: str = name
+        self.items: int = 0
+        self.busy_time: float = 0.0
+        self._lock: Lock = Lock()
+
+    def add(self, items: int, seconds: float) -> None:
+        with self._lock:
+            self.items += items
+            self.busy_time += seconds
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.busy_time if self.busy_time > 0 else 0.0
+
+    def __str__(self):
+        return f"{self.name}: {self.items} items in {self.busy_time:.3f}s ({self.throughput:.1f} items/s)"
+
+
+class IngestionPipeline:
+    """
+    Streams files through four stages, each running in its own thread:
+        loader -> parses files and page ranges of pdf (in a pool of processes) and emits documents (pages),
+            csv files are packed into chunks right in the loader, plain text files are memory-mapped
+            and emitted by windows
+        splitter -> splits documents into chunks
+        embedder -> encodes chunks in batches
+        upserter -> saves embedded chunks to the db
+
+    A new pipeline is created for every upload and keeps all state of it (counters, the file in work,
+    cache parts), while the shared processor and db hold no per-request data, so concurrent uploads
+    are independent and the memory of the process does not grow with the number of uploads.
+
+    Stages are joined by bounded queues, so embedding of one file overlaps with parsing of the
+    next one, and the amount of data kept in memory does not depend on the size of the upload.
+
+    Every file is synced with the points the collection already holds for its source (path of the
+    uploaded file in the chat): chunks get stable ids, only new chunks are embedded and stored, chunks
+    that disappeared from the file are deleted after the new ones are stored. Files are synced as they
+    stream, only ids of the old version are kept in memory. Points added for a file that failed to load,
+    or for files in work when the pipeline fails, are deleted, so no file is left partly ingested.
+
+    If the upload store is given, files that were already ingested with the same embedder skip
+    the loader, splitter and embedder - their cached chunks and vectors go directly to the
+    upserter. Results of new files are written to the cache once the whole pipeline succeeds.
+
+    queue_size -> the capacity of every queue between stages
+    batch_size -> the number of chunks encoded with one call of the embedder
+    workers -> the number of processes used for parsing
+    store -> content-addressed upload store with cached ingestion results
+    """
+
+    def __init__(
+        self,
+        processor: DocumentProcessor,
+        db: VectorDatabase,
+        queue_size: int | None = None,
+        batch_size: int | None = None,
+        workers: int | None = None,
+        store: UploadStore | None = None,
+    ):
+        self.processor = processor
+        self.db = db
+        self.store = store
+        self.model_key: str | None = UploadStore.model_key(db.embedder) if store else None
+        self._cache_writer = store.writer(self.model_key) if store else None
+        self.queue_size = queue_size or settings.ingestion.queue_size
+        self.batch_size = batch_size or settings.ingestion.embedding_batch_size
+        if workers is None:
+            workers = (
+                settings.processor.loading_workers
+                if settings.processor.parallel_loading
+                else 1
+            )
+        self.workers = max(1, workers)
+
+        self.files_loaded: int = 0  # files that went through the loader, including failed ones
+        self.files_from_cache: int = 0
+        self.sources: dict[str, str] = {}
+        self._stop = Event()
+        self._errors: list[Exception] = []
+        self._open_sources: dict[str, list[str]] = {}  # sources not completed by the upserter -> added ids
+        self._old_versions: dict[str, frozenset[str]] = {}  # re-uploaded open sources -> ids of the old version
+        self._sources_lock = Lock()
+        self.stats: dict[str, StageStats] = {
+            name: StageStats(name) for name in ("loader", "splitter", "embedder", "upserter")
+        }
+
+    """
+    Runs the pipeline and blocks until all files are saved. Returns per stage counters
+
+    sources -> maps paths to the sources (names of uploaded files), the path itself is used for missing
+        ones. Two files with the same source in one upload are rejected, they would replace each other
+    """
+
+    def run(
+        self,
+        collection_name: str,
+        documents: list[str],
+        sources: dict[str, str] | None = None,
+    ) -> dict[str, StageStats]:
+        self.sources = sources or {}
+        repeated = [source for source, count in Counter(map(self._source_of, documents)).items() if count > 1]
+        if repeated:
+            raise ValueError(f"Several different files are uploaded as {', '.join(repeated)}")
+
+        documents_queue: Queue = Queue(maxsize=self.queue_size)
+        chunks_queue: Queue = Queue(maxsize=self.queue_size)
+        vectors_queue: Queue = Queue(maxsize=self.queue_size)
+
+        threads = [
+            Thread(target=self._guard, args=(self._load, collection_name, documents, documents_queue, vectors_queue), daemon=True),
+            Thread(target=self._guard, args=(self._split, collection_name, documents_queue, chunks_queue), daemon=True),
+            Thread(target=self._guard, args=(self._embed, chunks_queue, vectors_queue), daemon=True),
+            Thread(target=self._guard, args=(self._upsert, collection_name, vectors_queue), daemon=True),
+        ]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._errors:
+            if self._cache_writer is not None:
+                self._cache_writer.discard()
+            self._remove_open_sources(collection_name)
+            raise self._errors[0]
+
+        if self._cache_writer is not None:
+            self._cache_writer.commit()
+
+        return self.stats
+
+    def _guard(self, stage, *args) -> None:
+        try:
+            stage(*args)
+        except Exception as e:
+            logging.error("Error at ingestion pipeline stage %s", stage.__name__, exc_info=e)
+            self._errors.append(e)
+            self._stop.set()
+
+    """
+    Deletes points added for the sources that were not completed, the old versions of them are kept
+    """
+
+    def _remove_open_sources(self, collection_name: str) -> None:
+        with self._sources_lock:
+            open_sources, self._open_sources = self._open_sources, {}
+            self._old_versions = {}
+
+        for source, added in open_sources.items():
+            try:
+                self.db.delete_points(collection_name, added)
+            except Exception as e:
+                logging.error("Error at removing partly ingested %s", source, exc_info=e)
+
+    def _open_source(self, collection_name: str, source: str) -> _FileState:
+        state = _FileState(source, self.db.get_source_points(collection_name, source))
+        with self._sources_lock:
+            self._open_sources[source] = state.added
+            if state.existing:
+                self._old_versions[source] = frozenset(state.existing)
+        return state
+
+    def _close_source(self, source: str) -> None:
+        with self._sources_lock:
+            self._open_sources.pop(source, None)
+            self._old_versions.pop(source, None)
+
+    """
+    Returns ids of the old versions of the sources of chunks. The old version is deleted only after the
+    new one is stored, so new chunks are not checked against it for near-duplicates - an edited chunk
+    would be rejected as a duplicate of the text it replaces and both would be gone
+    """
+
+    def _old_version_ids(self, chunks: list[Chunk]) -> set[str]:
+        with self._sources_lock:
+            versions = [self._old_versions.get(source) for source in {chunk.source for chunk in chunks}]
+        return set().union(*(version for version in versions if version))
+
+    def _source_of(self, path: str) -> str:
+        return self.sources.get(path) or path
+
+    """
+    Blocking put that gives up when another stage has failed
+    """
+
+    def _put(self, queue: Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _get(self, queue: Queue):
+        while not self._stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                continue
+        return _END
+
+    """
+    Sends cached files straight to the upserter, then loads the rest of files. Loading is split into
+    tasks (a whole file, or a range of pages for pdf), at most 'workers' tasks are running at the same
+    time and their documents are emitted in the order of paths and pages, so the first pages of a large
+    pdf go further while the next ones are still being extracted. Files that failed to load are
+    logged and skipped
+    """
+
+    def _load(self, collection_name: str, documents: list[str], output: Queue, cached_output: Queue) -> None:
+        if self.store is not None:
+            not_cached = []
+            for path in documents:
+                if not self.store.has_cache(path, self.model_key):
+                    not_cached.append(path)
+                    continue
+
+                if not self._load_cached(collection_name, path, cached_output):
+                    return
+                self.files_loaded += 1
+                self.files_from_cache += 1
+            documents = not_cached
+
+        tasks = self._loading_tasks(documents)
+        failed: set[str] = set()
+
+        if self.workers <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                if not self._emit_task(output, task, None, time.perf_counter(), failed):
+                    return
+        else:
+            in_flight: deque[tuple[_LoadingTask, Future | None, float]] = deque()
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(tasks)), mp_context=parsing_context()) as executor:
+                for task in tasks:
+                    if len(in_flight) >= self.workers:
+                        if not self._emit_task(output, *in_flight.popleft(), failed):
+                            return
+                    future = None if task.inline else executor.submit(task.function, *task.args)
+                    in_flight.append((task, future, time.perf_counter()))
+
+                while in_flight:
+                    if not self._emit_task(output, *in_flight.popleft(), failed):
+                        return
+
+        self._put(output, _END)
+
+    def _loading_tasks(self, documents: list[str]) -> list[_LoadingTask]:
+        tasks = []
+
+        for path in documents:
+            if path.endswith(".csv") and settings.processor.pack_csv_rows:
+                tasks.append(
+                    _LoadingTask(path, iter_csv_chunks, (path, settings.text_splitter.chunk_size), inline=True)
+                )
+                continue
+
+            if path.endswith((".txt", ".json", ".md")):
+                tasks.append(
+                    _LoadingTask(path, iter_text_windows, (path, settings.processor.text_window_size), inline=True)
+                )
+                continue
+
+            if path.endswith(".docx"):
+                tasks.append(
+                    _LoadingTask(path, iter_docx_windows, (path, settings.processor.text_window_size), inline=True)
+                )
+                continue
+
+            if not path.endswith(".pdf"):
+                tasks.append(_LoadingTask(path, extract_documents, (path,)))
+                continue
+
+            try:
+                ranges = pdf_page_ranges(path, settings.processor.pdf_pages_per_task)
+            except Exception as e:
+                self.files_loaded += 1
+                logging.error("Error at load_documents while loading %s", path, exc_info=e)
+                continue
+
+            if not ranges:
+                tasks.append(_LoadingTask(path, extract_pdf_pages, (path,)))
+            for i, (start, end) in enumerate(ranges):
+                tasks.append(_LoadingTask(path, extract_pdf_pages, (path, start, end), last=i == len(ranges) - 1))
+
+        return tasks
+
+    """
+    Passes on the result of the task: documents (or batches of ready chunks for inline tasks),
+    followed by the end of file marker after the last task of the file. The first failed task of
+    a file ends it, results of its remaining tasks are dropped
+
+    future -> the task running in the pool, None if the task should be run here
+    """
+
+    def _emit_task(
+        self,
+        output: Queue,
+        task: _LoadingTask,
+        future: Future | None,
+        submitted: float,
+        failed: set[str],
+    ) -> bool:
+        if task.path in failed:
+            return True
+
+        items = 0
+        try:
+            result = future.result() if future is not None else task.function(*task.args)
+            for item in result:
+                if not self._put(output, item):
+                    return False
+                items += 1
+        except Exception as e:
+            logging.error("Error at load_documents while loading %s", task.path, exc_info=e)
+            failed.add(task.path)
+            self.files_loaded += 1
+            return self._put(output, _FileEnd(task.path, failed=True))
+        finally:
+            self.stats["loader"].add(items, time.perf_counter() - submitted)
+
+        if task.last:
+            self.files_loaded += 1
+            return self._put(output, _FileEnd(task.path))
+        return True
+
+    """
+    Syncs cached chunks of the file with the collection batch by batch and sends only missing ones
+    (with their vectors) to the upserter, followed by the end of the source
+    """
+
+    def _load_cached(self, collection_name: str, path: str, output: Queue) -> bool:
+        self._cache_writer.exclude(path)  # the cache of this file is already complete
+
+        state = self._open_source(collection_name, self._source_of(path))
+
+        for chunks, cached_vectors in self.store.read_cache(path, self.model_key, batch_size=self.batch_size):
+            vectors = {id(chunk): vector for chunk, vector in zip(chunks, cached_vectors)}
+            fresh = self._sync_chunks(state, chunks)
+            if fresh and not self._put(output, (fresh, [vectors[id(chunk)] for chunk in fresh], True)):
+                return False
+
+        return self._put(output, self._end_of_source(state))
+
+    """
+    Splits documents into chunks as soon as they arrive, gives them stable ids and passes on the ones
+    that are not stored yet. The end of a re-uploaded source is passed on after its chunks
+    """
+
+    def _split(self, collection_name: str, input: Queue, output: Queue) -> None:
+        stats = self.stats["splitter"]
+        state: _FileState | None = None
+
+        while (item := self._get(input)) is not _END:
+            start = time.perf_counter()
+
+            if isinstance(item, _FileEnd):
+                source_end = self._finish_file(collection_name, item, state)
+                state = None
+                stats.add(0, time.perf_counter() - start)
+                if source_end is not None and not self._put(output, source_end):
+                    return
+                continue
+
+            # csv is packed into chunks by the loader, other documents are splitted here
+            chunks = item if isinstance(item, list) else self.processor.split_document(item)
+            if not chunks:
+                continue
+
+            if state is None:
+                state = self._open_source(collection_name, self._source_of(chunks[0].filename))
+
+            fresh = self._sync_chunks(state, chunks, chunks[0].filename)
+            stats.add(len(chunks), time.perf_counter() - start)
+
+            for group in range(0, len(fresh), self.batch_size):
+                if not self._put(output, fresh[group : group + self.batch_size]):
+                    return
+
+        self._put(output, _END)
+
+    """
+    Returns chunks of the file that are not stored yet
+
+    path -> the file is not cached if some of its chunks do not go through the pipeline, None to keep the cache
+    """
+
+    def _sync_chunks(self, state: _FileState, chunks: list[Chunk], path: str | None = None) -> list[Chunk]:
+        assign_stable_ids(chunks, state.source, state.occurrences)
+        fresh = chunks
+        if state.existing:
+            fresh, moved = self.db.diff_source(chunks, state.existing)
+            state.moved.extend(moved)
+            if len(fresh) < len(chunks) and path is not None and self._cache_writer is not None:
+                self._cache_writer.exclude(path)  # the cache of partly synced file would be incomplete
+
+        state.added.extend(str(chunk.id) for chunk in fresh)
+        return fresh
+
+    def _end_of_source(self, state: _FileState, failed: bool = False) -> _SourceEnd:
+        if failed:
+            return _SourceEnd(state.source, stale=[], moved=[], added=state.added, failed=True)
+        return _SourceEnd(state.source, stale=list(state.existing), moved=state.moved, added=state.added)
+
+    def _finish_file(self, collection_name: str, file_end: _FileEnd, state: _FileState | None) -> _SourceEnd | None:
+        if file_end.failed:
+            if self._cache_writer is not None:
+                self._cache_writer.exclude(file_end.path)
+            return None if state is None else self._end_of_source(state, failed=True)
+
+        if state is None:  # the new version has no text, all points of the old one are stale
+            state = self._open_source(collection_name, self._source_of(file_end.path))
+        return self._end_of_source(state)
+
+    """
+    Collects chunks from several documents into batches of 'batch_size' and encodes them. The end of
+    a source is passed on right after the batch with the last chunk of the source
+
+    With the embedding pool, batches grow to 'embedding_pool.min_chunks', so db.encode_bulk shards them
+    across the worker processes instead of encoding them in this process
+    """
+
+    def _embed(self, input: Queue, output: Queue) -> None:
+        stats = self.stats["embedder"]
+        batch_size = self.batch_size
+        if self.db.embedding_pool is not None:
+            batch_size = max(batch_size, settings.embedding_pool.min_chunks)
+        batch: list[Chunk] = []
+        source_ends: list[tuple[int, _SourceEnd]] = []  # (the number of chunks of the batch before it, end)
+
+        def flush(size: int) -> bool:
+            nonlocal batch, source_ends
+            current, batch = batch[:size], batch[size:]
+            if current:
+                start = time.perf_counter()
+                vectors = self.db.encode_bulk([chunk.get_raw_text() for chunk in current])
+                stats.add(len(current), time.perf_counter() - start)
+                if not self._put(output, (current, vectors, False)):
+                    return False
+
+            for position, source_end in source_ends:
+                if position <= size and not self._put(output, source_end):
+                    return False
+            source_ends = [(position - size, source_end) for position, source_end in source_ends if position > size]
+            return True
+
+        while (item := self._get(input)) is not _END:
+            if isinstance(item, _SourceEnd):
+                source_ends.append((len(batch), item))
+                if not batch and not flush(0):
+                    return
+                continue
+
+            batch.extend(item)
+            while len(batch) >= batch_size:
+                if not flush(batch_size):
+                    return
+
+        if (batch or source_ends) and not flush(len(batch)):
+            return
+        self._put(output, _END)
+
+    def _upsert(self, collection_name: str, input: Queue) -> None:
+        stats = self.stats["upserter"]
+
+        while (item := self._get(input)) is not _END:
+            if isinstance(item, _SourceEnd):
+                if item.failed:
+                    self.db.delete_points(collection_name, item.added)
+                else:
+                    self.db.update_payloads(collection_name, item.moved)
+                    self.db.delete_points(collection_name, item.stale)
+                self._close_source(item.source)
+                continue
+
+            chunks, vectors, cached = item
+            start = time.perf_counter()
+            stored = self.db.store_vectors(collection_name, chunks, vectors, exclude=self._old_version_ids(chunks))
+            stats.add(stored, time.perf_counter() - start)
+
+            if self._cache_writer is not None and not cached:  # cached vectors are already in the store
+                self._cache_writer.append(chunks, vectors)
@@ -1,14 +1,14 @@
-from langchain_community.document_loaders import (
-    PyPDFLoader,
-    UnstructuredWordDocumentLoader,
-    TextLoader,
-    CSVLoader,
-    UnstructuredMarkdownLoader,
-)
+from langchain_community.document_loaders import CSVLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
 from app.core.models import Embedder
 from app.core.chunks import Chunk
+from app.core.loaders import extract_pdf_pages, load_docx, iter_text_windows
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.context import BaseContext
+from itertools import accumulate
+from bisect import bisect_left, bisect_right
+import multiprocessing
 import nltk  # used for proper tokenizer workflow
 from uuid import (
     uuid4,
@@ -17,25 +17,110 @@ import numpy as np
 from app.settings import logging, settings
 
 
-# TODO: replace PDFloader since it is completely unusable OR try to fix it
+"""
+Start method of processes that parse files. The server process already runs threads (micro-batcher,
+jobs, sqlite connections) and torch, so a fork of it may deadlock. Workers are forked from a clean
+forkserver process instead, which imports this module once, so a new pool does not import torch
+again (spawn where forkserver is not available)
+"""
 
 
-class DocumentProcessor:
+def parsing_context() -> BaseContext:
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+"""
+Extracts text from one file. Defined on the module level (not as a method) so it can be
+pickled and sent to the worker processes of load_documents
+
+TODO: Play with .pdf and text from img extraction
+TODO: Try chunking with llm
+"""
+
+
+def extract_documents(filepath: str) -> list[Document]:
+    loader = None
+
+    if filepath.endswith(".pdf"):
+        try:
+            # splits each presentation into slides and processes it as separate file
+            return extract_pdf_pages(filepath)
+        except Exception:
+            raise RuntimeError("File is corrupted")
+    elif filepath.endswith(".docx"):
+        try:
+            return load_docx(filepath, settings.processor.text_window_size)
+        except Exception:
+            raise RuntimeError("File is corrupted")
+    elif filepath.endswith(".doc"):
+        # old binary format is not a zip with xml, so only unstructured can read it
+        from langchain_community.document_loaders import UnstructuredWordDocumentLoader
+
+        loader = UnstructuredWordDocumentLoader(file_path=filepath)
+    elif filepath.endswith((".txt", ".json", ".md")):
+        try:
+            return list(iter_text_windows(filepath, settings.processor.text_window_size))
+        except Exception:
+            raise RuntimeError("File is corrupted")
+    elif filepath.endswith(".csv"):
+        loader = CSVLoader(file_path=filepath)
+
+    if loader is None:
+        raise RuntimeError("Unsupported type of file")
+
+    try:
+        # We can not return a single document since .pdf are splitted into several files
+        return loader.load()
+    except Exception:
+        raise RuntimeError("File is corrupted")
+
+
+class IngestionSession:
     """
-    TODO: determine the most suitable chunk size
+    State of one upload. A new session is created for every request, so the memory it takes
+    depends only on the documents of this request, and concurrent uploads never share lists
 
-    chunks -> the list of chunks from loaded files
+    chunks -> the list of chunks from files loaded in this session
     chunks_unsaved -> the list of recently added chunks that have not been saved to db yet
     processed -> the list of files that were already splitted into chunks
     unprocessed -> !processed
-    text_splitter -> text splitting strategy
     """
 
-    def __init__(self, embedder: Embedder):
+    def __init__(self):
         self.chunks: list[Chunk] = []
         self.chunks_unsaved: list[Chunk] = []
         self.processed: list[Document] = []
         self.unprocessed: list[Document] = []
+
+    """
+    chunks_unsaved are used to avoid dublications while saving to db: returns only the chunks
+    added since the previous call
+    """
+
+    def get_and_save_unsaved_chunks(self) -> list[Chunk]:
+        chunks = self.chunks_unsaved
+        self.chunks_unsaved = []
+        return chunks
+
+    def get_all_chunks(self) -> list[Chunk]:
+        return self.chunks
+
+
+class DocumentProcessor:
+    """
+    Stateless part of ingestion shared by all requests, the state lives in IngestionSession
+
+    TODO: determine the most suitable chunk size
+
+    text_splitter -> text splitting strategy
+    """
+
+    def __init__(self, embedder: Embedder):
         self.embedder = embedder
         self.text_splitter = RecursiveCharacterTextSplitter(
             **settings.text_splitter.model_dump()
@@ -74,144 +159,214 @@ class DocumentProcessor:
     """
     Loads one file - extracts text from file
 
-    TODO: Replace UnstructuredWordDocumentLoader with Docx2txtLoader
-    TODO: Play with .pdf and text from img extraction
-    TODO: Try chunking with llm
-
-    add_to_unprocessed -> used to add loaded file to the list of unprocessed(unchunked) files if true
+    session -> if given, loaded file is added to the list of unprocessed(unchunked) files of the session
     """
 
     def load_document(
-        self, filepath: str, add_to_unprocessed: bool = False
+        self, filepath: str, session: IngestionSession | None = None
     ) -> list[Document]:
-        loader = None
-
-        if filepath.endswith(".pdf"):
-            loader = PyPDFLoader(
-                file_path=filepath
-            )  # splits each presentation into slides and processes it as separate file
-        elif filepath.endswith(".docx") or filepath.endswith(".doc"):
-            # loader = Docx2txtLoader(file_path=filepath) ## try it later, since UnstructuredWordDocumentLoader is extremly slow
-            loader = UnstructuredWordDocumentLoader(file_path=filepath)
-        elif filepath.endswith(".txt"):
-            loader = TextLoader(file_path=filepath)
-        elif filepath.endswith(".csv"):
-            loader = CSVLoader(file_path=filepath)
-        elif filepath.endswith(".json"):
-            loader = TextLoader(file_path=filepath)
-        elif filepath.endswith(".md"):
-            loader = UnstructuredMarkdownLoader(file_path=filepath)
-
-        if loader is None:
-            raise RuntimeError("Unsupported type of file")
-
-        documents: list[Document] = (
-            []
-        )  # We can not assign a single value to the document since .pdf are splitted into several files
-        try:
-            documents = loader.load()
-            # print("-" * 100, documents, "-" * 100, sep="\n")
-        except Exception:
-            raise RuntimeError("File is corrupted")
+        documents: list[Document] = extract_documents(filepath)
 
-        if add_to_unprocessed:
-            for doc in documents:
-                self.unprocessed.append(doc)
+        if session is not None:
+            session.unprocessed.extend(documents)
 
         return documents
 
     """
-    Similar to load_document, but for multiple files
+    Similar to load_document, but for multiple files. When parallel loading is enabled and
+    there is more than one file, files are parsed in a pool of processes. Documents are
+    returned in the order of the given paths in both cases
 
-    add_to_unprocessed -> used to add loaded files to the list of unprocessed(unchunked) files if true
+    session -> if given, loaded files are added to the list of unprocessed(unchunked) files of the session
+    workers -> the maximum number of processes, settings.processor.loading_workers by default
     """
 
     def load_documents(
-        self, documents: list[str], add_to_unprocessed: bool = False
+        self,
+        documents: list[str],
+        session: IngestionSession | None = None,
+        workers: int | None = None,
     ) -> list[Document]:
         extracted_documents: list[Document] = []
 
-        for doc in documents:
-            temp_storage: list[Document] = []
-
-            try:
-                temp_storage = self.load_document(
-                    filepath=doc, add_to_unprocessed=False
-                )  # In some cases it should be True, but i can not imagine any :(
-            except Exception as e:
+        if workers is None:
+            workers = (
+                settings.processor.loading_workers
+                if settings.processor.parallel_loading
+                else 1
+            )
+        workers = max(1, min(workers, len(documents)))
+
+        for doc, temp_storage in zip(
+            documents, self._extract_all(documents, workers=workers)
+        ):
+            if isinstance(temp_storage, Exception):
                 logging.error(
-                    "Error at load_documents while loading %s", doc, exc_info=e
+                    "Error at load_documents while loading %s", doc, exc_info=temp_storage
                 )
                 continue
 
             for extrc_doc in temp_storage:
                 extracted_documents.append(extrc_doc)
 
-                if add_to_unprocessed:
-                    self.unprocessed.append(extrc_doc)
+                if session is not None:
+                    session.unprocessed.append(extrc_doc)
 
         return extracted_documents
 
     """
-    Generates chunks with recursive splitter from the list of unprocessed files, add files to the list of processed, and clears unprocessed
+    Extracts documents from every file, returns either the list of documents or the raised
+    exception for each path (in the same order as paths)
+    """
+
+    def _extract_all(
+        self, documents: list[str], workers: int = 1
+    ) -> list[list[Document] | Exception]:
+        results: list[list[Document] | Exception] = []
+
+        if workers <= 1:
+            for doc in documents:
+                try:
+                    results.append(extract_documents(doc))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=parsing_context()) as executor:
+            futures = [executor.submit(extract_documents, doc) for doc in documents]
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(e)
+
+        return results
+
+    """
+    Generates chunks with recursive splitter from the list of unprocessed files of the session, add files
+    to the list of processed, and clears unprocessed
 
     TODO: try to split text with other llm (not really needed, but we should at least try it)
     """
 
-    def generate_chunks(self, query: str = "", embedding: bool = False):
+    def generate_chunks(self, session: IngestionSession, query: str = "", embedding: bool = False):
         most_relevant = []
 
         if embedding:
-            query_embedded = self.embedder.encode(query)
+            query_embedded = np.asarray(self.embedder.encode(query), dtype=np.float32).reshape(-1)
+            query_embedded = query_embedded / np.linalg.norm(query_embedded)
 
-        for document in self.unprocessed:
-            self.processed.append(document)
+        for document in session.unprocessed:
+            session.processed.append(document)
+            new_chunks = self.split_document(document)
 
-            text: list[str] = self.text_splitter.split_documents([document])
-            lines: list[str] = document.page_content.split("\n")
+            if embedding and new_chunks:
+                most_relevant = self.update_most_relevant_chunks(query_embedded, new_chunks, most_relevant)
 
-            for chunk in text:
-                start_l, end_l = self.get_start_end_lines(
-                    splitted_text=lines,
-                    start_char=chunk.metadata.get("start_index", 0),
-                    end_char=chunk.metadata.get("start_index", 0)
-                    + len(chunk.page_content),
-                )
+            session.chunks.extend(new_chunks)
+            session.chunks_unsaved.extend(new_chunks)
+
+        session.unprocessed = []
+        return most_relevant
 
-                newChunk = Chunk(
+    """
+    Batched version of update_most_relevant_chunk: encodes all chunks in one call, measures cosine
+    with the normalized query as one matrix product and merges chunks into the list of the most relevant.
+    The result is the same as adding chunks one by one: sorted by similarity, equal ones in the order of adding
+    (similarities of identical texts may differ in the last bit, since BLAS rounds rows of the product differently)
+    """
+
+    def update_most_relevant_chunks(
+        self,
+        query_normalized: np.ndarray,
+        chunks: list[Chunk],
+        relevant_chunks: list[list[np.float32, Chunk]],
+        mx_len=15,
+    ) -> list[list[np.float32, Chunk]]:
+        vectors = np.asarray(self.embedder.encode([chunk.text for chunk in chunks]), dtype=np.float32)
+        similarities = vectors @ query_normalized / np.linalg.norm(vectors, axis=1)
+
+        candidates = [chunk for _, chunk in relevant_chunks] + chunks
+        scores = np.concatenate([np.asarray([score for score, _ in relevant_chunks], dtype=np.float32), similarities])
+
+        return [[scores[i], candidates[i]] for i in self.top_k_indices(scores, mx_len)]
+
+    """
+    Returns indices of k largest scores in descending order, equal scores keep their order.
+    Uses partial sort, only the candidates are sorted completely
+    """
+
+    @staticmethod
+    def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+        if len(scores) > k:
+            threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+            candidates = np.flatnonzero(scores >= threshold)  # keeps all ties with the k-th score
+        else:
+            candidates = np.arange(len(scores))
+
+        return candidates[np.argsort(-scores[candidates], kind="stable")][:k]
+
+    """
+    Splits one document into chunks with recursive splitter. Does not touch the processor state,
+    so it can be used by the ingestion pipeline
+
+    Documents that are windows of a larger text (see iter_text_windows) carry char_offset and
+    line_offset, which are added to positions of chunks to make them absolute in the file
+    """
+
+    def split_document(self, document: Document) -> list[Chunk]:
+        chunks: list[Chunk] = []
+        char_offset = document.metadata.get("char_offset", 0)
+        line_offset = document.metadata.get("line_offset", 0)
+
+        text: list[Document] = self.text_splitter.split_documents([document])
+        lines: list[str] = document.page_content.split("\n")
+        line_index: list[int] = self.build_line_index(lines)
+
+        for chunk in text:
+            start_l, end_l = self.get_start_end_lines(
+                splitted_text=lines,
+                start_char=chunk.metadata.get("start_index", 0),
+                end_char=chunk.metadata.get("start_index", 0)
+                + len(chunk.page_content),
+                line_index=line_index,
+            )
+
+            chunks.append(
+                Chunk(
                     id=uuid4(),
                     filename=document.metadata.get("source", ""),
                     page_number=document.metadata.get("page", 0),
-                    start_index=chunk.metadata.get("start_index", 0),
-                    start_line=start_l,
-                    end_line=end_l,
+                    start_index=char_offset + chunk.metadata.get("start_index", 0),
+                    start_line=line_offset + start_l if start_l else 0,
+                    end_line=line_offset + end_l if end_l else 0,
                     text=chunk.page_content,
                 )
+            )
 
-                if embedding:
-                    chunk_embedded = self.embedder.encode(newChunk.text)
-                    similarity = self.cosine_similarity(query_embedded, chunk_embedded)
-                    self.update_most_relevant_chunk(
-                        [similarity, newChunk], most_relevant
-                    )
+        return chunks
 
-                self.chunks.append(newChunk)
-                self.chunks_unsaved.append(newChunk)
+    """
+    Builds cumulative line offsets for the text splitted by \n: offsets[i] is the index of the
+    first symbol of line i, offsets[-1] is the length of the text + 1 (as if it ended with \n)
+    """
 
-            self.unprocessed = []
-        return most_relevant
+    def build_line_index(self, splitted_text: list[str]) -> list[int]:
+        return [0, *accumulate(len(line) + 1 for line in splitted_text)]
 
     """
-    Determines the line, were the chunk starts and ends (1-based indexing)
+    Determines the line, were the chunk starts and ends (1-based indexing) with two binary
+    searches over the line offsets (O(log n) instead of scanning the text from the top)
 
-    Some magic stuff here. To be honest, i understood it after 7th attempt
-
-    TODO: invent more efficient way
+    A symbol on the border of two lines (the \n itself) belongs to both of them: the chunk end
+    is attributed to the first line that contains it and the chunk start to the last one that
+    does not go beyond the end line
 
     splitted_text -> original text splitted by \n
     start_char -> index of symbol, were current chunk starts
     end_char ->  index of symbol, were current chunk ends
     debug_mode -> flag, which enables printing useful info about the process
+    line_index -> offsets built with build_line_index, pass it to avoid rebuilding for every chunk
     """
 
     def get_start_end_lines(
@@ -220,30 +375,28 @@ class DocumentProcessor:
         start_char: int,
         end_char: int,
         debug_mode: bool = False,
+        line_index: list[int] | None = None,
     ) -> tuple[int, int]:
-        if debug_mode:
-            logging.info(splitted_text)
-
-        start, end, char_ct = 0, 0, 0
-        iter_count = 1
+        if line_index is None:
+            line_index = self.build_line_index(splitted_text)
 
-        for i, line in enumerate(splitted_text):
-            if debug_mode:
-                logging.info(
-                    f"start={start_char}, current={char_ct}, end_current={char_ct + len(line) + 1}, end={end_char}, len={len(line)}, iter={iter_count}\n"
-                )
+        lines_count = len(line_index) - 1
+        start, end = 0, 0
 
-            if char_ct <= start_char <= char_ct + len(line) + 1:
-                start = i + 1
-            if char_ct <= end_char <= char_ct + len(line) + 1:
-                end = i + 1
-                break
+        # the first line whose end (offset of the next line) is not less than end_char
+        last = bisect_left(line_index, end_char, 1) - 1
+        if last < lines_count:
+            end = last + 1
+        else:
+            last = lines_count - 1
 
-            iter_count += 1
-            char_ct += len(line) + 1
+        # the last line that starts not after start_char
+        first = min(bisect_right(line_index, start_char) - 1, last)
+        if first >= 0 and start_char <= line_index[first + 1]:
+            start = first + 1
 
         if debug_mode:
-            logging.info(f"result => {start} {end}\n\n\n")
+            logging.info(f"start={start_char}, end={end_char}, result => {start} {end}\n")
 
         return start, end
 
@@ -255,29 +408,6 @@ class DocumentProcessor:
         nltk.download("punkt")
         nltk.download("averaged_perceptron_tagger")
 
-    """
-    For now the system works as follows: we save recently loaded chunks in two arrays:
-        chunks - for all chunks, even for that ones that havn't been saveed to db
-        chunks_unsaved - for chunks that have been added recently
-    I do not know weather we really need to store all chunks that were added in the
-    current session, but chunks_unsaved are used to avoid dublications while saving to db.
-    """
-
-    def clear_unsaved_chunks(self):
-        self.chunks_unsaved = []
-
-    def get_all_chunks(self) -> list[Chunk]:
-        return self.chunks
-
-    """
-    If we want to save chunks to db, we need to clear the temp storage to avoid dublications
-    """
-
-    def get_and_save_unsaved_chunks(self) -> list[Chunk]:
-        chunks_copy: list[Chunk] = self.chunks.copy()
-        self.clear_unsaved_chunks()
-        return chunks_copy
-
 
 if __name__ == "__main__":
     document = DocumentProcessor()
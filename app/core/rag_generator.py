@@ -1,24 +1,150 @@
-from typing import Any, AsyncGenerator
+from typing import Any, AsyncGenerator, Callable
+from threading import Lock, Thread
 from app.core.models import LocalLLM, Embedder, Reranker, GeminiLLM, GeminiEmbed, Wrapper
 from app.core.processor import DocumentProcessor
 from app.core.database import VectorDatabase
-import time
+from app.core.pipeline import IngestionPipeline, StageStats
+from app.core.jobs import JobManager, IngestionJob
+from app.core.upload_store import UploadStore
+from app.core.reranking import CascadeReranker
+import asyncio
 import os
-from app.settings import settings, BASE_DIR
+import time
+from app.settings import settings, BASE_DIR, logging
+
+
+class LazyComponent:
+    """
+    Creates a heavy part of the system (model, db connection) on the first use instead of at start.
+    Concurrent first uses wait for one creation, a failed creation is retried on the next use
+
+    status -> not_loaded, loading, ready or failed
+    """
+
+    def __init__(self, name: str, factory: Callable[[], Any]):
+        self.name: str = name
+        self.factory = factory
+        self.status: str = "not_loaded"
+        self.error: str | None = None
+        self.load_time: float | None = None
+        self._value: Any = None
+        self._lock = Lock()
+
+    def get(self) -> Any:
+        if self.status == "ready":
+            return self._value
+
+        with self._lock:
+            if self.status != "ready":
+                self.status = "loading"
+                start = time.perf_counter()
+                try:
+                    self._value = self.factory()
+                except Exception as e:
+                    self.status, self.error = "failed", str(e)
+                    raise
+                self.load_time = time.perf_counter() - start
+                self.status, self.error = "ready", None
+                logging.info("%s is ready in %.1f s", self.name, self.load_time)
+
+        return self._value
+
+    def readiness(self) -> dict:
+        return {"status": self.status, "load_time": self.load_time, "error": self.error}
 
 
 class RagSystem:
+    """
+    Models and db connection are created lazily, on the first use or by warm_up, so the
+    construction is cheap and routes that do not need them work right after start
+    """
+
     def __init__(self):
-        self.embedder = (
-            GeminiEmbed()
-            if settings.use_gemini
-            else Embedder(model=settings.models.embedder_model)
-        )
-        self.reranker = Reranker(model=settings.models.reranker_model)
-        self.processor = DocumentProcessor(self.embedder)
-        self.db = VectorDatabase(embedder=self.embedder)
-        self.llm = GeminiLLM() if settings.use_gemini else LocalLLM()
-        self.wrapper = Wrapper()
+        self.components: dict[str, LazyComponent] = {
+            component.name: component
+            for component in (
+                LazyComponent(
+                    "embedder",
+                    lambda: GeminiEmbed() if settings.use_gemini else Embedder(model=settings.models.embedder_model),
+                ),
+                LazyComponent("db", lambda: VectorDatabase(embedder=self.embedder)),
+                LazyComponent("processor", lambda: DocumentProcessor(self.embedder)),
+                LazyComponent("reranker", lambda: Reranker(model=settings.models.reranker_model)),
+                LazyComponent("reranking", lambda: CascadeReranker(self.reranker)),
+                LazyComponent("wrapper", Wrapper),
+                LazyComponent("llm", lambda: GeminiLLM() if settings.use_gemini else LocalLLM()),
+            )
+        }
+        self.store = UploadStore()
+        self.jobs = JobManager(run_job=self.upload_documents)
+        self._warm_up_thread: Thread | None = None
+
+    @property
+    def embedder(self) -> Embedder | GeminiEmbed:
+        return self.components["embedder"].get()
+
+    @property
+    def db(self) -> VectorDatabase:
+        return self.components["db"].get()
+
+    @property
+    def processor(self) -> DocumentProcessor:
+        return self.components["processor"].get()
+
+    @property
+    def reranker(self) -> Reranker:
+        return self.components["reranker"].get()
+
+    @property
+    def reranking(self) -> CascadeReranker:
+        return self.components["reranking"].get()
+
+    @property
+    def wrapper(self) -> Wrapper:
+        return self.components["wrapper"].get()
+
+    @property
+    def llm(self) -> GeminiLLM | LocalLLM:
+        return self.components["llm"].get()
+
+    """
+    Creates all components that are not created yet, a failure of one does not stop the others
+    """
+
+    def warm_up(self) -> dict[str, dict]:
+        for component in self.components.values():
+            try:
+                component.get()
+            except Exception as e:
+                logging.error("Error at warm up of %s", component.name, exc_info=e)
+        return self.readiness()
+
+    """
+    Runs warm_up in background, returns False if it is already running
+    """
+
+    def start_warm_up(self) -> bool:
+        if self._warm_up_thread is not None and self._warm_up_thread.is_alive():
+            return False
+
+        self._warm_up_thread = Thread(target=self.warm_up, name="warm-up", daemon=True)
+        self._warm_up_thread.start()
+        return True
+
+    """
+    Stops background jobs and worker processes of the embedding pool, the db is not created for it
+    """
+
+    def shutdown(self) -> None:
+        self.jobs.shutdown()
+        if self.components["db"].status == "ready" and self.db.embedding_pool is not None:
+            self.db.embedding_pool.shutdown()
+
+    def readiness(self) -> dict[str, dict]:
+        return {name: component.readiness() for name, component in self.components.items()}
+
+    def is_ready(self) -> bool:
+        return all(component.status == "ready" for component in self.components.values())
 
     """
     Provides a prompt with substituted context from chunks
@@ -31,7 +157,7 @@ class RagSystem:
 
         relevant_chunks = self.db.search(collection_name, query=enhanced_prompt, top_k=30)
         if relevant_chunks is not None and len(relevant_chunks) > 0:
-            ranks = self.reranker.rank(query=enhanced_prompt, chunks=relevant_chunks)[
+            ranks = self.reranking.rank(query=enhanced_prompt, chunks=relevant_chunks, top_n=5)[
                 : min(5, len(relevant_chunks))
             ]
             relevant_chunks = [relevant_chunks[rank["corpus_id"]] for rank in ranks]
@@ -72,54 +198,32 @@ class RagSystem:
         return self.wrapper.wrap(enhanced_prompt)
 
     """
-    Splits the list of documents into groups with 'split_by' docs (done to avoid qdrant_client connection error handling), loads them,
-    splits into chunks, and saves to db
+    Loads documents, splits them into chunks, and saves to db through the streaming ingestion pipeline.
+    Returns per stage counters (number of items and time spent)
+
+    sources -> maps paths to the names of uploaded files, chunks of a re-uploaded file replace the old ones
+    pipeline -> already constructed pipeline (used by background jobs to read the progress)
     """
 
     def upload_documents(
         self,
         collection_name: str,
         documents: list[str],
-        split_by: int = 3,
         debug_mode: bool = True,
-    ) -> None:
-
-        for i in range(0, len(documents), split_by):
+        sources: dict[str, str] | None = None,
+        pipeline: IngestionPipeline | None = None,
+    ) -> dict[str, StageStats]:
+        if pipeline is None:
+            pipeline = IngestionPipeline(processor=self.processor, db=self.db, store=self.store)
+        stats = pipeline.run(collection_name, documents, sources=sources)
 
-            if debug_mode:
-                print(
-                    "<"
-                    + "-" * 10
-                    + "New document group is taken into processing"
-                    + "-" * 10
-                    + ">"
-                )
+        if debug_mode:
+            for stage in stats.values():
+                logging.info(str(stage))
+            if self.embedder.cache is not None:
+                logging.info("embedding cache: %s", self.embedder.cache.stats())
 
-            docs = documents[i : i + split_by]
-
-            loading_time = 0
-            chunk_generating_time = 0
-            db_saving_time = 0
-
-            print("Start loading the documents")
-            start = time.time()
-            self.processor.load_documents(documents=docs, add_to_unprocessed=True)
-            loading_time = time.time() - start
-
-            print("Start loading chunk generation")
-            start = time.time()
-            self.processor.generate_chunks()
-            chunk_generating_time = time.time() - start
-
-            print("Start saving to db")
-            start = time.time()
-            self.db.store(collection_name, self.processor.get_and_save_unsaved_chunks())
-            db_saving_time = time.time() - start
-
-            if debug_mode:
-                print(
-                    f"loading time = {loading_time}, chunk generation time = {chunk_generating_time}, saving time = {db_saving_time}\n"
-                )
+        return stats
 
     def extract_text(self, response) -> str:
         text = ""
@@ -130,26 +234,52 @@ class RagSystem:
         return text
 
     """
-    Produces answer to user's request. First, finds the most relevant chunks, generates prompt with them, and asks llm
+    Starts the upload in background and returns immediately. Search in the collection keeps
+    working on already stored chunks while the job is running
+    """
+
+    def submit_documents(
+        self,
+        collection_name: str,
+        documents: list[str],
+        owner_id: int | None = None,
+        sources: dict[str, str] | None = None,
+    ) -> IngestionJob:
+        job = IngestionJob(
+            collection_name=collection_name,
+            documents=documents,
+            pipeline=IngestionPipeline(processor=self.processor, db=self.db, store=self.store),
+            owner_id=owner_id,
+            sources=sources,
+        )
+        return self.jobs.submit(job)
+
+    """
+    Produces answer to user's request. First, finds the most relevant chunks, generates prompt with them, and asks llm.
+    Retrieval is blocking (query encoding, db, reranking), so it runs in a thread: the event loop keeps serving
+    other requests, and queries of concurrent requests can be joined into one batch by the embedder. Components
+    are resolved in threads as well, the first use waits until the model is loaded
     """
 
     async def generate_response(
         self, collection_name: str, user_prompt: str, stream: bool = True
     ) -> str:
-        general_prompt = self.get_general_prompt(
-            user_prompt=user_prompt, collection_name=collection_name
+        general_prompt = await asyncio.to_thread(
+            self.get_general_prompt, user_prompt=user_prompt, collection_name=collection_name
         )
 
-        return self.llm.get_response(prompt=general_prompt)
+        llm = await asyncio.to_thread(self.components["llm"].get)
+        return await asyncio.to_thread(llm.get_response, prompt=general_prompt)
 
     async def generate_response_stream(
         self, collection_name: str, user_prompt: str, stream: bool = True
     ) -> AsyncGenerator[Any, Any]:
-        general_prompt = self.get_general_prompt(
-            user_prompt=user_prompt, collection_name=collection_name
+        general_prompt = await asyncio.to_thread(
+            self.get_general_prompt, user_prompt=user_prompt, collection_name=collection_name
         )
 
-        async for chunk in self.llm.get_streaming_response(
+        llm = await asyncio.to_thread(self.components["llm"].get)
+        async for chunk in llm.get_streaming_response(
             prompt=general_prompt, stream=True
         ):
             yield self.extract_text(chunk)
@@ -0,0 +1,28 @@
+from threading import Lock
+import time
+
+
+class RateLimiter:
+    """
+    Spaces calls evenly, so that at most 'per_minute' of them start within a minute. Is shared by
+    threads, every caller waits for its own slot
+
+    per_minute -> 0 or None turns the limit off
+    """
+
+    def __init__(self, per_minute: int | None):
+        self.interval: float = 60 / per_minute if per_minute else 0.0
+        self._next: float = 0.0
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,177 @@
+from collections import OrderedDict
+from threading import Lock
+from app.core.chunks import Chunk
+from app.core.models import Reranker
+from app.settings import settings
+import hashlib
+import math
+import time
+import re
+
+
+class RerankCache:
+    """
+    Bounded cache of cross-encoder scores keyed by (hash of query, id of chunk), the least
+    recently used scores above 'max_entries' are dropped
+    """
+
+    def __init__(self, max_entries: int | None = None):
+        self.max_entries: int = max_entries or settings.reranking.cache_size
+        self._scores: OrderedDict[tuple[str, str], float] = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def query_hash(query: str) -> str:
+        return hashlib.sha256(query.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+    def get(self, key: tuple[str, str]) -> float | None:
+        with self._lock:
+            score = self._scores.get(key)
+            if score is not None:
+                self._scores.move_to_end(key)
+            return score
+
+    def put(self, key: tuple[str, str], score: float) -> None:
+        with self._lock:
+            self._scores[key] = score
+            self._scores.move_to_end(key)
+            while len(self._scores) > self.max_entries:
+                self._scores.popitem(last=False)
+
+
+class RerankMetrics:
+    """
+    Counters of reranking: latency, cross-encoder pairs, cache hits and candidates skipped by
+    the first stage and by the adaptive cut-off
+    """
+
+    def __init__(self):
+        self.requests: int = 0
+        self.candidates: int = 0
+        self.scored: int = 0
+        self.cache_hits: int = 0
+        self.pruned: int = 0
+        self.cut_off: int = 0
+        self.total_time: float = 0.0
+        self.last_time: float = 0.0
+        self._lock = Lock()
+
+    def add(self, candidates: int, scored: int, cache_hits: int, pruned: int, cut_off: int, elapsed: float) -> None:
+        with self._lock:
+            self.requests += 1
+            self.candidates += candidates
+            self.scored += scored
+            self.cache_hits += cache_hits
+            self.pruned += pruned
+            self.cut_off += cut_off
+            self.total_time += elapsed
+            self.last_time = elapsed
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            lookups = self.scored + self.cache_hits
+            return {
+                "requests": self.requests,
+                "candidates": self.candidates,
+                "cross_encoder_pairs": self.scored,
+                "cache_hits": self.cache_hits,
+                "cache_hit_rate": self.cache_hits / lookups if lookups else 0.0,
+                "pruned_by_first_stage": self.pruned,
+                "skipped_by_cut_off": self.cut_off,
+                "average_latency": self.total_time / self.requests if self.requests else 0.0,
+                "last_latency": self.last_time,
+            }
+
+
+"""
+Cheap first stage: scores chunks by the query terms they contain, every term is weighted by its
+rarity among the candidates (idf), so common words matter less
+"""
+
+
+def lexical_scores(query: str, texts: list[str]) -> list[float]:
+    terms = {term for term in re.findall(r"\w+", query.lower()) if len(term) > 1}
+    if not terms:
+        return [0.0] * len(texts)
+
+    found = [terms.intersection(re.findall(r"\w+", text.lower())) for text in texts]
+    frequency = {term: sum(term in chunk_terms for chunk_terms in found) for term in terms}
+
+    return [
+        sum(math.log(1 + len(texts) / frequency[term]) for term in chunk_terms)
+        for chunk_terms in found
+    ]
+
+
+class CascadeReranker:
+    """
+    Reranks candidates of the search in three steps:
+        1. first stage keeps 'first_stage_keep' candidates ranked high by the lexical score or by the
+           search itself (candidates come in the order of dense similarity), so a paraphrase without
+           common words survives as well. Only candidates low in both rankings are not sent to the
+           cross-encoder
+        2. kept candidates are scored by the cross-encoder in batches of 'batch_size', scores are
+           taken from the cache when the same query and chunk were scored before
+        3. scoring stops early when 'top_n' candidates are scored and the best one of the last batch
+           is more than 'score_gap' below the current top_n-th score - the rest ranked lower by the
+           first stage are unlikely to get into the top
+
+    Returns scored candidates in the format of Reranker.rank (sorted by score), unscored ones are dropped
+    """
+
+    def __init__(self, reranker: Reranker, cache: RerankCache | None = None):
+        self.reranker = reranker
+        self.cache = cache or RerankCache()
+        self.metrics = RerankMetrics()
+
+    def rank(self, query: str, chunks: list[Chunk], top_n: int | None = None) -> list[dict]:
+        start = time.perf_counter()
+        config = settings.reranking
+        top_n = top_n or config.top_n
+
+        lexical = lexical_scores(query, [chunk.get_raw_text() for chunk in chunks])
+        lexical_rank = {i: rank for rank, i in enumerate(sorted(range(len(chunks)), key=lambda i: -lexical[i]))}
+        order = sorted(range(len(chunks)), key=lambda i: (min(lexical_rank[i], i), i))  # i is the search rank
+        kept = order[: max(config.first_stage_keep, top_n)]
+
+        query_hash = self.cache.query_hash(query)
+        scores: dict[int, float] = {}
+        scored = cache_hits = 0
+
+        for batch_start in range(0, len(kept), config.batch_size):
+            batch = kept[batch_start : batch_start + config.batch_size]
+            missing = []
+            for i in batch:
+                score = self.cache.get((query_hash, str(chunks[i].id)))
+                if score is None:
+                    missing.append(i)
+                else:
+                    scores[i] = score
+                    cache_hits += 1
+
+            if missing:
+                for rank in self.reranker.rank(query, [chunks[i] for i in missing]):
+                    i = missing[rank["corpus_id"]]
+                    scores[i] = float(rank["score"])
+                    self.cache.put((query_hash, str(chunks[i].id)), scores[i])
+                scored += len(missing)
+
+            if len(scores) >= top_n and batch_start + len(batch) < len(kept):
+                top_score = sorted(scores.values(), reverse=True)[top_n - 1]
+                if max(scores[i] for i in batch) < top_score - config.score_gap:
+                    break
+
+        self.metrics.add(
+            candidates=len(chunks),
+            scored=scored,
+            cache_hits=cache_hits,
+            pruned=len(chunks) - len(kept),
+            cut_off=len(kept) - len(scores),
+            elapsed=time.perf_counter() - start,
+        )
+
+        # sorted is stable, equal scores keep the order of the first stage
+        return [
+            {"corpus_id": i, "score": scores[i]}
+            for i in sorted(scores, key=lambda i: -scores[i])
+        ]
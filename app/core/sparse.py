@@ -0,0 +1,54 @@
+from qdrant_client.models import SparseVector
+from collections import Counter
+from app.settings import settings
+import hashlib
+import re
+
+"""
+Splits text into lowercase words, one-letter words are dropped
+"""
+
+
+def tokenize(text: str) -> list[str]:
+    return [term for term in re.findall(r"\w+", text.lower()) if len(term) > 1]
+
+
+"""
+Maps a term to the dimension of sparse vector, the same term gets the same dimension in every
+process (unlike hash()), so vectors stored before restart still match queries
+"""
+
+
+def term_index(term: str) -> int:
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=4).digest(), "little")
+
+
+"""
+Sparse vector of a chunk: term frequencies saturated and normalized by length like in BM25. The idf part
+is applied by qdrant at search time (collection is created with Modifier.IDF), so weights of stored points
+do not depend on the rest of the collection and do not have to be recomputed when it grows
+"""
+
+
+def sparse_document_vector(text: str) -> SparseVector:
+    config = settings.hybrid_search
+    terms = tokenize(text)
+    frequencies = Counter(term_index(term) for term in terms)
+    length_norm = config.bm25_k1 * (1 - config.bm25_b + config.bm25_b * len(terms) / config.average_length)
+
+    indices = sorted(frequencies)
+    return SparseVector(
+        indices=indices,
+        values=[frequencies[i] * (config.bm25_k1 + 1) / (frequencies[i] + length_norm) for i in indices],
+    )
+
+
+"""
+Sparse vector of a query: every term of the query has weight 1, so the score of a chunk is the sum of
+bm25 weights of the query terms it contains
+"""
+
+
+def sparse_query_vector(text: str) -> SparseVector:
+    indices = sorted({term_index(term) for term in tokenize(text)})
+    return SparseVector(indices=indices, values=[1.0] * len(indices))
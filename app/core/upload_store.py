@@ -0,0 +1,246 @@
+from app.core.chunks import Chunk
+from app.settings import settings
+from threading import Lock
+from typing import Iterator
+from uuid import UUID, uuid4
+import numpy as np
+import hashlib
+import json
+import re
+import os
+
+
+class UploadStore:
+    """
+    Content-addressed storage of uploaded files. Every file is saved once as <digest>.<ext>,
+    where digest is sha256 of its bytes, no matter how many chats it was uploaded into.
+
+    Next to the files the store keeps the result of their ingestion (chunks and vectors) per
+    embedding model, so a repeated upload is copied to the new collection without parsing and
+    embedding:
+        <root>/<digest>.<ext> -> the file itself (its path is used in citations and viewer links)
+        <root>/cache/<digest>/<model_key>/chunks.jsonl -> one chunk per line
+        <root>/cache/<digest>/<model_key>/vectors.f32 -> float32 vectors in the order of chunks
+        <root>/cache/<digest>/<model_key>/meta.json -> written last, marks the cache as complete
+    """
+
+    def __init__(self, root: str | None = None):
+        self.root: str = str(root or settings.upload_store.path)
+        os.makedirs(self.root, exist_ok=True)
+
+    """
+    Vectors of different models (or dimensionalities, or inference backends) are cached separately
+    """
+
+    @staticmethod
+    def model_key(embedder) -> str:
+        name = getattr(embedder, "model_name", type(embedder).__name__)
+        backend = getattr(embedder, "backend", None)
+        key = f"{name}-{embedder.get_vector_dimensionality()}" + (f"-{backend}" if backend else "")
+        return key.replace("/", "_")
+
+    @staticmethod
+    def new_hash():
+        return hashlib.sha256()
+
+    def path_for(self, digest: str, filename: str) -> str:
+        return os.path.join(self.root, f"{digest}.{filename.split('.')[-1].lower()}")
+
+    """
+    Returns the path of the stored file by its name (<digest>.<ext>), None for anything else, e.g. the
+    cache next to the files
+    """
+
+    def file_path(self, name: str) -> str | None:
+        if re.fullmatch(r"[0-9a-f]{64}\.\w+", name) is None:
+            return None
+        path = os.path.join(self.root, name)
+        return path if os.path.isfile(path) else None
+
+    def temp_path(self) -> str:
+        return os.path.join(self.root, f".{uuid4().hex}.part")
+
+    """
+    Moves fully written temporary file to its content address. If the same content is already
+    stored, the temporary file is removed
+    """
+
+    def commit_file(self, temp_path: str, digest: str, filename: str) -> str:
+        path = self.path_for(digest, filename)
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, path)
+        return path
+
+    """
+    Returns the digest for the file that lives in the store, None for any other path
+    """
+
+    def digest_of(self, path: str) -> str | None:
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.root):
+            return None
+        return os.path.basename(path).split(".")[0]
+
+    def _cache_dir(self, digest: str, model_key: str) -> str:
+        return os.path.join(self.root, "cache", digest, model_key)
+
+    def has_cache(self, path: str, model_key: str) -> bool:
+        digest = self.digest_of(path)
+        if digest is None:
+            return False
+        return os.path.exists(os.path.join(self._cache_dir(digest, model_key), "meta.json"))
+
+    """
+    Reads cached chunks and vectors of the file in batches, without loading the whole cache
+    """
+
+    def read_cache(
+        self, path: str, model_key: str, batch_size: int = 256
+    ) -> Iterator[tuple[list[Chunk], list[list[float]]]]:
+        cache_dir = self._cache_dir(self.digest_of(path), model_key)
+        with open(os.path.join(cache_dir, "meta.json")) as f:
+            meta = json.load(f)
+
+        if meta["count"] == 0:
+            return
+
+        vectors = np.memmap(
+            os.path.join(cache_dir, "vectors.f32"),
+            dtype=np.float32,
+            mode="r",
+            shape=(meta["count"], meta["dimensionality"]),
+        )
+
+        batch: list[Chunk] = []
+        offset = 0
+        with open(os.path.join(cache_dir, "chunks.jsonl"), encoding="utf-8") as f:
+            for line in f:
+                batch.append(self._chunk_from_dict(json.loads(line), path))
+                if len(batch) == batch_size:
+                    yield batch, vectors[offset : offset + len(batch)].tolist()
+                    offset += len(batch)
+                    batch = []
+
+        if batch:
+            yield batch, vectors[offset : offset + len(batch)].tolist()
+
+    def writer(self, model_key: str) -> "CacheWriter":
+        return CacheWriter(self, model_key)
+
+    @staticmethod
+    def _chunk_from_dict(data: dict, path: str) -> Chunk:
+        return Chunk(
+            id=UUID(data["id"]),
+            filename=path,
+            page_number=data["page_number"],
+            start_index=data["start_index"],
+            start_line=data["start_line"],
+            end_line=data["end_line"],
+            text=data["text"],
+        )
+
+
+class CacheWriter:
+    """
+    Collects chunks and vectors produced during ingestion, appending them straight to temporary
+    files grouped by source file. Caches become visible only after commit
+    """
+
+    def __init__(self, store: UploadStore, model_key: str):
+        self.store = store
+        self.model_key = model_key
+        self._parts: dict[str, dict] = {}
+        self._excluded: set[str] = set()
+        self._lock = Lock()  # exclude and append are called from different pipeline stages
+
+    """
+    Stops caching of the file, e.g. when only a part of its chunks goes through the pipeline
+    """
+
+    def exclude(self, path: str) -> None:
+        digest = self.store.digest_of(path)
+        if digest is None:
+            return
+
+        with self._lock:
+            self._excluded.add(digest)
+            part = self._parts.pop(digest, None)
+            if part is not None:
+                self._remove(part)
+
+    def append(self, chunks: list[Chunk], vectors) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        with self._lock:
+            self._append(chunks, vectors)
+
+    def _append(self, chunks: list[Chunk], vectors: np.ndarray) -> None:
+        for chunk, vector in zip(chunks, vectors):
+            digest = self.store.digest_of(chunk.filename)
+            if digest is None or digest in self._excluded:
+                continue
+
+            part = self._parts.get(digest)
+            if part is None:
+                cache_dir = self.store._cache_dir(digest, self.model_key)
+                os.makedirs(cache_dir, exist_ok=True)
+                suffix = uuid4().hex
+                part = {
+                    "dir": cache_dir,
+                    "suffix": suffix,
+                    "chunks": open(os.path.join(cache_dir, f"chunks.jsonl.{suffix}"), "w", encoding="utf-8"),
+                    "vectors": open(os.path.join(cache_dir, f"vectors.f32.{suffix}"), "wb"),
+                    "count": 0,
+                    "dimensionality": vector.shape[0],
+                }
+                self._parts[digest] = part
+
+            metadata = chunk.get_metadata()
+            metadata.update(id=str(chunk.id), text=chunk.get_raw_text())
+            metadata.pop("filename")
+            part["chunks"].write(json.dumps(metadata, ensure_ascii=False) + "\n")
+            part["vectors"].write(vector.tobytes())
+            part["count"] += 1
+
+    """
+    Publishes written caches. If another ingestion of the same file has already finished, its
+    cache is kept and ours is removed
+    """
+
+    def commit(self) -> None:
+        for part in self._parts.values():
+            if os.path.exists(os.path.join(part["dir"], "meta.json")):
+                self._remove(part)
+                continue
+
+            self._close(part)
+            os.replace(
+                os.path.join(part["dir"], f"chunks.jsonl.{part['suffix']}"),
+                os.path.join(part["dir"], "chunks.jsonl"),
+            )
+            os.replace(
+                os.path.join(part["dir"], f"vectors.f32.{part['suffix']}"),
+                os.path.join(part["dir"], "vectors.f32"),
+            )
+            with open(os.path.join(part["dir"], "meta.json"), "w") as f:
+                json.dump({"count": part["count"], "dimensionality": int(part["dimensionality"])}, f)
+        self._parts = {}
+
+    def discard(self) -> None:
+        for part in self._parts.values():
+            self._remove(part)
+        self._parts = {}
+
+    def _remove(self, part: dict) -> None:
+        self._close(part)
+        for name in ("chunks.jsonl", "vectors.f32"):
+            try:
+                os.remove(os.path.join(part["dir"], f"{name}.{part['suffix']}"))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _close(part: dict) -> None:
+        part["chunks"].close()
+        part["vectors"].close()
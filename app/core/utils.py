@@ -1,14 +1,20 @@
 from fastapi.templating import Jinja2Templates
-from fastapi import Request, UploadFile
+from fastapi import Request, UploadFile, HTTPException
+from fastapi.concurrency import run_in_threadpool
 
 from app.backend.controllers.chats import list_user_chats, verify_ownership_rights
 from app.backend.controllers.users import get_current_user
 from app.backend.models.users import User
 from app.core.rag_generator import RagSystem
-from app.settings import BASE_DIR
+from app.core.jobs import IngestionJob
+from app.core.upload_store import UploadStore
+from app.settings import settings
 
-from uuid import uuid4
+from typing import AsyncGenerator, BinaryIO
+import asyncio
 import markdown
+import posixpath
+import json
 import os
 
 rag = None
@@ -64,47 +70,113 @@ def protect_chat(user: User, chat_id: int) -> bool:
     return verify_ownership_rights(user, chat_id)
 
 
+"""
+Writes uploaded file to the content-addressed store block by block, hashing it and checking its size
+on the fly. Disk writes and hashing run in the thread pool, so the event loop is never blocked, and
+only one block of the file is kept in memory. Returns the path of the stored file, identical files
+uploaded into different chats share the same path
+"""
+
+
+async def save_to_store(file: UploadFile, store: UploadStore) -> str:
+    digest = store.new_hash()
+    temp_path = store.temp_path()
+    size = 0
+
+    f = await run_in_threadpool(open, temp_path, "wb")
+    try:
+        while content := await file.read(settings.upload_store.read_size):
+            size += len(content)
+            if size > settings.upload_store.max_file_size:
+                raise HTTPException(
+                    413, f"File {file.filename} is larger than {settings.upload_store.max_file_size} bytes"
+                )
+            await run_in_threadpool(write_block, f, digest, content)
+    except BaseException:
+        f.close()
+        os.remove(temp_path)
+        raise
+
+    await run_in_threadpool(f.close)
+    return await run_in_threadpool(store.commit_file, temp_path, digest.hexdigest(), file.filename)
+
+
+def write_block(f: BinaryIO, digest, content: bytes) -> None:
+    digest.update(content)
+    f.write(content)
+
+
+"""
+Returns the source of uploaded file: its path as the client sent it (folders included), normalized and
+without '..', so files with the same name from different folders are different sources, while the next
+upload of the same path into the chat is a new version of the source
+"""
+
+
+def source_name(filename: str) -> str:
+    return posixpath.normpath("/" + filename.replace("\\", "/")).lstrip("/")
+
+
+"""
+Saves uploaded files to the upload store (several files at the same time) and starts their ingestion
+in background. Returns the ingestion job (None if nothing was uploaded)
+"""
+
+
 async def save_documents(
     collection_name: str,
     files: list[UploadFile],
     RAG: RagSystem,
     user: User,
     chat_id: int,
-) -> None:
-    storage = os.path.join(
-        BASE_DIR,
-        "chats_storage",
-        f"user_id={user.id}",
-        f"chat_id={chat_id}",
-        "documents",
-    )
-    docs = []
+) -> IngestionJob | None:
+    sources: dict[str, str] = {}  # path in the store -> source (path of uploaded file in the chat)
+    paths: dict[str, str] = {}  # source -> path in the store
 
     if files is None or len(files) == 0:
-        return
+        return None
 
-    os.makedirs(os.path.join(storage, "pdfs"), exist_ok=True)
+    semaphore = asyncio.Semaphore(settings.upload_store.concurrent_writes)
 
-    for file in files:
-        content = await file.read()
+    async def save(file: UploadFile) -> str:
+        async with semaphore:
+            return await save_to_store(file, RAG.store)
 
-        if file.filename.endswith(".pdf"):
-            saved_file = os.path.join(storage, "pdfs", str(uuid4()) + ".pdf")
-        else:
-            saved_file = os.path.join(
-                storage, str(uuid4()) + "." + file.filename.split(".")[-1]
-            )
+    saved_files = await asyncio.gather(*(save(file) for file in files), return_exceptions=True)
+    for saved_file in saved_files:
+        if isinstance(saved_file, BaseException):
+            raise saved_file
 
-        with open(saved_file, "wb") as f:
-            f.write(content)
+    for file, saved_file in zip(files, saved_files):
+        source = source_name(file.filename)
+        if paths.setdefault(source, saved_file) != saved_file:
+            raise HTTPException(400, f"Several different files are uploaded as {source}")
+        sources.setdefault(saved_file, source)  # the same file twice in one upload is ingested once
+
+    # the first upload creates the processor and the db (loads the embedder), which must not block the event loop
+    return await run_in_threadpool(
+        RAG.submit_documents, collection_name, list(sources), owner_id=user.id, sources=sources
+    )
 
-        docs.append(saved_file)
 
-    if len(files) > 0:
-        RAG.upload_documents(collection_name, docs)
+"""
+Yields server-sent events with the progress of ingestion job until it is finished
+"""
+
+
+async def job_progress_events(job: IngestionJob) -> AsyncGenerator[str, None]:
+    while True:
+        progress = job.get_progress()
+        yield f"data: {json.dumps(progress)}\n\n"
+        if job.finished:
+            break
+        await asyncio.sleep(settings.ingestion.progress_interval)
 
 
 def get_pdf_path(path: str) -> str:
+    if os.path.dirname(os.path.abspath(path)) == os.path.abspath(settings.upload_store.path):
+        return "documents/" + os.path.basename(path)  # the upload store is served only by /documents
+
     parts = path.split("chats_storage")
     if len(parts) < 2:
         return ""
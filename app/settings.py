@@ -28,6 +28,23 @@ class QdrantSettings(BaseModel):
 class ModelsSettings(BaseModel):
     embedder_model: str = "all-MiniLM-L6-v2"
     reranker_model: str = "cross-encoder/ms-marco-MiniLM-L6-v2"
+    backend: str = "torch"  # Inference backend of local embedder and reranker: torch or onnx (needs sentence-transformers[onnx])
+    quantize: bool = False  # Use ONNX model with dynamic int8 quantization, only for onnx backend
+    quantization_config: str = "avx512_vnni"  # Target of quantization: arm64, avx2, avx512 or avx512_vnni
+    onnx_path: Path = BASE_DIR / "models_cache" / "onnx"  # Where quantized models are exported
+
+
+class BatchingSettings(BaseModel):
+    token_budget: int = 8192  # Padded tokens in one batch of local Embedder and Reranker (batch size * longest input)
+    max_batch_size: int = 128  # Batches of short inputs are not larger than this
+
+
+class RerankingSettings(BaseModel):
+    cache_size: int = 10_000  # Cross-encoder scores of (query, chunk) pairs kept in memory
+    first_stage_keep: int = 20  # Candidates ranked best by lexical score or by search sent to the cross-encoder
+    batch_size: int = 8  # Candidates scored by the cross-encoder at once
+    top_n: int = 5  # The number of best candidates needed by the prompt
+    score_gap: float = 3.0  # Stop scoring when the last batch is this far below the top_n-th score
 
 
 class LocalLLMSettings(BaseModel):
@@ -59,6 +76,73 @@ class TextSplitterSettings(BaseModel):
     add_start_index: bool = True
 
 
+class ProcessorSettings(BaseModel):
+    parallel_loading: bool = True  # Parse files of one upload in a pool of processes
+    loading_workers: int = Field(
+        default_factory=lambda: os.cpu_count() or 1
+    )  # The maximum number of processes used for parsing
+    pdf_pages_per_task: int = 8  # Pages of pdf are extracted by ranges of this size in parallel
+    pack_csv_rows: bool = True  # Pack csv rows into chunks instead of making a document of every row
+    text_window_size: int = 4 * 1024 * 1024  # Bytes of txt/json/md decoded at once
+
+
+class IngestionSettings(BaseModel):
+    queue_size: int = 8  # The capacity of queues between the stages of ingestion pipeline
+    embedding_batch_size: int = 256  # The number of chunks encoded with one embedder call
+    job_workers: int = 2  # The number of uploads processed in background at the same time
+    max_kept_jobs: int = 100  # Finished jobs above this number are forgotten
+    progress_interval: float = 0.5  # Seconds between two progress events of a job
+
+
+class UploadStoreSettings(BaseModel):
+    path: Path = BASE_DIR / "upload_store"  # Content-addressed storage of uploaded files, outside of served chats_storage
+    read_size: int = 1024 * 1024  # The number of bytes read from upload at once
+    max_file_size: int = 200 * 1024 * 1024  # Larger uploads are rejected with 413
+    concurrent_writes: int = 4  # The number of files of one upload written at the same time
+
+
+class EmbeddingCacheSettings(BaseModel):
+    enabled: bool = True  # Take vectors of texts encoded before from the cache instead of the model
+    path: Path = BASE_DIR / "cache" / "embeddings.sqlite3"  # Outside of served chats_storage, vectors leak the texts
+    max_entries: int = 200_000  # The least recently used vectors above this number are evicted
+
+
+class MicroBatchingSettings(BaseModel):
+    enabled: bool = True  # Join small encode requests of concurrent callers of local Embedder
+    max_batch_size: int = 64  # The batch is sent as soon as it has this number of texts
+    max_wait: float = 0.005  # Seconds the first request of a batch waits for others
+
+
+class EmbeddingPoolSettings(BaseModel):
+    enabled: bool = True  # Encode large stores with a pool of processes (local embedder on cpu only)
+    min_chunks: int = 2048  # Smaller stores are encoded in the current process
+    workers: int = 0  # The number of worker processes, 0 -> available cores // cores_per_worker
+    cores_per_worker: int = 4  # Every worker is pinned to this number of cores
+    shard_size: int = 256  # The number of texts sent to a worker at once
+
+
+class DedupeIndexSettings(BaseModel):
+    enabled: bool = True  # Check near-duplicates at ingestion with in-process index instead of db queries
+    max_points: int = 50_000  # Larger collections are checked with db queries
+    max_collections: int = 4  # Indexes of the least recently used collections above this number are dropped
+    build_ratio: float = 0.2  # Build an index once the vectors checked with db queries reach this share of the collection
+    vector_signatures: bool = True  # Random projections of vectors in addition to MinHash of text
+    vector_bands: int = 16
+    vector_band_bits: int = 8
+    minhash_bands: int = 16
+    minhash_band_rows: int = 4
+    seed: int = 5
+
+
+class HybridSearchSettings(BaseModel):
+    enabled: bool = True  # New collections store sparse (bm25) vectors, their search fuses dense and sparse results
+    sparse_vector_name: str = "sparse"
+    prefetch_multiplier: int = 2  # Every sub-query of the fusion returns this many times more candidates than needed
+    bm25_k1: float = 1.2  # Saturation of term frequency
+    bm25_b: float = 0.75  # Strength of length normalization
+    average_length: float = 150.0  # Average number of terms in a chunk (~1000 characters)
+
+
 class APISettings(BaseModel):
     app: str = "app.api.api:api"
     host: str = "127.0.0.1"
@@ -83,6 +167,14 @@ class GeminiEmbeddingSettings(BaseModel):
     task_type: str = "retrieval_document"
 
 
+class GeminiEmbeddingRequestsSettings(BaseModel):
+    concurrency: int = 4  # The number of embedding batches in flight at the same time
+    requests_per_minute: int = 1500  # 0 turns the limit off
+    max_retries: int = 5  # Throttled (429) or unavailable (500, 503) batches are retried this number of times
+    backoff: float = 1.0  # Seconds before the first retry, doubled for every next one
+    max_backoff: float = 30.0
+
+
 class GeminiWrapperSettings(BaseModel):
     temperature: float = 0.0
     top_p: float = 0.95
@@ -111,13 +203,26 @@ class Settings(BaseSettings):
     qdrant: QdrantSettings = Field(default_factory=QdrantSettings)
     local_llm: LocalLLMSettings = Field(default_factory=LocalLLMSettings)
     models: ModelsSettings = Field(default_factory=ModelsSettings)
+    batching: BatchingSettings = Field(default_factory=BatchingSettings)
+    reranking: RerankingSettings = Field(default_factory=RerankingSettings)
     local_generation: GenerationSettings = Field(default_factory=GenerationSettings)
     text_splitter: TextSplitterSettings = Field(default_factory=TextSplitterSettings)
+    processor: ProcessorSettings = Field(default_factory=ProcessorSettings)
+    ingestion: IngestionSettings = Field(default_factory=IngestionSettings)
+    upload_store: UploadStoreSettings = Field(default_factory=UploadStoreSettings)
+    embedding_cache: EmbeddingCacheSettings = Field(default_factory=EmbeddingCacheSettings)
+    micro_batching: MicroBatchingSettings = Field(default_factory=MicroBatchingSettings)
+    embedding_pool: EmbeddingPoolSettings = Field(default_factory=EmbeddingPoolSettings)
+    dedupe_index: DedupeIndexSettings = Field(default_factory=DedupeIndexSettings)
+    hybrid_search: HybridSearchSettings = Field(default_factory=HybridSearchSettings)
     api: APISettings = Field(default_factory=APISettings)
     gemini_generation: GeminiSettings = Field(default_factory=GeminiSettings)
     gemini_embedding: GeminiEmbeddingSettings = Field(
         default_factory=GeminiEmbeddingSettings
     )
+    gemini_embedding_requests: GeminiEmbeddingRequestsSettings = Field(
+        default_factory=GeminiEmbeddingRequestsSettings
+    )
     gemini_wrapper: GeminiWrapperSettings = Field(
         default_factory=GeminiWrapperSettings
     )
@@ -136,6 +241,7 @@ class Settings(BaseSettings):
     base_dir: Path = BASE_DIR
 
     stream: bool = True
+    warm_up_on_start: bool = True  # Load models in background right after start instead of on the first use
 
     secret_pepper: str = os.environ["SECRET_PEPPER"]
     jwt_algorithm: str = os.environ["JWT_ALGORITHM"].replace("\r", "")
@@ -252,4 +358,4 @@ if __name__ == "__main__":
 #
 # max_cookie_lifetime = 3000  # in seconds
 #
-url_user_not_required = ["login", "", "viewer", "message_with_docs", "new_user", "health"]
+url_user_not_required = ["login", "", "viewer", "message_with_docs", "new_user", "health", "ready"]
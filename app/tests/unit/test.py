@@ -1,7 +1,8 @@
+import os
 import pytest
 from unittest.mock import MagicMock
 from app.backend.schemas import SUser
-from app.core.utils import construct_collection_name, get_pdf_path, lines_to_markdown, protect_chat, extend_context
+from app.core.utils import construct_collection_name, get_pdf_path, lines_to_markdown, protect_chat, extend_context, source_name
 from app.backend.models.users import User
 
 
@@ -63,6 +64,19 @@ def test_get_pdf_path():
     path_without = "/app/some_other_path/file.pdf"
     assert get_pdf_path(path_without) == ""
 
+    # Case 3: File of the upload store is served by /documents
+    from app.settings import settings
+
+    stored = os.path.join(settings.upload_store.path, "ab" * 32 + ".pdf")
+    assert get_pdf_path(stored) == "documents/" + "ab" * 32 + ".pdf"
+
+
+# Tests source_name keeps folders of uploaded files and drops '..' and backslashes.
+def test_source_name():
+    assert source_name("report.pdf") == "report.pdf"
+    assert source_name("docs\\2024/./report.pdf") == "docs/2024/report.pdf"
+    assert source_name("../../etc/passwd") == "etc/passwd"
+
 
 # Tests lines_to_markdown converts text lines to HTML correctly.
 def test_lines_to_markdown():
@@ -108,3 +122,1148 @@ def test_extend_context(monkeypatch):
     assert result_without_user["navbar_context"]["user"]["role"] == "guest"
     assert result_without_user["navbar_context"]["user"]["instance"] is None
     assert result_without_user["sidebar_context"]["chat_groups"] == []
+
+
+# Tests for app/core/processor
+
+# Tests load_documents keeps the order of paths and skips files that failed to load.
+def test_load_documents_order(monkeypatch):
+    from app.core.processor import DocumentProcessor, IngestionSession
+    from langchain_core.documents import Document
+
+    def fake_extract(filepath):
+        if filepath == "broken.txt":
+            raise RuntimeError("File is corrupted")
+        return [Document(page_content=filepath, metadata={"source": filepath})]
+
+    monkeypatch.setattr("app.core.processor.extract_documents", fake_extract)
+    processor = DocumentProcessor(embedder=None)
+    session = IngestionSession()
+    result = processor.load_documents(["a.txt", "broken.txt", "b.txt"], session=session, workers=1)
+    assert [doc.page_content for doc in result] == ["a.txt", "b.txt"]
+    assert session.unprocessed == result
+
+
+# Tests sessions do not share state and unsaved chunks are returned only once.
+def test_ingestion_session(monkeypatch):
+    from app.core.processor import DocumentProcessor, IngestionSession
+    from langchain_core.documents import Document
+
+    monkeypatch.setattr(
+        "app.core.processor.extract_documents",
+        lambda filepath: [Document(page_content="line one\nline two", metadata={"source": filepath})],
+    )
+    processor = DocumentProcessor(embedder=None)
+    first, second = IngestionSession(), IngestionSession()
+
+    processor.load_document("a.txt", session=first)
+    processor.generate_chunks(first)
+    assert second.unprocessed == [] and second.chunks == []
+    assert len(first.get_and_save_unsaved_chunks()) == 1
+    assert first.get_and_save_unsaved_chunks() == []
+
+    processor.load_document("b.txt", session=first)
+    processor.generate_chunks(first)
+    assert [chunk.filename for chunk in first.get_and_save_unsaved_chunks()] == ["b.txt"]
+    assert len(first.get_all_chunks()) == 2
+
+
+# Tests for app/core/jobs
+
+# Tests JobManager runs the job in background and reports failures through the job status.
+def test_job_manager_status():
+    from app.core.jobs import JobManager, IngestionJob, JobStatus
+    from app.core.pipeline import StageStats
+
+    pipeline = MagicMock()
+    pipeline.files_loaded = 0
+    pipeline.stats = {name: StageStats(name) for name in ("loader", "splitter", "embedder", "upserter")}
+
+    def run_job(collection_name, documents, sources, pipeline):
+        pipeline.files_loaded = len(documents)
+        pipeline.stats["upserter"].add(3, 0.1)
+        if collection_name == "broken":
+            raise RuntimeError("Qdrant is down")
+
+    manager = JobManager(run_job=run_job, workers=1)
+    done = manager.submit(IngestionJob("collection", ["a.txt", "b.txt"], pipeline, owner_id=1))
+    failed = manager.submit(IngestionJob("broken", ["c.txt"], pipeline, owner_id=1))
+    manager.executor.shutdown(wait=True)
+
+    assert manager.get(done.id).status == JobStatus.DONE
+    assert manager.get(failed.id).status == JobStatus.FAILED
+    assert failed.get_progress()["error"] == "Qdrant is down"
+    assert done.get_progress()["points_upserted"] == 6
+
+
+# Tests IngestionJob.wait returns once the job is finished, failed jobs do not raise.
+async def test_job_wait():
+    import time
+    from app.core.jobs import JobManager, IngestionJob, JobStatus
+
+    def run_job(collection_name, documents, sources, pipeline):
+        time.sleep(0.05)
+        if collection_name == "broken":
+            raise RuntimeError("Qdrant is down")
+
+    manager = JobManager(run_job=run_job, workers=2)
+    done = manager.submit(IngestionJob("collection", ["a.txt"], MagicMock(), owner_id=1))
+    failed = manager.submit(IngestionJob("broken", ["b.txt"], MagicMock(), owner_id=1))
+
+    await done.wait()
+    await failed.wait()
+    assert done.status == JobStatus.DONE
+    assert failed.status == JobStatus.FAILED and failed.error == "Qdrant is down"
+
+
+# Tests for app/core/pipeline
+
+# Fake db for pipeline tests: keeps metadata of stored points in db.points, texts are appended to 'stored' in the
+# order of upserts.
+def make_pipeline_db(stored: list):
+    from app.core.database import VectorDatabase
+
+    db = MagicMock()
+    db.embedding_pool = None
+    db.points = {}
+    db.embedder.cache = None
+    db.embedder.encode.side_effect = lambda texts: [[float(len(text)), 1.0] for text in texts]
+    db.encode_bulk.side_effect = lambda texts: VectorDatabase.encode_bulk(db, texts)
+    db.diff_source.side_effect = VectorDatabase.diff_source
+    db.get_source_points.side_effect = lambda collection_name, source: {
+        point_id: metadata for point_id, metadata in db.points.items() if metadata["source"] == source
+    }
+
+    def store_vectors(collection_name, chunks, vectors, exclude=None):
+        stored.extend(chunk.get_raw_text() for chunk in chunks)
+        db.points.update((str(chunk.id), chunk.get_metadata()) for chunk in chunks)
+        return len(chunks)
+
+    def delete_points(collection_name, ids):
+        for point_id in ids:
+            db.points.pop(point_id, None)
+
+    def update_payloads(collection_name, operations):
+        for operation in operations:
+            for point_id in operation.set_payload.points:
+                db.points[point_id] = operation.set_payload.payload["metadata"]
+
+    db.store_vectors.side_effect = store_vectors
+    db.delete_points.side_effect = delete_points
+    db.update_payloads.side_effect = update_payloads
+    return db
+
+
+# Fake processor for pipeline tests: every line of a document is a chunk.
+def make_pipeline_processor():
+    from uuid import uuid4
+    from app.core.chunks import Chunk
+
+    processor = MagicMock()
+    processor.split_document.side_effect = lambda document: [
+        Chunk(uuid4(), document.metadata["source"], 0, 0, i + 1, i + 1, line)
+        for i, line in enumerate(document.page_content.splitlines())
+    ]
+    return processor
+
+
+# Tests IngestionPipeline stores chunks of all files in order and counts items of every stage.
+def test_ingestion_pipeline_order(tmp_path, monkeypatch):
+    from app.core.pipeline import IngestionPipeline
+    from app.settings import settings
+
+    monkeypatch.setattr(settings.processor, "text_window_size", 16)  # several documents per file
+    paths = []
+    for name in ("a", "b"):
+        paths.append(str(tmp_path / f"{name}.txt"))
+        with open(paths[-1], "w") as f:
+            f.write("".join(f"{name} line {i}\n" for i in range(10)))
+
+    stored = []
+    pipeline = IngestionPipeline(make_pipeline_processor(), make_pipeline_db(stored), queue_size=2, batch_size=3, workers=1)
+    stats = pipeline.run("collection", paths)
+
+    assert stored == [f"{name} line {i}" for name in ("a", "b") for i in range(10)]
+    assert stats["loader"].items == 20  # one line fits into a window
+    assert stats["splitter"].items == stats["embedder"].items == stats["upserter"].items == 20
+    assert pipeline.files_loaded == 2
+
+
+# Tests the pipeline gathers batches up to min_chunks of the embedding pool and encodes them in the pool.
+def test_ingestion_pipeline_embedding_pool(tmp_path, monkeypatch):
+    from app.core.pipeline import IngestionPipeline
+    from app.settings import settings
+
+    monkeypatch.setattr(settings.embedding_pool, "min_chunks", 8)
+    paths = []
+    for name in ("a", "b"):
+        paths.append(str(tmp_path / f"{name}.txt"))
+        with open(paths[-1], "w") as f:
+            f.write("".join(f"{name} line {i}\n" for i in range(10)))
+
+    stored = []
+    db = make_pipeline_db(stored)
+    db.embedding_pool = MagicMock()
+    db.embedding_pool.encode.side_effect = lambda texts: [[float(len(text)), 1.0] for text in texts]
+    IngestionPipeline(make_pipeline_processor(), db, batch_size=3, workers=1).run("collection", paths)
+
+    assert stored == [f"{name} line {i}" for name in ("a", "b") for i in range(10)]
+    assert [len(call.args[0]) for call in db.embedding_pool.encode.call_args_list] == [8, 8]
+    assert [len(call.args[0]) for call in db.embedder.encode.call_args_list] == [4]  # the rest is too small
+
+
+# Tests the pipeline parses files in processes that are not forked from the server process.
+def test_ingestion_pipeline_parsing_processes(tmp_path, monkeypatch):
+    from concurrent.futures import Future
+    from langchain_core.documents import Document
+    from app.core.pipeline import IngestionPipeline
+
+    contexts = []
+
+    class FakeExecutor:  # runs tasks right away, records the start method
+        def __init__(self, max_workers, mp_context):
+            contexts.append(mp_context)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def submit(self, function, *args):
+            future = Future()
+            future.set_result(function(*args))
+            return future
+
+    monkeypatch.setattr("app.core.pipeline.ProcessPoolExecutor", FakeExecutor)
+    monkeypatch.setattr(
+        "app.core.pipeline.extract_documents",
+        lambda path: [Document(page_content=f"{path} text", metadata={"source": path})],
+    )
+    paths = [str(tmp_path / "a.log"), str(tmp_path / "b.log")]
+
+    stored = []
+    IngestionPipeline(make_pipeline_processor(), make_pipeline_db(stored), workers=2).run("collection", paths)
+    assert stored == [f"{path} text" for path in paths]
+    assert len(contexts) == 1 and contexts[0].get_start_method() in ("forkserver", "spawn")
+
+
+# Tests a re-uploaded file stores only new chunks and deletes the gone ones after them, a failed re-upload keeps
+# the old version, and two files with the same source in one upload are rejected.
+def test_ingestion_pipeline_reupload(tmp_path):
+    from app.core.pipeline import IngestionPipeline
+
+    path = str(tmp_path / "a.txt")
+    sources = {path: "docs/a.txt"}
+
+    def upload(lines, db, stored, **kwargs):
+        with open(path, "w") as f:
+            f.write("".join(f"{line}\n" for line in lines))
+        IngestionPipeline(make_pipeline_processor(), db, batch_size=2, workers=1, **kwargs).run("collection", [path], sources)
+
+    stored = []
+    db = make_pipeline_db(stored)
+    upload([f"line {i}" for i in range(6)], db, stored)
+    first_version = set(db.points)
+
+    stored.clear()
+    db.embedder.encode.side_effect = RuntimeError("embedder failed")
+    with pytest.raises(RuntimeError):
+        upload(["new line", "line 0", "line 1"], db, stored)
+    assert set(db.points) == first_version and stored == []
+
+    db.embedder.encode.side_effect = lambda texts: [[float(len(text)), 1.0] for text in texts]
+    upload(["new line", "line 0", "line 1"], db, stored)
+    assert stored == ["new line"]
+    assert sorted(metadata["start_line"] for metadata in db.points.values()) == [1, 2, 3]
+    calls = [call[0] for call in db.mock_calls][::-1]
+    assert calls.index("delete_points") < calls.index("store_vectors")  # the last delete is after the last upsert
+
+    with pytest.raises(ValueError, match="docs/a.txt"):
+        IngestionPipeline(make_pipeline_processor(), db, workers=1).run(
+            "collection", [path, str(tmp_path / "b.txt")], {path: "docs/a.txt", str(tmp_path / "b.txt"): "docs/a.txt"}
+        )
+
+
+# Tests an edited chunk of a re-uploaded file is stored, it is not rejected as a near-duplicate of the text it replaces.
+@pytest.mark.parametrize("use_index", [True, False])
+def test_ingestion_pipeline_edited_chunk(tmp_path, monkeypatch, use_index):
+    import threading
+    from collections import OrderedDict
+    from types import SimpleNamespace
+    from qdrant_client import QdrantClient
+    from app.core.database import VectorDatabase
+    from app.core.pipeline import IngestionPipeline
+    from app.settings import settings
+
+    monkeypatch.setattr(settings.dedupe_index, "enabled", use_index)
+    words = ["alpha", "beta", "gamma", "edited"]
+
+    def encode(texts):
+        return [[1.0 if word in text.split() else 0.0 for word in words[:3]] + [0.1 * ("edited" in text)] for text in texts]
+
+    db = VectorDatabase.__new__(VectorDatabase)
+    db.client = QdrantClient(":memory:")
+    db.embedder = SimpleNamespace(get_vector_dimensionality=lambda: 4, encode=encode, cache=None)
+    db.embedding_pool = None
+    db.sparse_collections = {}
+    db.dedupe_indexes, db._dedupe_lock, db._dedupe_locks, db._dedupe_checked = OrderedDict(), threading.Lock(), {}, {}
+    db.create_collection("collection")
+
+    path = str(tmp_path / "a.txt")
+    for lines in (["alpha one", "beta two", "gamma three"], ["alpha one", "beta two edited", "gamma three"]):
+        with open(path, "w") as f:
+            f.write("".join(f"{line}\n" for line in lines))
+        IngestionPipeline(make_pipeline_processor(), db, workers=1).run("collection", [path], {path: "docs/a.txt"})
+
+    records, _ = db.client.scroll("collection", limit=10, with_payload=["text"])
+    assert sorted(record.payload["text"] for record in records) == ["alpha one", "beta two edited", "gamma three"]
+
+
+# Tests points of a file whose later page range failed are deleted (the old version is kept), and points of files
+# in work are deleted when the pipeline fails.
+def test_ingestion_pipeline_partial_failure(tmp_path, monkeypatch):
+    from langchain_core.documents import Document
+    from app.core.pipeline import IngestionPipeline, _LoadingTask
+
+    path, other = str(tmp_path / "a.pdf"), str(tmp_path / "b.pdf")
+    versions = {path: ["page one\npage two", "page three"], other: ["other page"]}
+    ranges = {path: 3, other: 1}
+
+    def extract(filepath, page):
+        if page >= len(versions[filepath]):
+            raise RuntimeError("broken page range")
+        return [Document(page_content=versions[filepath][page], metadata={"source": filepath})]
+
+    monkeypatch.setattr(
+        IngestionPipeline,
+        "_loading_tasks",
+        lambda self, documents: [
+            _LoadingTask(filepath, extract, (filepath, page), last=page == ranges[filepath] - 1)
+            for filepath in documents
+            for page in range(ranges[filepath])
+        ],
+    )
+
+    stored = []
+    db = make_pipeline_db(stored)
+    versions[path].append("page four")
+    IngestionPipeline(make_pipeline_processor(), db, batch_size=2, workers=1).run("collection", [path])
+    first_version = dict(db.points)
+
+    versions[path][:] = ["page one", "new page two"]  # the third range fails now
+    IngestionPipeline(make_pipeline_processor(), db, batch_size=2, workers=1).run("collection", [path, other])
+    assert "new page two" in stored
+    assert {point_id: metadata["source"] for point_id, metadata in db.points.items() if metadata["source"] == path} == {
+        point_id: path for point_id in first_version
+    }
+    assert len(db.points) == len(first_version) + 1  # and the page of the other file
+
+    stored.clear()
+    db.points.clear()
+    versions[path][:] = ["page one", "page two", "page three"]
+    store_vectors = db.store_vectors.side_effect
+    db.store_vectors.side_effect = lambda *args, **kwargs: store_vectors(*args, **kwargs) if not stored else 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        IngestionPipeline(make_pipeline_processor(), db, batch_size=1, workers=1).run("collection", [path])
+    assert stored and db.points == {}
+
+
+# Tests a file cached in the upload store is stored without parsing and embedding and is not written to the cache again.
+def test_ingestion_pipeline_from_cache(tmp_path):
+    from uuid import uuid4
+    from app.core.chunks import Chunk
+    from app.core.pipeline import IngestionPipeline
+    from app.core.upload_store import UploadStore
+
+    store = UploadStore(root=tmp_path)
+    temp_path = store.temp_path()
+    with open(temp_path, "wb") as f:
+        f.write(b"cached")
+    digest = store.new_hash()
+    digest.update(b"cached")
+    path = store.commit_file(temp_path, digest.hexdigest(), "report.txt")
+
+    stored = []
+    processor, db = make_pipeline_processor(), make_pipeline_db(stored)
+    db.embedder.model_name, db.embedder.get_vector_dimensionality.return_value = "model", 2
+    writer = store.writer(UploadStore.model_key(db.embedder))
+    writer.append([Chunk(uuid4(), path, 0, 0, i, i, f"text {i}") for i in range(5)], [[float(i), 1.0] for i in range(5)])
+    writer.commit()
+
+    pipeline = IngestionPipeline(processor, db, batch_size=2, workers=1, store=store)
+    pipeline._cache_writer.append = MagicMock()
+    pipeline.run("collection", [path], sources={path: "report.txt"})
+
+    assert stored == [f"text {i}" for i in range(5)]
+    assert pipeline.files_from_cache == 1
+    processor.split_document.assert_not_called()
+    db.embedder.encode.assert_not_called()
+    pipeline._cache_writer.append.assert_not_called()
+
+
+# Tests an error in any stage stops IngestionPipeline and is raised by run.
+@pytest.mark.parametrize("stage", ["loader", "splitter", "embedder", "upserter"])
+def test_ingestion_pipeline_error(tmp_path, stage):
+    from app.core.pipeline import IngestionPipeline
+
+    path = str(tmp_path / "a.txt")
+    with open(path, "w") as f:
+        f.write("".join(f"line {i}\n" for i in range(100)))
+
+    stored = []
+    processor, db, store = make_pipeline_processor(), make_pipeline_db(stored), None
+    error = RuntimeError(f"{stage} failed")
+    if stage == "loader":
+        store = MagicMock()
+        store.has_cache.side_effect = error
+    elif stage == "splitter":
+        processor.split_document.side_effect = error
+    elif stage == "embedder":
+        db.embedder.encode.side_effect = error
+    else:
+        db.store_vectors.side_effect = error
+
+    pipeline = IngestionPipeline(processor, db, queue_size=1, batch_size=4, workers=1, store=store)
+    with pytest.raises(RuntimeError, match=f"{stage} failed"):
+        pipeline.run("collection", [path])
+    assert stored == []
+
+
+# Tests get_start_end_lines with the offsets index gives the same lines as scanning the text.
+def test_get_start_end_lines():
+    from app.core.processor import DocumentProcessor
+
+    processor = DocumentProcessor(embedder=None)
+    lines = ["first line", "", "third", "fourth line here"]
+    line_index = processor.build_line_index(lines)
+    assert line_index == [0, 11, 12, 18, 35]
+
+    assert processor.get_start_end_lines(lines, 0, 5, line_index=line_index) == (1, 1)
+    assert processor.get_start_end_lines(lines, 3, 15, line_index=line_index) == (1, 3)
+    assert processor.get_start_end_lines(lines, 11, 11, line_index=line_index) == (1, 1)
+    assert processor.get_start_end_lines(lines, 12, 30) == (3, 4)
+    assert processor.get_start_end_lines(lines, 20, 100) == (4, 0)
+
+
+# Tests for app/core/upload_store
+
+# Tests identical content gets one path and cached chunks/vectors are read back in order.
+def test_upload_store_cache(tmp_path):
+    from app.core.upload_store import UploadStore
+    from app.core.chunks import Chunk
+    from uuid import uuid4
+
+    store = UploadStore(root=tmp_path)
+    paths = []
+    for _ in range(2):
+        temp_path = store.temp_path()
+        with open(temp_path, "wb") as f:
+            f.write(b"same content")
+        digest = store.new_hash()
+        digest.update(b"same content")
+        paths.append(store.commit_file(temp_path, digest.hexdigest(), "report.TXT"))
+
+    assert paths[0] == paths[1] and paths[0].endswith(".txt")
+    assert store.digest_of(paths[0]) == digest.hexdigest()
+    assert store.file_path(os.path.basename(paths[0])) == paths[0]
+    assert store.file_path("cache") is None and store.file_path("../" + os.path.basename(paths[0])) is None
+    assert not store.has_cache(paths[0], "model-2")
+
+    chunks = [Chunk(uuid4(), paths[0], 0, i * 10, i + 1, i + 1, f"text {i}") for i in range(3)]
+    writer = store.writer("model-2")
+    writer.append(chunks, [[float(i), 1.0] for i in range(3)])
+    assert not store.has_cache(paths[0], "model-2")
+    writer.commit()
+
+    batches = list(store.read_cache(paths[0], "model-2", batch_size=2))
+    assert [len(batch) for batch, _ in batches] == [2, 1]
+    assert [chunk.text for batch, _ in batches for chunk in batch] == ["text 0", "text 1", "text 2"]
+    assert [vector for _, vectors in batches for vector in vectors] == [[0.0, 1.0], [1.0, 1.0], [2.0, 1.0]]
+
+
+# Tests for app/core/chunks
+
+# Tests stable ids depend only on source and text, and repeated texts get different ids.
+def test_assign_stable_ids():
+    from app.core.chunks import Chunk, assign_stable_ids
+    from uuid import uuid4, uuid5, NAMESPACE_URL
+
+    def make_chunks(texts):
+        return [Chunk(uuid4(), "/store/abc.txt", 0, 0, 1, 1, text) for text in texts]
+
+    first = assign_stable_ids(make_chunks(["intro", "body", "intro"]), "report.txt")
+    edited = assign_stable_ids(make_chunks(["new intro", "body", "intro"]), "report.txt")
+    other = assign_stable_ids(make_chunks(["body"]), "other.txt")
+
+    assert len({chunk.id for chunk in first}) == 3
+    assert first[1].id == edited[1].id and first[0].id == edited[2].id
+    assert edited[0].id not in {chunk.id for chunk in first}
+    assert other[0].id != first[1].id
+    assert first[0].get_metadata()["source"] == "report.txt"
+    assert first[2].id == uuid5(NAMESPACE_URL, "report.txt\x001\x00intro")
+
+    occurrences = {}  # counters keep digests, not the texts of the file
+    assign_stable_ids(make_chunks(["x" * 10_000, "x" * 10_000]), "big.txt", occurrences)
+    assert list(occurrences.values()) == [2] and all(len(key) == 32 for key in occurrences)
+
+
+# Tests for app/core/loaders
+
+# Tests pdf pages are split into ranges and extracted lazily with 0-based page numbers.
+def test_pdf_page_ranges(tmp_path):
+    from pypdf import PdfWriter
+    from app.core.loaders import pdf_page_ranges, iter_pdf_pages
+
+    path = str(tmp_path / "blank.pdf")
+    writer = PdfWriter()
+    for _ in range(10):
+        writer.add_blank_page(width=200, height=200)
+    with open(path, "wb") as f:
+        writer.write(f)
+
+    assert pdf_page_ranges(path, 4) == [(0, 4), (4, 8), (8, 10)]
+    pages = list(iter_pdf_pages(path, 4, 8))
+    assert [page.metadata["page"] for page in pages] == [4, 5, 6, 7]
+    assert all(page.metadata["source"] == path for page in pages)
+
+
+# Tests docx paragraphs are streamed one per line with tabs (not tab stops) and line breaks preserved and packed into windows.
+def test_load_docx(tmp_path):
+    import zipfile
+    from app.core.loaders import load_docx
+
+    namespace = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+    xml = (
+        f'<w:document xmlns:w="{namespace}"><w:body>'
+        "<w:p><w:pPr><w:tabs><w:tab w:val=\"left\" w:pos=\"720\"/><w:tab w:val=\"left\" w:pos=\"1440\"/></w:tabs></w:pPr>"
+        "<w:r><w:t>Hello</w:t><w:tab/><w:t>world</w:t></w:r></w:p><w:p/>"
+        "<w:tbl><w:tr><w:tc><w:p><w:r><w:t>cell</w:t><w:br/><w:t>two</w:t></w:r></w:p></w:tc></w:tr></w:tbl>"
+        "</w:body></w:document>"
+    )
+    path = str(tmp_path / "test.docx")
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("word/document.xml", xml)
+
+    documents = load_docx(path, window_size=1000)
+    assert len(documents) == 1
+    assert documents[0].page_content == "Hello\tworld\n\ncell\ntwo\n"
+    assert documents[0].metadata["source"] == path
+
+    # windows are cut between paragraphs and keep the position of their first symbol
+    documents = load_docx(path, window_size=13)
+    assert [document.page_content for document in documents] == ["Hello\tworld\n\n", "cell\ntwo\n"]
+    assert [document.metadata["char_offset"] for document in documents] == [0, 13]
+    assert [document.metadata["line_offset"] for document in documents] == [0, 2]
+
+
+# Tests uploads are saved by content hash in blocks and oversized ones are rejected.
+async def test_save_to_store(tmp_path, monkeypatch):
+    import io
+    import hashlib
+    from fastapi import UploadFile, HTTPException
+    from app.core.utils import save_to_store
+    from app.core.upload_store import UploadStore
+    from app.settings import settings
+
+    store = UploadStore(root=tmp_path)
+    monkeypatch.setattr(settings.upload_store, "read_size", 4)
+    monkeypatch.setattr(settings.upload_store, "max_file_size", 16)
+
+    content = b"0123456789"
+    path = await save_to_store(UploadFile(io.BytesIO(content), filename="notes.txt"), store)
+    assert path == store.path_for(hashlib.sha256(content).hexdigest(), "notes.txt")
+    with open(path, "rb") as f:
+        assert f.read() == content
+
+    with pytest.raises(HTTPException) as error:
+        await save_to_store(UploadFile(io.BytesIO(b"x" * 17), filename="big.txt"), store)
+    assert error.value.status_code == 413
+    assert sorted(os.listdir(tmp_path)) == [os.path.basename(path)]
+
+
+# Tests csv rows are packed into chunks with file line ranges as citations.
+def test_iter_csv_chunks(tmp_path):
+    from app.core.loaders import iter_csv_chunks
+
+    path = str(tmp_path / "table.csv")
+    with open(path, "w", newline="") as f:
+        f.write('name, age\nbob,3\n"multi\nline",4\nx,5\n')
+
+    chunks = [chunk for batch in iter_csv_chunks(path, chunk_size=25, chunks_per_batch=2) for chunk in batch]
+    assert [(chunk.start_line, chunk.end_line) for chunk in chunks] == [(2, 2), (3, 4), (5, 5)]
+    assert chunks[0].text == "name: bob\nage: 3"
+    assert chunks[1].text == "name: multi\nline\nage: 4"
+
+    chunks = [chunk for batch in iter_csv_chunks(path, chunk_size=1000) for chunk in batch]
+    assert len(chunks) == 1 and (chunks[0].start_line, chunks[0].end_line) == (2, 5)
+
+
+# Tests that windows of a memory-mapped text keep absolute offsets and do not cut lines or symbols.
+def test_iter_text_windows(tmp_path):
+    from app.core.loaders import iter_text_windows
+
+    path = str(tmp_path / "log.txt")
+    text = "".join(f"строка {i}\n" for i in range(100)) + "ё" * 50
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+    windows = list(iter_text_windows(path, window_size=64))
+    assert "".join(window.page_content for window in windows) == text
+    for window in windows:
+        start = window.metadata["char_offset"]
+        assert text[start : start + len(window.page_content)] == window.page_content
+        assert window.metadata["line_offset"] == text[:start].count("\n")
+
+    empty = str(tmp_path / "empty.txt")
+    open(empty, "w").close()
+    assert list(iter_text_windows(empty, window_size=64)) == []
+
+
+# Tests batched relevance gives the same chunks as adding them one by one.
+def test_update_most_relevant_chunks():
+    import numpy as np
+    from app.core.processor import DocumentProcessor
+    from app.core.chunks import Chunk
+
+    rnd = np.random.default_rng(5)
+    vectors = {str(i): rnd.normal(size=8).astype(np.float32) for i in range(60)}
+    embedder = MagicMock()
+    embedder.encode.side_effect = lambda text: vectors[text] if isinstance(text, str) else np.stack([vectors[t] for t in text])
+    processor = DocumentProcessor(embedder=embedder)
+
+    chunks = [Chunk(None, "a.txt", 0, 0, 0, 0, str(i)) for i in range(60)]
+    query = rnd.normal(size=8).astype(np.float32)
+
+    expected = []
+    for chunk in chunks:
+        similarity = processor.cosine_similarity(query, vectors[chunk.text])
+        processor.update_most_relevant_chunk([similarity, chunk], expected)
+
+    result = []
+    for start in range(0, 60, 25):
+        result = processor.update_most_relevant_chunks(query / np.linalg.norm(query), chunks[start : start + 25], result)
+
+    assert [chunk.text for _, chunk in result] == [chunk.text for _, chunk in expected]
+    assert np.allclose([score for score, _ in result], [score for score, _ in expected])
+
+
+# Tests the embedding cache encodes only new texts, counts hits and evicts the least recently used vectors.
+def test_embedding_cache(tmp_path):
+    import numpy as np
+    from app.core.embedding_cache import EmbeddingCache
+
+    cache = EmbeddingCache(path=str(tmp_path / "embeddings.sqlite3"), max_entries=2)
+    calls = []
+
+    def compute(texts):
+        calls.append(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    vectors = cache.get_or_compute("model-2", ["a", "bb", "a"], compute)
+    assert calls == [["a", "bb"]]
+    assert np.array_equal(vectors, [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0]])
+
+    cache.get_or_compute("model-2", ["bb"], compute)
+    assert len(calls) == 1 and cache.stats() == {"hits": 2, "misses": 2}
+
+    cache.get_or_compute("model-2", ["ccc"], compute)  # evicts "a", used the longest time ago
+    cache.get_or_compute("model-2", ["bb", "a"], compute)
+    assert calls[-1] == ["a"]
+
+    cache.get_or_compute("other-2", ["bb"], compute)  # other model does not share vectors
+    assert calls[-1] == ["bb"]
+
+
+# Tests the rate limiter spaces calls evenly and can be turned off.
+def test_rate_limiter():
+    import time
+    from app.core.rate_limiter import RateLimiter
+
+    limiter = RateLimiter(per_minute=1200)  # one call per 0.05 s
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.2
+
+    limiter = RateLimiter(per_minute=0)
+    start = time.monotonic()
+    for _ in range(100):
+        limiter.acquire()
+    assert time.monotonic() - start < 0.05
+
+
+# Tests GeminiEmbed retries a throttled batch with growing backoff and keeps the order of concurrent batches.
+def test_gemini_embed_retries(monkeypatch):
+    import threading
+    from types import SimpleNamespace
+    from unittest.mock import MagicMock
+    from concurrent.futures import ThreadPoolExecutor
+    from google.genai import errors
+    from app.core import models
+    from app.core.models import GeminiEmbed
+    from app.core.rate_limiter import RateLimiter
+    from app.settings import GeminiEmbeddingRequestsSettings
+
+    delays = []
+    monkeypatch.setattr(models, "time", SimpleNamespace(sleep=delays.append))
+    monkeypatch.setattr(models.random, "random", lambda: 1.0)  # no jitter
+
+    throttled = {"100": 2, "300": 1}  # the first text of a batch -> the number of 429 responses before success
+    attempts = []
+    lock = threading.Lock()
+
+    def embed_content(model, contents, config):
+        with lock:
+            attempts.append(contents[0])
+            if throttled.get(contents[0], 0) > 0:
+                throttled[contents[0]] -= 1
+                raise errors.APIError(429, {"error": {"code": 429, "message": "Resource exhausted"}})
+        return SimpleNamespace(embeddings=[SimpleNamespace(values=[float(text)]) for text in contents])
+
+    embedder = GeminiEmbed.__new__(GeminiEmbed)
+    embedder.model = "text-embedding-004"
+    embedder.cache = None
+    embedder.client = MagicMock()
+    embedder.client.models.embed_content.side_effect = embed_content
+    embedder.requests = GeminiEmbeddingRequestsSettings(concurrency=4, max_retries=3, backoff=1.0, max_backoff=1.5)
+    embedder.limiter = RateLimiter(0)
+    embedder.executor = ThreadPoolExecutor(max_workers=4)
+
+    texts = [str(i) for i in range(450)]
+    assert embedder.encode(texts) == [[float(i)] for i in range(450)]
+    assert sorted(attempts) == sorted(["0", "100", "100", "100", "200", "300", "300", "400"])
+    assert sorted(delays) == [1.0, 1.0, 1.5]  # 2 s of the second retry are capped by max_backoff
+
+    throttled["0"] = 10  # gives up after max_retries
+    with pytest.raises(errors.APIError):
+        embedder.encode(["0"])
+    assert attempts.count("0") == 1 + 4
+    embedder.executor.shutdown()
+
+
+# Tests the micro-batcher joins concurrent requests into one call and returns every caller its own vectors.
+def test_micro_batcher():
+    from concurrent.futures import ThreadPoolExecutor
+    from app.core.micro_batcher import MicroBatcher
+
+    calls = []
+
+    def encode(texts):
+        calls.append(len(texts))
+        return [[float(text)] for text in texts]
+
+    batcher = MicroBatcher(encode, max_batch_size=8, max_wait=0.2)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda i: batcher([str(i), str(i + 100)]), range(8)))
+
+    assert [result.tolist() for result in results] == [[[i], [i + 100]] for i in range(8)]
+    assert sum(calls) == 16 and len(calls) < 8
+
+    failing = MicroBatcher(lambda texts: 1 / 0, max_batch_size=8, max_wait=0.0)
+    with pytest.raises(ZeroDivisionError):
+        failing(["a"])
+
+
+# Tests batches by token budget cover every input once, keep padded size under budget and group similar lengths.
+def test_token_budget_batches():
+    from app.core.batching import token_budget_batches
+
+    lengths = [10, 500, 12, 490, 11, 9, 1000]
+    batches = token_budget_batches(lengths, token_budget=1000, max_batch_size=3)
+
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    assert all(len(batch) * max(lengths[i] for i in batch) <= 1000 for batch in batches)
+    assert batches == [[6], [1, 3], [2, 4, 0], [5]]
+    assert token_budget_batches([], token_budget=1000, max_batch_size=3) == []
+
+
+# Tests load_model picks the backend from settings, exports the quantized model once and keys caches by backend.
+def test_load_model_backends(tmp_path, monkeypatch):
+    import os
+    import sentence_transformers
+    from app.core.backends import load_model, backend_name
+    from app.core.embedding_cache import EmbeddingCache
+    from app.core.upload_store import UploadStore
+    from app.settings import settings
+
+    loaded, exported = [], []
+
+    class FakeModel:
+        def __init__(self, model, **kwargs):
+            loaded.append((model, kwargs))
+
+        def save_pretrained(self, path):
+            os.makedirs(os.path.join(path, "onnx"), exist_ok=True)
+
+    def export(model, quantization_config, model_name_or_path):
+        exported.append(quantization_config)
+        open(os.path.join(model_name_or_path, "onnx", f"model_qint8_{quantization_config}.onnx"), "w").close()
+
+    monkeypatch.setattr(sentence_transformers, "export_dynamic_quantized_onnx_model", export, raising=False)
+    monkeypatch.setattr(settings.models, "onnx_path", tmp_path)
+
+    monkeypatch.setattr(settings.models, "backend", "torch")
+    load_model(FakeModel, "org/model", "cpu")
+    assert loaded[-1] == ("org/model", {"device": "cpu"}) and backend_name() == "torch"
+
+    monkeypatch.setattr(settings.models, "backend", "onnx")
+    monkeypatch.setattr(settings.models, "quantize", False)
+    load_model(FakeModel, "org/model", "cpu")
+    assert loaded[-1] == ("org/model", {"device": "cpu", "backend": "onnx"}) and backend_name() == "onnx"
+
+    monkeypatch.setattr(settings.models, "quantize", True)
+    monkeypatch.setattr(settings.models, "quantization_config", "avx2")
+    quantized = ("org_model", "onnx/model_qint8_avx2.onnx")
+    for _ in range(2):
+        load_model(FakeModel, "org/model", "cpu")
+        path, kwargs = loaded[-1]
+        assert (os.path.relpath(path, tmp_path), kwargs["model_kwargs"]["file_name"]) == quantized
+    assert exported == ["avx2"] and len(loaded) == 5  # the second load skips the export
+    assert backend_name() == "onnx-qint8-avx2"
+
+    monkeypatch.setattr(settings.models, "backend", "tensorrt")
+    with pytest.raises(ValueError):
+        load_model(FakeModel, "org/model", "cpu")
+
+    assert EmbeddingCache.model_key("model", 384, "onnx-qint8-avx2") != EmbeddingCache.model_key("model", 384, "torch")
+
+    class FakeEmbedder:
+        model_name = "org/model"
+        backend = "onnx-qint8-avx2"
+
+        def get_vector_dimensionality(self):
+            return 384
+
+    assert UploadStore.model_key(FakeEmbedder()) == "org_model-384-onnx-qint8-avx2"
+
+
+# Tests workers of the embedding pool get separate groups of cores and are not started before the first call.
+def test_embedding_pool_core_groups():
+    from app.core.embedding_pool import EmbeddingPool, available_cores
+
+    cores = available_cores()
+    pool = EmbeddingPool("all-MiniLM-L6-v2", workers=2, cores_per_worker=1)
+
+    assert len(pool.core_groups) == 2 and pool._executors == []
+    if len(cores) >= 2:
+        assert pool.core_groups == [[cores[0]], [cores[1]]]
+
+
+# Tests a lazy component is created once on the first use and a failed creation is retried.
+def test_lazy_component():
+    from concurrent.futures import ThreadPoolExecutor
+    from app.core.rag_generator import LazyComponent
+
+    created = []
+    component = LazyComponent("model", lambda: created.append(1) or object())
+    assert component.readiness()["status"] == "not_loaded" and created == []
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        values = list(executor.map(lambda _: component.get(), range(8)))
+    assert len(created) == 1 and all(value is values[0] for value in values)
+    assert component.readiness()["status"] == "ready"
+
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionError("db is not up yet")
+        return "connection"
+
+    failing = LazyComponent("db", flaky)
+    with pytest.raises(ConnectionError):
+        failing.get()
+    assert failing.readiness() == {"status": "failed", "load_time": None, "error": "db is not up yet"}
+    assert failing.get() == "connection" and failing.readiness()["status"] == "ready"
+
+
+# Tests retrieval of concurrent requests runs off the event loop, so their queries are encoded in joint batches.
+async def test_generate_response_stream_concurrent():
+    import asyncio
+    from types import SimpleNamespace
+    from unittest.mock import MagicMock
+    from app.core.micro_batcher import MicroBatcher
+    from app.core.rag_generator import RagSystem, LazyComponent
+
+    calls = []
+
+    def encode(texts):
+        calls.append(len(texts))
+        return [[1.0] for _ in texts]
+
+    batcher = MicroBatcher(encode, max_batch_size=8, max_wait=0.2)
+
+    db = MagicMock()
+    db.search.side_effect = lambda collection_name, query, top_k: batcher([query]) and []
+
+    async def get_streaming_response(prompt, stream):
+        part = SimpleNamespace(text="answer")
+        yield SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+    llm = MagicMock()
+    llm.get_streaming_response = get_streaming_response
+    wrapper = MagicMock()
+    wrapper.wrap.side_effect = lambda prompt: prompt
+
+    rag = RagSystem.__new__(RagSystem)
+    rag.components = {
+        name: LazyComponent(name, lambda value=value: value)
+        for name, value in {"db": db, "llm": llm, "wrapper": wrapper, "reranking": MagicMock()}.items()
+    }
+
+    async def ask(i: int) -> list[str]:
+        return [text async for text in rag.generate_response_stream("collection", f"question {i}")]
+
+    answers = await asyncio.gather(*(ask(i) for i in range(8)))
+    assert answers == [["answer"]] * 8
+    assert sum(calls) == 8 and len(calls) < 8
+
+
+# Tests a model loaded on the first request is created in a thread and the event loop keeps serving meanwhile.
+async def test_generate_response_lazy_llm():
+    import asyncio
+    import time
+    from unittest.mock import MagicMock
+    from app.core.rag_generator import RagSystem, LazyComponent
+
+    def load_llm():
+        time.sleep(0.3)
+        llm = MagicMock()
+        llm.get_response.return_value = "answer"
+        return llm
+
+    rag = RagSystem.__new__(RagSystem)
+    rag.get_general_prompt = lambda user_prompt, collection_name: user_prompt
+    rag.components = {"llm": LazyComponent("llm", load_llm)}
+
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while rag.components["llm"].status != "ready":
+            ticks += 1
+            await asyncio.sleep(0.02)
+
+    answer, _ = await asyncio.gather(rag.generate_response("collection", "question"), tick())
+    assert answer == "answer" and ticks >= 5
+
+
+# Tests cascade reranking prunes candidates low in lexical and search order, reuses cached scores and stops at a large score gap.
+def test_cascade_reranker(monkeypatch):
+    from uuid import uuid4
+    from app.core.chunks import Chunk
+    from app.core.reranking import CascadeReranker, RerankCache
+    from app.settings import settings
+
+    monkeypatch.setattr(settings.reranking, "first_stage_keep", 5)
+    monkeypatch.setattr(settings.reranking, "batch_size", 2)
+    monkeypatch.setattr(settings.reranking, "score_gap", 3.0)
+
+    texts = ["qdrant stores vectors", "qdrant vectors index", "qdrant", "vectors", "qdrant vectors", "pizza", "cats"]
+    chunks = [Chunk(uuid4(), "a.txt", 0, 0, 0, 0, text) for text in texts]
+    scored = []
+
+    def rank(query, batch):
+        scored.extend(chunk.text for chunk in batch)
+        scores = [10.0 if "stores" in chunk.text else (5.0 if "index" in chunk.text else -5.0) for chunk in batch]
+        return sorted(({"corpus_id": i, "score": score} for i, score in enumerate(scores)), key=lambda r: -r["score"])
+
+    reranker = MagicMock()
+    reranker.rank.side_effect = rank
+    cascade = CascadeReranker(reranker, cache=RerankCache(max_entries=100))
+
+    ranks = cascade.rank("how qdrant stores vectors index", chunks, top_n=2)
+    assert [chunks[rank["corpus_id"]].text for rank in ranks[:2]] == ["qdrant stores vectors", "qdrant vectors index"]
+    assert "pizza" not in scored and "cats" not in scored  # pruned by the first stage
+    assert len(scored) == 4  # the second batch is far below the top, the fifth candidate is not scored
+
+    scored.clear()
+    assert cascade.rank("how qdrant stores vectors index", chunks, top_n=2) == ranks
+    assert scored == [] and cascade.metrics.as_dict()["cache_hits"] > 0
+
+
+# Tests the best dense candidate without words of the query survives the first stage and wins by the cross-encoder.
+def test_cascade_reranker_keeps_dense_top(monkeypatch):
+    from uuid import uuid4
+    from app.core.chunks import Chunk
+    from app.core.reranking import CascadeReranker, RerankCache
+    from app.settings import settings
+
+    monkeypatch.setattr(settings.reranking, "first_stage_keep", 5)
+    monkeypatch.setattr(settings.reranking, "batch_size", 8)
+
+    texts = ["the database keeps embeddings"] + [f"qdrant stores vectors {i}" for i in range(29)]
+    chunks = [Chunk(uuid4(), "a.txt", 0, 0, 0, 0, text) for text in texts]  # in the order of dense search
+
+    def rank(query, batch):
+        scores = [10.0 if "embeddings" in chunk.text else 0.0 for chunk in batch]
+        return sorted(({"corpus_id": i, "score": score} for i, score in enumerate(scores)), key=lambda r: -r["score"])
+
+    reranker = MagicMock()
+    reranker.rank.side_effect = rank
+    ranks = CascadeReranker(reranker, cache=RerankCache(max_entries=100)).rank("where qdrant stores vectors", chunks, top_n=2)
+
+    assert len(ranks) == 5 and chunks[ranks[0]["corpus_id"]].text == "the database keeps embeddings"
+
+
+# Tests batched dedupe rejects vectors close to stored ones and to earlier vectors of the same upload.
+def test_store_vectors_filters_duplicates(monkeypatch):
+    import numpy as np
+    from types import SimpleNamespace
+    from uuid import uuid4
+    from app.core.chunks import Chunk
+    from app.core.database import VectorDatabase
+    from app.settings import settings
+
+    monkeypatch.setattr(settings.dedupe_index, "enabled", False)  # checks go to the db
+    stored = np.asarray([[1.0, 0.0, 0.0]])
+
+    def query_batch_points(collection_name, requests):
+        return [
+            SimpleNamespace(points=[SimpleNamespace(score=float(np.max(stored @ np.asarray(r.query) / np.linalg.norm(r.query))))])
+            for r in requests
+        ]
+
+    db = VectorDatabase.__new__(VectorDatabase)
+    db.client = MagicMock()
+    db.client.query_batch_points.side_effect = query_batch_points
+    db.sparse_collections = {"collection": False}
+
+    vectors = [[2.0, 0.01, 0.0], [0.0, 1.0, 0.0], [0.0, 3.0, 0.05], [0.0, 0.0, 1.0], [0.0, 1.0, 0.02]]
+    chunks = [Chunk(uuid4(), "a.txt", 0, 0, 0, 0, str(i)) for i in range(len(vectors))]
+
+    assert db.store_vectors("collection", chunks, vectors, batch_size=3) == 2
+    assert db.client.query_batch_points.call_count == 2
+    upserted = [point.payload["text"] for call in db.client.upsert.call_args_list for point in call.kwargs["points"]]
+    assert upserted == ["1", "3"]
+
+
+# Tests the dedupe index is built only when enough vectors are checked against the collection, and a long build
+# does not hold uploads to other collections.
+def test_get_dedupe_index(monkeypatch):
+    import threading
+    from collections import OrderedDict
+    from types import SimpleNamespace
+    from app.core.database import VectorDatabase
+    from app.settings import settings
+
+    monkeypatch.setattr(settings.dedupe_index, "enabled", True)
+    monkeypatch.setattr(settings.dedupe_index, "build_ratio", 0.2)
+    counts = {"large": 10_000, "small": 10}
+    release = threading.Event()
+
+    def scroll(collection_name, **kwargs):
+        if collection_name == "large":
+            assert release.wait(timeout=5)
+        return [], None
+
+    db = VectorDatabase.__new__(VectorDatabase)
+    db.embedder = SimpleNamespace(get_vector_dimensionality=lambda: 8)
+    db.dedupe_indexes, db._dedupe_lock, db._dedupe_locks, db._dedupe_checked = OrderedDict(), threading.Lock(), {}, {}
+    db.client = MagicMock()
+    db.client.count.side_effect = lambda collection_name, exact: SimpleNamespace(count=counts[collection_name])
+    db.client.scroll.side_effect = scroll
+
+    assert db.get_dedupe_index("large", checked=10) is None  # a small upload is checked with db queries
+    assert db.client.scroll.call_count == 0 and "large" not in db.dedupe_indexes
+
+    builds = []
+    build = threading.Thread(target=lambda: builds.append(db.get_dedupe_index("large", checked=1990)))
+    build.start()  # 2000 checked vectors are a fifth of the collection, the index is worth building
+    assert db.get_dedupe_index("small", checked=10) is not None  # while "large" is being built
+    release.set()
+    build.join(timeout=5)
+    assert builds[0] is not None and db.get_dedupe_index("large") is builds[0]
+
+
+# Tests the near-duplicate index finds close vectors and same texts, forgets removed points and respects the limit.
+def test_near_duplicate_index():
+    import numpy as np
+    from app.core.dedupe_index import NearDuplicateIndex
+
+    rnd = np.random.default_rng(5)
+    vectors = rnd.normal(size=(200, 32)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    texts = [f"chunk {i} about qdrant and vectors" for i in range(200)]
+
+    index = NearDuplicateIndex(dimensionality=32, max_points=300)
+    assert index.add([str(i) for i in range(200)], vectors, texts)
+
+    noisy = vectors[:50] + rnd.normal(scale=0.02, size=(50, 32)).astype(np.float32)
+    noisy /= np.linalg.norm(noisy, axis=1, keepdims=True)
+    assert index.find_duplicates(noisy).all()
+    assert index.find_duplicates(vectors[:5], texts[:5]).all()
+
+    other = rnd.normal(size=(50, 32)).astype(np.float32)
+    other /= np.linalg.norm(other, axis=1, keepdims=True)
+    brute_force = (1 - (other @ vectors.T).max(axis=1)) < 0.15
+    assert np.array_equal(index.find_duplicates(other), brute_force)
+
+    index.remove(["0", "1"])
+    assert not index.find_duplicates(vectors[:2], texts[:2]).any() and len(index) == 198
+    assert not index.add([str(i) for i in range(1000, 1200)], other.repeat(4, axis=0), None)
+
+
+# Tests search of a collection without sparse vectors sends dense and keyword queries in one request, skips the keyword
+# one without keywords and merges by id.
+def test_search_batches_queries():
+    from types import SimpleNamespace
+    from uuid import uuid4
+    from app.core.database import VectorDatabase
+
+    ids = [str(uuid4()) for _ in range(3)]
+
+    def point(point_id):
+        return SimpleNamespace(id=point_id, payload={"metadata": {"id": point_id}, "text": point_id})
+
+    db = VectorDatabase.__new__(VectorDatabase)
+    db.embedder = MagicMock()
+    db.embedder.encode.return_value = [[0.1, 0.2]]
+    db.client = MagicMock()
+    db.sparse_collections = {"collection": False}
+    db.client.query_batch_points.return_value = [
+        SimpleNamespace(points=[point(ids[0]), point(ids[1])]),
+        SimpleNamespace(points=[point(ids[1]), point(ids[2])]),
+    ]
+
+    chunks = db.search("collection", "What is RAG?", top_k=10)
+    assert [str(chunk.id) for chunk in chunks] == ids
+    assert len(db.client.query_batch_points.call_args.kwargs["requests"]) == 2
+
+    db.client.query_batch_points.return_value = [SimpleNamespace(points=[point(ids[0])])]
+    db.search("collection", "what is it?", top_k=10)
+    assert len(db.client.query_batch_points.call_args.kwargs["requests"]) == 1
+    assert db.client.query_batch_points.call_count == 2
+
+
+# Tests hybrid search finds a chunk by a rare term through its sparse vector when the dense vector points elsewhere.
+def test_hybrid_search(monkeypatch):
+    from types import SimpleNamespace
+    from uuid import uuid4
+    from qdrant_client import QdrantClient
+    from app.core.chunks import Chunk
+    from app.core.database import VectorDatabase
+    from app.core.sparse import sparse_document_vector, sparse_query_vector
+    from app.settings import settings
+
+    monkeypatch.setattr(settings.dedupe_index, "enabled", False)
+    assert sparse_query_vector("Qdrant, qdrant!").indices == sparse_document_vector("qdrant").indices
+    assert sparse_query_vector("a b").indices == []
+
+    texts = ["dense retrieval with embeddings", "the QDRANT sparse index", "chunks of a pdf file"]
+    vectors = {texts[0]: [1.0, 0.0, 0.0], texts[1]: [0.0, 1.0, 0.0], texts[2]: [0.0, 0.0, 1.0]}
+    chunks = [Chunk(uuid4(), "a.txt", 0, 0, 0, 0, text) for text in texts]
+
+    db = VectorDatabase.__new__(VectorDatabase)
+    db.client = QdrantClient(":memory:")
+    db.embedder = SimpleNamespace(get_vector_dimensionality=lambda: 3, encode=lambda text: [[1.0, 0.0, 0.1]])
+    db.sparse_collections = {}
+    db.create_collection("collection")
+
+    assert db.has_sparse_vectors("collection")
+    assert db.store_vectors("collection", chunks, [vectors[text] for text in texts]) == 3
+
+    found = [chunk.get_raw_text() for chunk in db.search("collection", "what is qdrant?", top_k=2)]
+    assert found == [texts[1], texts[0]]  # found by both sub-queries, then the best dense one